@@ -0,0 +1,5 @@
+#!/usr/bin/env bash
+
+set -eo pipefail
+
+PYTHONPATH=src python src/benchmark/run_benchmarks.py "$@"
@@ -34,6 +34,7 @@ if __name__ == '__main__':
         package_dir={'gocdpb': 'src/gocdpb'},
         packages=['gocdpb'],
         install_requires=['jinja2', 'requests', 'PyYAML'],
+        extras_require={'lxml': ['lxml>=4.5']},
         entry_points={
             'console_scripts': [
                 'gocdpb=gocdpb.gocdpb:main',
@@ -0,0 +1,316 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for gocdpb, run against src/test/fake_goserver.py and local git
+repositories, so no Go server is needed.
+
+Run from the root of the repo with ./bench.sh (which passes arguments on
+to this script). Save the results of a run with --output, and compare a
+later run with them with --compare:
+
+    ./bench.sh --output before.json
+    (change something)
+    ./bench.sh --compare before.json
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from io import BytesIO
+from collections import OrderedDict, namedtuple
+from timeit import default_timer
+
+from test.fake_goserver import (FakeGoServer, FakeGoState, SyntheticTopology, pipeline_config,
+                                git_material, dependency_material)
+from gocdpb.goserver_adapter import Goserver
+from gocdpb.goserver_config import CruiseTree
+from gocdpb.gocd_settings import JsonSettings, Pipeline
+from gocdpb.tagrepos import branch_tag_repos
+
+Case = namedtuple('Case', 'name run setup')
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Keep output from the code under test out of the report.
+    """
+    saved = sys.stdout, sys.stderr
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = saved
+
+
+@contextlib.contextmanager
+def fake_server(state, latency):
+    cache_dir = tempfile.mkdtemp()
+    server = FakeGoServer(state, latency).start()
+    go = Goserver(None, False, {'url': server.url, 'cache_dir': cache_dir, 'instance_cache': False})
+    try:
+        yield go
+    finally:
+        go.close()
+        server.stop()
+        shutil.rmtree(cache_dir)
+        Goserver._parsed_configs.clear()
+
+
+def cruise_tree_cases(options):
+    for size in options.sizes:
+        xml = SyntheticTopology(pipelines=size, repos=max(1, size // 10), instances=0).build(FakeGoState()).xml
+        groups = ['group{:03d}'.format(i) for i in range(max(1, size // 20))]
+
+        def group_ops(tree, groups=groups):
+            for group in groups:
+                tree.rename_pipeline_group(group, group + '-renamed')
+            for group in groups:
+                tree.move_all_pipelines_in_group(group + '-renamed', group)
+            for group in groups:
+                tree.drop_pipeline_group(group + '-renamed')
+
+        def parsed(xml=xml):
+            return CruiseTree.fromstring(xml)
+
+        def chunks(tree):
+            for _chunk in tree.tostring_chunks():
+                pass
+
+        yield Case('cruise_tree.parse[{}]'.format(size), CruiseTree.fromstring, lambda xml=xml: xml)
+        yield Case('cruise_tree.fromstream[{}]'.format(size), CruiseTree.fromstream,
+                   lambda xml=xml: BytesIO(xml.encode('utf-8')))
+        yield Case('cruise_tree.tostring[{}]'.format(size), CruiseTree.tostring, parsed)
+        yield Case('cruise_tree.tostring_chunks[{}]'.format(size), chunks, parsed)
+        yield Case('cruise_tree.config_subset_tostring[{}]'.format(size), CruiseTree.config_subset_tostring, parsed)
+        yield Case('cruise_tree.group_ops[{}]'.format(size), group_ops, parsed)
+
+
+def server_operations_cases(options):
+    for count in options.operations:
+        operations = []
+        for i in range(count):
+            name = 'bench{:05d}'.format(i)
+            operations.append(OrderedDict([
+                ("create-a-pipeline", {"group": "bench", "pipeline": pipeline_config(
+                    name, [git_material('https://git.example.com/bench.git')])}),
+                ("environment", "env00"),
+                ("unpause", True),
+            ]))
+            operations.append({"add-downstream-dependencies": [
+                {"name": SyntheticTopology.pipeline_name(i % 100), "material": dependency_material(name)}]})
+        settings_json = json.dumps(operations)
+
+        def run(go, settings_json=settings_json):
+            JsonSettings(settings_json, {}).server_operations(go)
+
+        def setup():
+            return SyntheticTopology(pipelines=100, repos=10, instances=0).build(FakeGoState())
+
+        yield Case('server_operations[{}]'.format(count), run, setup)
+
+
+def traversal_cases(options):
+    shapes = [('deep', dict(fan_in=1)), ('wide', dict(fan_in=8))]
+    for shape, kwargs in shapes:
+        for size in options.dag_sizes:
+            state = SyntheticTopology(pipelines=size, repos=max(1, size // 10), **kwargs).build(FakeGoState())
+            top = '{}/1'.format(SyntheticTopology.pipeline_name(size - 1))
+            for jobs in (1, 8):
+                def run(go, top=top, jobs=jobs):
+                    pipeline = Pipeline(top, go, 'json')
+                    pipeline.prepare_recursive_repos(jobs)
+                    pipeline.collect_recursive_repos()
+
+                yield Case('traversal.{}[{}, jobs={}]'.format(shape, size, jobs), run, lambda state=state: state)
+
+
+def git(*args):
+    command = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com'] + list(args)
+    return subprocess.check_output(command, stderr=subprocess.STDOUT).decode('utf-8').strip()
+
+
+def make_bare_repos(directory, count):
+    structure = []
+    for i in range(count):
+        work = os.path.join(directory, 'work{:03d}'.format(i))
+        bare = os.path.join(directory, 'repo{:03d}.git'.format(i))
+        git('init', '-q', work)
+        with open(os.path.join(work, 'README'), 'w') as readme:
+            readme.write('repo {}\n'.format(i))
+        git('-C', work, 'add', 'README')
+        git('-C', work, 'commit', '-q', '-m', 'Initial')
+        git('-C', work, 'branch', '-M', 'master')
+        revision = git('-C', work, 'rev-parse', 'HEAD')
+        git('clone', '-q', '--bare', work, bare)
+        shutil.rmtree(work)
+        structure.append({'type': 'Git', 'description': 'URL: {}, Branch: master'.format(bare),
+                          'revision': revision, 'pipelines': [{'name': 'p{}'.format(i), 'counter': 1}]})
+    return structure
+
+
+class TagRepos(object):
+    """
+    Bare repositories to tag, with a fresh tag name for each run.
+    """
+    def __init__(self, count):
+        self.directory = tempfile.mkdtemp()
+        self.structure = make_bare_repos(self.directory, count)
+        self.runs = 0
+
+    def run(self, mode, jobs):
+        self.runs += 1
+        work_dir = tempfile.mkdtemp(dir=self.directory)
+        mirror_dir = os.path.join(self.directory, 'mirrors') if mode == 'mirror' else None
+        try:
+            branch_tag_repos(work_dir, 'bench-{}'.format(self.runs), self.structure, push=True, clean=True,
+                             jobs=jobs, mirror_dir=mirror_dir, remote=(mode == 'remote'))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def close(self):
+        shutil.rmtree(self.directory)
+
+
+def tag_repos_cases(options):
+    repos = TagRepos(options.repos)
+    options.cleanups.append(repos.close)
+    for mode in ('clone', 'mirror', 'remote'):
+        for jobs in (1, 8):
+            yield Case('branch_tag_repos.{}[{}, jobs={}]'.format(mode, options.repos, jobs),
+                       lambda mode=mode, jobs=jobs: repos.run(mode, jobs), None)
+
+
+SUITES = OrderedDict([
+    ('cruise_tree', (cruise_tree_cases, False)),
+    ('server_operations', (server_operations_cases, True)),
+    ('traversal', (traversal_cases, True)),
+    ('branch_tag_repos', (tag_repos_cases, False)),
+])
+
+
+def measure(case, repeat, latency=None):
+    """
+    Time case.run `repeat` times. Setup isn't included in the timing.
+    Cases with a server get a new fake server for each run, so that
+    they all start from the same state.
+    """
+    timings = []
+    for _ in range(repeat):
+        arg = case.setup() if case.setup else None
+        if latency is None:
+            start = default_timer()
+            with quiet():
+                case.run() if arg is None else case.run(arg)
+            timings.append(default_timer() - start)
+        else:
+            with fake_server(arg, latency) as go:
+                start = default_timer()
+                with quiet():
+                    case.run(go)
+                timings.append(default_timer() - start)
+    timings.sort()
+    return OrderedDict([("best", timings[0]), ("median", timings[len(timings) // 2]), ("repeat", repeat)])
+
+
+def git_commit():
+    try:
+        return git('rev-parse', '--short', 'HEAD')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(options):
+    results = OrderedDict()
+    options.cleanups = []
+    try:
+        for suite, (cases, uses_server) in SUITES.items():
+            if options.suites and suite not in options.suites:
+                continue
+            for case in cases(options):
+                if options.filter and options.filter not in case.name:
+                    continue
+                result = measure(case, options.repeat, options.latency if uses_server else None)
+                results[case.name] = result
+                print("{:55} {:10.4f} s".format(case.name, result['best']))
+                sys.stdout.flush()
+    finally:
+        for cleanup in options.cleanups:
+            cleanup()
+    return results
+
+
+def compare(results, baseline, threshold):
+    print()
+    print("{:55} {:>10} {:>10} {:>8}".format('benchmark', 'baseline', 'current', 'ratio'))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['best'], result['best']
+        ratio = after / before if before else float('inf')
+        verdict = ''
+        if ratio > 1 + threshold:
+            verdict = 'slower'
+        elif ratio < 1 - threshold:
+            verdict = 'faster'
+        print("{:55} {:10.4f} {:10.4f} {:8.2f} {}".format(name, before, after, ratio, verdict))
+
+
+def int_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+def main(args=sys.argv):
+    argparser = argparse.ArgumentParser(description="Measure the performance of gocdpb.")
+    argparser.add_argument("suites", nargs='*',
+                           help="Suites to run, out of: {}. Default is all of them.".format(", ".join(SUITES)))
+    argparser.add_argument("-k", "--filter", help="Only run benchmarks with this in their name.")
+    argparser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the best one counts.")
+    argparser.add_argument("--latency", type=float, default=0.002,
+                           help="Seconds of latency per request to the fake Go server.")
+    argparser.add_argument("--sizes", type=int_list, default=[100, 1000, 5000, 20000],
+                           help="Pipelines in the configs for cruise_tree, comma separated.")
+    argparser.add_argument("--operations", type=int_list, default=[10, 50],
+                           help="Pipelines to create in server_operations, comma separated.")
+    argparser.add_argument("--dag-sizes", type=int_list, default=[50, 200],
+                           help="Pipelines in the DAGs for traversal, comma separated.")
+    argparser.add_argument("--repos", type=int, default=10, help="Repositories for branch_tag_repos.")
+    argparser.add_argument("--quick", action='store_true', help="Small sizes and one run each.")
+    argparser.add_argument("-o", "--output", help="Save results as json in this file.")
+    argparser.add_argument("-c", "--compare", help="Compare with results saved with --output.")
+    argparser.add_argument("--threshold", type=float, default=0.1,
+                           help="Relative difference to report as slower/faster.")
+    options = argparser.parse_args(args[1:])
+    for suite in options.suites:
+        if suite not in SUITES:
+            argparser.error("unknown suite: {}".format(suite))
+    if options.quick:
+        options.sizes, options.operations, options.dag_sizes = [100, 1000], [10], [50]
+        options.repos, options.repeat = 3, 1
+
+    results = run_benchmarks(options)
+
+    if options.output:
+        report = OrderedDict([
+            ("commit", git_commit()),
+            ("python", platform.python_version()),
+            ("latency", options.latency),
+            ("results", results),
+        ])
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=4)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        compare(results, baseline['results'], options.threshold)
+
+
+if __name__ == '__main__':
+    main()
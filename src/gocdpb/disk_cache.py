@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+import os
+import io
+import sys
+import json
+import errno
+import hashlib
+import threading
+from collections import OrderedDict
+
+from jinja2 import BytecodeCache
+
+
+def default_cache_dir():
+    """
+    Where gocdpb keeps data between runs, unless 'cache_dir' is given in
+    the configuration. Can also be set with $GOCDPB_CACHE_DIR.
+    """
+    return (os.environ.get('GOCDPB_CACHE_DIR') or
+            os.path.join(os.path.expanduser('~'), '.cache', 'gocdpb'))
+
+
+def ensure_dir(path):
+    """
+    Make the directory, and any missing parents, accessible to the user
+    only, since the caches hold copies of the admin-only config.
+    """
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        ensure_dir(parent)
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def create_private(file_path, mode='wb', **kwargs):
+    """
+    Open a new file for writing, readable by the user only.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    return io.open(os.open(file_path, flags, 0o600), mode, **kwargs)
+
+
+def cache_key(*parts):
+    text = u'\0'.join(u'{}'.format(part) for part in parts)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def write_atomically(file_path, text):
+    """
+    Write via a temporary file, so that a concurrent reader never sees
+    a partially written file.
+    """
+    temp_path = '{}.{}.{}.tmp'.format(file_path, os.getpid(), threading.current_thread().ident)
+    with create_private(temp_path, 'w', encoding='utf-8') as temp_file:
+        temp_file.write(text)
+    os.rename(temp_path, file_path)
+
+
+def evict_least_recently_used(directory, suffix, max_bytes, keep_bytes=None):
+    """
+    If the files ending with suffix in directory take up more than
+    max_bytes, remove them, least recently used (by mtime) first, until
+    they take up at most keep_bytes (by default max_bytes).
+    :return: The size of the remaining files.
+    """
+    entries = []
+    total = 0
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(suffix):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, file_name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file_name))
+        total += stat.st_size
+    if total <= max_bytes:
+        return total
+    keep_bytes = max_bytes if keep_bytes is None else keep_bytes
+    for _mtime, size, file_name in sorted(entries):
+        if total <= keep_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, file_name))
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+class ConfigXmlCache(object):
+    """
+    The last cruise-config.xml we downloaded from a Go server,
+    together with its md5 (as given in x-cruise-config-md5).
+    """
+    def __init__(self, directory, server_url):
+        self.directory = os.path.join(directory, 'config')
+        self.key = cache_key(server_url)
+
+    @property
+    def xml_path(self):
+        return os.path.join(self.directory, self.key + '.xml')
+
+    @property
+    def md5_path(self):
+        return os.path.join(self.directory, self.key + '.md5')
+
+    @property
+    def md5(self):
+        """
+        md5 of the cached config, or None if there is no usable cache.
+        """
+        if not os.path.exists(self.xml_path):
+            return None
+        try:
+            with io.open(self.md5_path, encoding='utf-8') as md5_file:
+                return md5_file.read().strip() or None
+        except IOError:
+            return None
+
+    def open(self):
+        """
+        The cached config as a binary file, for streaming parsers.
+        """
+        return io.open(self.xml_path, 'rb')
+
+    def store_chunks(self, md5, chunks):
+        """
+        Pass on the (bytes) chunks of a config we're downloading, and
+        write them to the cache on the way. The config is only stored
+        if all chunks are read.
+        """
+        ensure_dir(self.directory)
+        # Invalidate first, so that a crash between the writes can't
+        # pair the new xml with the old md5.
+        self.clear()
+        temp_path = '{}.{}.{}.tmp'.format(self.xml_path, os.getpid(), threading.current_thread().ident)
+        try:
+            with create_private(temp_path) as temp_file:
+                for chunk in chunks:
+                    temp_file.write(chunk)
+                    yield chunk
+            os.rename(temp_path, self.xml_path)
+            write_atomically(self.md5_path, u'{}'.format(md5))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def clear(self):
+        for file_path in (self.md5_path, self.xml_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+class InstanceCache(object):
+    """
+    Pipeline instances, as returned by Goserver.get_pipeline_instance,
+    which never change once they exist. One json file per instance.
+
+    When the files take up more than max_bytes, the least recently used
+    ones are removed, down to keep_ratio of max_bytes. (File mtime is
+    updated on each read.) The directory is only listed on the first
+    put, and when the size of what we have put since then would take
+    the files over max_bytes.
+    """
+    default_max_bytes = 100 * 1024 * 1024
+    keep_ratio = 0.9
+
+    def __init__(self, directory, server_url, max_bytes=None):
+        self.directory = os.path.join(directory, 'instances')
+        self.server_url = server_url
+        self.max_bytes = self.default_max_bytes if max_bytes is None else max_bytes
+        # Size of the files, as of the last evict() and our puts since.
+        self.estimated_bytes = None
+        self.lock = threading.Lock()
+
+    def path(self, pipeline, counter):
+        return os.path.join(self.directory, cache_key(self.server_url, pipeline, counter) + '.json')
+
+    def get(self, pipeline, counter):
+        """
+        The cached instance, or None if we haven't seen it before.
+        """
+        file_path = self.path(pipeline, counter)
+        try:
+            with io.open(file_path, encoding='utf-8') as json_file:
+                text = json_file.read()
+            os.utime(file_path, None)
+        except (IOError, OSError):
+            return None
+        return json.loads(text, object_pairs_hook=OrderedDict)
+
+    def put(self, pipeline, counter, json_text):
+        ensure_dir(self.directory)
+        write_atomically(self.path(pipeline, counter), json_text)
+        with self.lock:
+            if self.estimated_bytes is not None:
+                self.estimated_bytes += len(json_text.encode('utf-8'))
+            if self.estimated_bytes is None or self.estimated_bytes > self.max_bytes:
+                self.estimated_bytes = self.evict()
+
+    def evict(self):
+        return evict_least_recently_used(self.directory, '.json', self.max_bytes,
+                                         int(self.max_bytes * self.keep_ratio))
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for file_name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
+
+
+class TemplateCache(BytecodeCache):
+    """
+    Jinja2 bytecode of compiled settings templates, so that a template
+    we have seen before is neither parsed nor compiled again. One file
+    per template source (see gocd_settings.compile_template) and Python
+    version, since the bytecode is marshalled code objects.
+
+    When the files take up more than max_bytes, the least recently used
+    ones are removed. (File mtime is updated on each read.)
+    """
+    default_max_bytes = 10 * 1024 * 1024
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = os.path.join(directory, 'templates')
+        self.max_bytes = self.default_max_bytes if max_bytes is None else max_bytes
+
+    def path(self, bucket):
+        return os.path.join(self.directory, '{}.py{}{}.cache'.format(bucket.key, *sys.version_info[:2]))
+
+    def load_bytecode(self, bucket):
+        file_path = self.path(bucket)
+        try:
+            with io.open(file_path, 'rb') as cache_file:
+                bucket.load_bytecode(cache_file)
+            os.utime(file_path, None)
+        except (IOError, OSError):
+            pass
+
+    def dump_bytecode(self, bucket):
+        ensure_dir(self.directory)
+        file_path = self.path(bucket)
+        temp_path = '{}.{}.{}.tmp'.format(file_path, os.getpid(), threading.current_thread().ident)
+        try:
+            with create_private(temp_path) as temp_file:
+                bucket.write_bytecode(temp_file)
+            os.rename(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        evict_least_recently_used(self.directory, '.cache', self.max_bytes)
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for file_name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
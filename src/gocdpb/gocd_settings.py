@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 import sys
+import csv
 import json
 import os.path
 from collections import OrderedDict, defaultdict
-from xml.etree import ElementTree
+from functools import partial
 
 import yaml
-from jinja2 import Template
+from jinja2 import Template, Environment, FunctionLoader
+
+from disk_cache import cache_key
+from operation_scheduler import OperationScheduler, bounded_map, name_dependencies
 
 
 class GoProxy(object):
@@ -16,9 +20,10 @@ class GoProxy(object):
     to figure out which pipelines should potentially
     be added to environment, unpaused etc.
     """
-    def __init__(self, go_server, settings):
+    def __init__(self, go_server, created):
         self.go = go_server
-        self.settings = settings
+        # (name, stage names) of the pipelines created by one operation.
+        self.created = created
 
     def __getattr__(self, item):
         if item == 'create_a_pipeline':
@@ -28,11 +33,11 @@ class GoProxy(object):
 
     def create_a_pipeline_wrapper(self, pipeline):
         self.go.create_a_pipeline(pipeline)
-        self.settings.pipeline_names.append(pipeline["pipeline"]["name"])
-        self.settings.pipeline_stage_names.append([
-            stage["name"] for stage
-            in pipeline["pipeline"].get("stages") or []
-        ])
+        self.created.append((
+            pipeline["pipeline"]["name"],
+            [stage["name"] for stage
+             in pipeline["pipeline"].get("stages") or []]
+        ))
 
 
 class JsonSettings(object):
@@ -46,21 +51,48 @@ class JsonSettings(object):
 
     See README.md for details.
     """
-    def __init__(self, settings_file, extra_settings, verbose=False):
+    def __init__(self, settings_file, extra_settings, verbose=False, template_cache=None):
         self.list = None
         self.go = None
         self.verbose = verbose
+        self.template_cache = template_cache
         self.load_file(settings_file, extra_settings)
-        self.pipeline_names = []
-        self.pipeline_stage_names = []
+        # The pipelines created by each operation, see GoProxy.
+        self.created = []
         self.pipeline_group_map = {}
+        # Environment name -> index of the last operation naming it.
+        self.environment_operations = OrderedDict()
+        # Index of the last operation with "unpause".
+        self.unpause_index = -1
+        self.scheduler = None
         self.action_plugins = OrderedDict()
 
     def load_file(self, settings_file, extra_settings):
         self.load_template(settings_file, extra_settings)
 
+    @staticmethod
+    def compile_template(template_data, template_cache=None):
+        """
+        With a template_cache (see disk_cache.TemplateCache), a template
+        which was compiled before is loaded as bytecode instead.
+        """
+        if template_cache is None:
+            return Template(template_data)
+        # The template is named by its content, so that's the cache key.
+        environment = Environment(loader=FunctionLoader(lambda name: template_data),
+                                  bytecode_cache=template_cache)
+        return environment.get_template(cache_key(template_data))
+
     def load_template(self, template_data, parameters):
-        template = Template(template_data)
+        """
+        :param template_data: The json settings template, as text or
+        as returned by compile_template().
+        :param parameters: Values for the template
+        """
+        if isinstance(template_data, Template):
+            template = template_data
+        else:
+            template = self.compile_template(template_data, self.template_cache)
         data = self.get_default_parameters()
         data.update(parameters)
         json_text = template.render(data)
@@ -85,54 +117,228 @@ class JsonSettings(object):
         data['repo_name'] = os.path.basename(os.getcwd())
         return data
 
-    def server_operations(self, go_server):
-        self.go = GoProxy(go_server, self)
+    @property
+    def pipeline_names(self):
+        return [name for created in self.created for name, stage_names in created]
+
+    @property
+    def pipeline_stage_names(self):
+        return [stage_names for created in self.created for name, stage_names in created]
+
+    def created_pipelines(self, index=None, succeeded=False):
+        """
+        (name, stage names) of the pipelines created by the operations
+        up to and including the one at index (all if None), in the order
+        of the operations.
+        :param succeeded: Only by the operations which ran without errors.
+        """
+        created = self.succeeded_created() if succeeded else self.created
+        return [pipeline for operation_created in created[:None if index is None else index + 1]
+                for pipeline in operation_created]
+
+    def created_until(self, index, succeeded=False):
+        return [name for name, stage_names in self.created_pipelines(index, succeeded)]
+
+    def succeeded_created(self):
+        """
+        The pipelines created by each operation, with none for those
+        which failed or weren't run.
+        """
+        if self.scheduler is None:
+            return self.created
+        return [created if record.seconds is not None and record.error is None else []
+                for created, record in zip(self.created, self.scheduler.records)]
+
+    def server_operations(self, go_server, jobs=1):
+        """
+        Even if an operation fails, the pipelines created by those which
+        succeeded are added to environments and unpaused.
+        """
+        try:
+            self.run_operations(go_server, jobs)
+        finally:
+            self.finish_pipelines()
+
+    def run_operations(self, go_server, jobs=1):
+        """
+        Run the operations on up to `jobs` threads. Operations which
+        refer to the same pipelines run in the order they are listed,
+        see operation_dependencies().
+        """
+        self.go = go_server
+        self.created = [[] for _ in self.list]
+        for index, operation in enumerate(self.list):
+            if "environment" in operation:
+                self.update_environment(operation, index)
+            if "unpause" in operation and operation["unpause"]:
+                self.unpause_index = index
+        self.scheduler = OperationScheduler(jobs)
+        self.scheduler.run([
+            (self.describe_operation(operation), partial(self.run_operation, index), dependencies)
+            for index, (operation, dependencies) in enumerate(zip(self.list, self.operation_dependencies()))
+        ])
+
+    def unpause_names(self):
+        # An operation with "unpause" unpauses all pipelines created so far.
+        return self.created_until(self.unpause_index, succeeded=True)
+
+    def run_operation(self, index):
+        operation = self.list[index]
+        go = GoProxy(self.go, self.created[index])
+        for action, plugin in self.action_plugins.items():
+            if action in operation:
+                plugin(go=go, operation=operation[action])
+        if "create-a-pipeline" in operation:
+            go.create_a_pipeline(operation["create-a-pipeline"])
+        if "add-downstream-dependencies" in operation:
+            self.update_downstream_pipelines(operation["add-downstream-dependencies"], index)
+
+    @staticmethod
+    def material_pipelines(materials):
+        return set(material["attributes"]["pipeline"] for material in materials
+                   if material.get("type") == "dependency" and material.get("attributes", {}).get("pipeline"))
+
+    def operation_pipelines(self, operation):
+        """
+        The names of the pipelines which the operation creates, changes
+        or depends on, or None if we can't tell. Plugin actions are
+        assumed to work on the pipeline in their data, like
+        "create-a-pipeline".
+        """
+        names = set()
+        for action, data in operation.items():
+            if action == "create-a-pipeline" or action in self.action_plugins:
+                pipeline = data.get("pipeline") if isinstance(data, dict) else None
+                if not isinstance(pipeline, dict) or not pipeline.get("name"):
+                    return None
+                names.add(pipeline["name"])
+                names.update(self.material_pipelines(pipeline.get("materials") or []))
+            elif action == "add-downstream-dependencies":
+                for dependency_update in data:
+                    names.add(dependency_update["name"])
+                    if "material" in dependency_update:
+                        names.update(self.material_pipelines([dependency_update["material"]]))
+        return names
+
+    def uses_last_created(self, operation):
+        """
+        True if the operation may depend on the pipeline created last,
+        see ensure_dependency_material().
+        """
+        for dependency_update in operation.get("add-downstream-dependencies", ()):
+            if "task" in dependency_update and not self.material_pipelines(
+                    [dependency_update["material"]] if "material" in dependency_update else []):
+                return True
+        return False
+
+    def operation_dependencies(self):
+        """
+        For each operation, the indexes of the earlier operations which
+        it must run after: Those referring to any of the same pipelines,
+        and all of them, if we can't tell what one of the two refers to.
+        Environments and unpausing are handled after all operations, so
+        they don't make operations depend on each other.
+        """
+        return name_dependencies([self.operation_pipelines(operation) for operation in self.list],
+                                 [self.uses_last_created(operation) for operation in self.list])
+
+    def settings_pipelines(self):
+        """
+        The names of the pipelines which any of the operations refer
+        to, or None if we can't tell.
+        """
+        names = set()
         for operation in self.list:
-            for action, plugin in self.action_plugins.items():
-                if action in operation:
-                    plugin(go=self.go, operation=operation[action])
-            if "create-a-pipeline" in operation:
-                self.go.create_a_pipeline(operation["create-a-pipeline"])
-            if self.pipeline_names and "environment" in operation:
-                self.update_environment(operation)
-            if "add-downstream-dependencies" in operation:
-                dependency_updates = operation["add-downstream-dependencies"]
-                for dependency_update in dependency_updates:
-                    downstream_name = dependency_update["name"]
-                    etag, pipeline = self.go.get_pipeline_config(downstream_name)
-                    # If this pipeline uses a template, we need to use that!!!
-                    self.add_downstream_dependencies(pipeline, dependency_update)
-                    self.go.edit_pipeline_config(downstream_name, etag, pipeline)
-            for pipeline_name in self.pipeline_names:
-                if "unpause" in operation and operation["unpause"]:
-                    self.go.unpause(pipeline_name)
-                if self.go.verbose:
-                    status = self.go.get_pipeline_status(pipeline_name)
-                    print(json.dumps(status, indent=4, sort_keys=True))
-
-    def add_downstream_dependencies(self, pipeline, update):
+            operation_names = self.operation_pipelines(operation)
+            if operation_names is None:
+                return None
+            names.update(operation_names)
+        return names
+
+    def describe_operation(self, operation):
+        actions = [action for action in operation
+                   if action in ("create-a-pipeline", "add-downstream-dependencies") or action in self.action_plugins]
+        names = self.operation_pipelines(operation)
+        return " ".join(actions) + (" " + ", ".join(sorted(names)) if names else "")
+
+    def print_report(self, out):
+        if self.scheduler is not None:
+            self.scheduler.print_report(out)
+
+    def finish_pipelines(self):
+        """
+        Add pipelines to environments, unpause each of the pipelines
+        that should be, once, and when verbose, show the status of each
+        created pipeline once, at the end.
+        """
+        self.patch_environments()
+        unpause_names = self.unpause_names()
+        if unpause_names:
+            self.concurrently(self.go.unpause, unpause_names)
+        pipeline_names = self.pipeline_names
+        if self.go.verbose and pipeline_names:
+            statuses = self.concurrently(self.go.get_pipeline_status, pipeline_names)
+            for status in statuses:
+                print(json.dumps(status, indent=4, sort_keys=True))
+
+    def concurrently(self, func, items):
+        """
+        func(item) for each item, on up to pool_size threads.
+        :return: The results, in the same order as the items.
+        """
+        return bounded_map(func, items, self.go.pool_size)
+
+    def update_downstream_pipelines(self, dependency_updates, index=None):
+        """
+        All updates of the same downstream pipeline are made with one
+        fetch and one put, and the downstream pipelines are updated
+        concurrently. Conflicting changes by others are retried, see
+        Goserver.update_pipeline_config.
+        :param index: Index of the operation, see ensure_dependency_material()
+        """
+        updates_by_name = OrderedDict()
+        for dependency_update in dependency_updates:
+            updates_by_name.setdefault(dependency_update["name"], []).append(dependency_update)
+
+        def update(name):
+            def change(pipeline):
+                # If this pipeline uses a template, we need to use that!!!
+                for dependency_update in updates_by_name[name]:
+                    self.add_downstream_dependencies(pipeline, dependency_update, index)
+            self.go.update_pipeline_config(name, change)
+
+        self.concurrently(update, updates_by_name)
+
+    def add_downstream_dependencies(self, pipeline, update, index=None):
         if "material" in update:
             pipeline["materials"].append(update["material"])
         if "task" in update:
-            self.ensure_dependency_material(pipeline)
+            self.ensure_dependency_material(pipeline, index)
             if "stages" in pipeline:
                 job = self.get_job(pipeline, update)
                 job["tasks"].insert(0, update["task"])
             else:
                 sys.stderr.write("Adding tasks to template not supported!\n")
 
-    def ensure_dependency_material(self, pipeline):
+    def ensure_dependency_material(self, pipeline, index=None):
+        """
+        The default dependency material is on the pipeline created last
+        by the operations up to the one at index (all if None), in the
+        order of the operations, even if later ones have already run.
+        """
         for material in pipeline['materials']:
             if material['type'] == 'dependency' and material['attributes']['pipeline']:
                 return
+        created = self.created_pipelines(index)
         # Expected dependency material not found. Add default.
-        if self.pipeline_stage_names and (len(self.pipeline_stage_names[-1]) == 1):
+        if created and (len(created[-1][1]) == 1):
+            name, stage_names = created[-1]
             pipeline['materials'].append(
                 {
                     "type": "dependency",
                     "attributes": {
-                        "pipeline": self.pipeline_names[-1],
-                        "stage": self.pipeline_stage_names[-1][0],
+                        "pipeline": name,
+                        "stage": stage_names[0],
                         "auto_update": True
                     }
                 }
@@ -159,27 +365,55 @@ class JsonSettings(object):
             job = stage["jobs"][0]
         return job
 
-    def update_environment(self, operation):
+    def update_environment(self, operation, index):
         """
-        If the setting names an environment, the pipelines in the
-        setting, should be assigned to that environment in the cruise-config.
-        :param configuration: Go configuration as xml.etree.ElementTree
+        If the setting names an environment, the pipelines created so
+        far should be assigned to that environment, see patch_environments().
         :param operation: Operation to perform in the Json settings
+        :param index: Index of the operation in the Json settings
         """
         op_env_name = operation.get('environment')
         if not op_env_name:
             return
-        self.go.patch_environment(op_env_name, pipelines_add=self.pipeline_names)
+        self.environment_operations[op_env_name] = index
+
+    def environment_names(self):
+        """
+        Environment name -> names of the pipelines which should be in it.
+        """
+        names_by_env = OrderedDict()
+        for env_name, index in self.environment_operations.items():
+            names = self.created_until(index, succeeded=True)
+            if names:
+                names_by_env[env_name] = names
+        return names_by_env
+
+    def patch_environments(self):
+        """
+        Add the pipelines to the environments named in the settings, with
+        one PATCH per environment, and only of the pipelines which aren't
+        in it already.
+        """
+        names_by_env = self.environment_names()
+        if not names_by_env:
+            return
+
+        def patch(env_name):
+            members = self.go.get_environment_pipelines(env_name)
+            names = [name for name in names_by_env[env_name] if name not in members]
+            if names:
+                self.go.patch_environment(env_name, pipelines_add=names)
+        self.concurrently(patch, names_by_env)
 
     @staticmethod
     def _set_pipeline_in_environment(name, conf_environment):
         conf_pipelines = conf_environment.find('pipelines')
         if conf_pipelines is None:
-            conf_pipelines = ElementTree.SubElement(
-                conf_environment, 'pipelines')
+            conf_pipelines = conf_environment.makeelement('pipelines', {})
+            conf_environment.append(conf_pipelines)
         # TODO: Check if already there?
-        conf_pipeline = ElementTree.SubElement(conf_pipelines, 'pipeline')
-        conf_pipeline.set('name', name)
+        conf_pipeline = conf_pipelines.makeelement('pipeline', {'name': name})
+        conf_pipelines.append(conf_pipeline)
 
 
 class YamlSettings(JsonSettings):
@@ -205,6 +439,101 @@ class YamlSettings(JsonSettings):
         self.load_template(open(template_path).read(), parameters)
 
 
+class BulkSettings(JsonSettings):
+    """
+    A BulkSettings object is initiated with one json settings
+    template and many parameter sets, e.g. one per repository.
+    The template is compiled once and rendered with each of the
+    parameter sets. The settings of different parameter sets run
+    concurrently, unless they refer to the same pipelines, and the
+    environments and unpausing of all of them are handled together,
+    at the end.
+    """
+    def __init__(self, settings_file, parameter_sets, extra_settings, verbose=False, template_cache=None):
+        self.parameter_sets = parameter_sets
+        self.settings = []
+        super(BulkSettings, self).__init__(settings_file, extra_settings, verbose, template_cache)
+
+    def load_file(self, settings_file, extra_settings):
+        """
+        Render the template with each of the parameter sets. As with
+        yaml settings, the extra settings override the parameter sets.
+        :param settings_file: Json settings template
+        :param extra_settings: settings from e.g. command line
+        """
+        template = self.compile_template(settings_file, self.template_cache)
+        for parameter_set in self.parameter_sets:
+            parameters = dict(parameter_set)
+            parameters.update(extra_settings)
+            self.settings.append(JsonSettings(template, parameters, verbose=self.verbose))
+        self.list = []
+
+    @staticmethod
+    def load_parameter_sets(parameter_file):
+        """
+        A list of parameter dicts, from a CSV file with a header row, a
+        file with one json object per line (.jsonl), or a yaml list.
+        """
+        name = getattr(parameter_file, 'name', '')
+        if name.endswith('.csv'):
+            return [dict(row) for row in csv.DictReader(parameter_file)]
+        if name.endswith(('.jsonl', '.ndjson')):
+            return [json.loads(line) for line in parameter_file if line.strip()]
+        parameter_sets = yaml.safe_load(parameter_file) or []
+        if not isinstance(parameter_sets, list) or not all(isinstance(item, dict) for item in parameter_sets):
+            raise ValueError("Expected a list of parameter sets in {}".format(name))
+        return parameter_sets
+
+    def register_plugin(self, module):
+        super(BulkSettings, self).register_plugin(module)
+        for settings in self.settings:
+            settings.register_plugin(module)
+
+    @staticmethod
+    def describe(index, parameter_set):
+        return "parameter set {}: {}".format(
+            index + 1, ", ".join("{}={}".format(key, value) for key, value in sorted(parameter_set.items())))
+
+    def server_operations(self, go_server, jobs=1):
+        """
+        Run the settings of each parameter set, on up to `jobs` threads.
+        A parameter set which fails doesn't stop the others, except those
+        referring to the same pipelines, which would have run after it.
+        """
+        self.go = go_server
+        self.scheduler = OperationScheduler(jobs, keep_going=True)
+        dependencies = name_dependencies([settings.settings_pipelines() for settings in self.settings])
+        try:
+            self.scheduler.run([
+                (self.describe(index, parameter_set), partial(settings.run_operations, go_server),
+                 dependencies[index])
+                for index, (parameter_set, settings) in enumerate(zip(self.parameter_sets, self.settings))
+            ])
+        finally:
+            self.finish_pipelines()
+
+    # Like for single settings, environments and unpausing are only
+    # handled for the operations which ran without errors, also in
+    # parameter sets where a later operation failed.
+    @property
+    def pipeline_names(self):
+        return [name for settings in self.settings for name in settings.created_until(None, succeeded=True)]
+
+    def unpause_names(self):
+        return [name for settings in self.settings for name in settings.unpause_names()]
+
+    def environment_names(self):
+        names_by_env = OrderedDict()
+        for settings in self.settings:
+            for env_name, names in settings.environment_names().items():
+                names_by_env.setdefault(env_name, []).extend(names)
+        return names_by_env
+
+    def print_report(self, out):
+        if self.scheduler is not None:
+            self.scheduler.print_report(out, "Parameter sets")
+
+
 def last_modification(modifications):
         return sorted(modifications, key=lambda rev: rev['modified_time'])[-1]
 
@@ -234,16 +563,38 @@ class SourceMaterial(object):
 
 
 class Pipeline(object):
-    def __init__(self, pipeline_instance, go, output_format):
+    """
+    A pipeline instance and its upstream pipeline instances.
+
+    The upstream graph is a DAG, where the same pipeline instance is often
+    reached through several paths. All Pipeline objects in a traversal
+    share the `visited` table, so that each instance is fetched, expanded
+    and collected only once.
+    """
+    def __init__(self, pipeline_instance, go, output_format, visited=None):
         self.pipeline, self.instance = pipeline_instance.split('/')[:2]
         self.go = go
         self.format = output_format
         self.upstreams = []
         self.source_repos = []
         self.recursive_repos = defaultdict(set)
+        self.visited = {} if visited is None else visited
+        self.visited[(self.pipeline, self.instance)] = self
+        self.prepared = False
+        self.collected = False
+
+    def upstream(self, pipeline_instance):
+        """
+        The Pipeline for pipeline_instance in this traversal, and
+        whether it's new, i.e. not visited before.
+        """
+        key = tuple(pipeline_instance.split('/')[:2])
+        if key in self.visited:
+            return self.visited[key], False
+        return Pipeline(pipeline_instance, self.go, self.format, self.visited), True
 
-    def print_recursive_repos(self):
-        self.prepare_recursive_repos()
+    def print_recursive_repos(self, jobs=1):
+        self.prepare_recursive_repos(jobs)
         self.collect_recursive_repos()
         if self.format == 'json':
             repos = [repo.as_dict(pipelines=[dict(zip(('name', 'counter'), pl)) for pl in pipelines])
@@ -255,18 +606,44 @@ class Pipeline(object):
         else:
             raise TypeError("Don't know how to print in format: {}".format(self.format))
 
-    def prepare_recursive_repos(self):
-        pipeline_instance = self.go.get_pipeline_instance(self.pipeline, self.instance)
+    def prepare_recursive_repos(self, jobs=1):
+        """
+        Walk the upstream graph breadth first. All pipeline instances on
+        the same level are fetched at once, by `jobs` concurrent workers.
+        """
+        level = [] if self.prepared else [self]
+        while level:
+            instances = bounded_map(Pipeline.fetch_instance, level, jobs)
+            next_level = []
+            for pipeline, pipeline_instance in zip(level, instances):
+                next_level.extend(pipeline.add_materials(pipeline_instance))
+            level = next_level
+
+    def fetch_instance(self):
+        return self.go.get_pipeline_instance(self.pipeline, self.instance)
+
+    def add_materials(self, pipeline_instance):
+        """
+        Register the materials of our pipeline instance.
+        :return: Upstream pipelines not visited before.
+        """
+        self.prepared = True
+        new_upstreams = []
         for material_revision in pipeline_instance['build_cause']['material_revisions']:
             if material_revision['material']['type'] == 'Pipeline':
                 last_mod = last_modification(material_revision['modifications'])
-                upstream_pipeline = Pipeline(last_mod['revision'], self.go, self.format)
+                upstream_pipeline, new = self.upstream(last_mod['revision'])
                 self.upstreams.append(upstream_pipeline)
-                upstream_pipeline.prepare_recursive_repos()
+                if new:
+                    new_upstreams.append(upstream_pipeline)
             else:
                 self.source_repos.append(SourceMaterial(material_revision))
+        return new_upstreams
 
     def collect_recursive_repos(self):
+        if self.collected:
+            return
+        self.collected = True
         for upstream in self.upstreams:
             upstream.collect_recursive_repos()
             for repo in upstream.recursive_repos:
@@ -7,7 +7,8 @@ import argparse
 import importlib
 import requests
 from goserver_adapter import Goserver
-from gocd_settings import JsonSettings, YamlSettings, Pipeline
+from goserver_config import CruiseTree
+from gocd_settings import JsonSettings, YamlSettings, BulkSettings, Pipeline
 
 
 def list2dict(list_of_pairs):
@@ -42,10 +43,36 @@ def repos(args=sys.argv):
         default='json',
         help="Format for output."
     )
+    argparser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Neither use nor update the local cache of pipeline instances."
+    )
+    argparser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="Empty the local cache of pipeline instances first."
+    )
+    argparser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of pipeline instances to fetch concurrently."
+    )
 
     go, pargs = init_run(argparser, args)
 
-    Pipeline(pargs.pipeline_instance, go, pargs.format).print_recursive_repos()
+    try:
+        if pargs.clear_cache and go.instance_cache:
+            go.instance_cache.clear()
+        if pargs.no_cache:
+            go.instance_cache = None
+
+        # More jobs than connections would only wait for a connection.
+        jobs = min(pargs.jobs, go.pool_size)
+        Pipeline(pargs.pipeline_instance, go, pargs.format).print_recursive_repos(jobs)
+    finally:
+        report_stats(go, pargs)
 
 
 def main(args=sys.argv):
@@ -70,6 +97,23 @@ def main(args=sys.argv):
         "--move-all-pipelines-in-group",
         help=":source-group-name:target-group-name (put separator as first char)"
     )
+    argparser.add_argument(
+        "--parameter-sets",
+        type=argparse.FileType('r'),
+        help="Render the -j settings with each of the parameter sets in this "
+             "yaml, csv or json lines (.jsonl) file, and run them all."
+    )
+    argparser.add_argument(
+        "--config-edit",
+        action="append",
+        help="Edit the config XML, e.g. 'move-pipeline :pipeline:group'. "
+             "All edits are uploaded together."
+    )
+    argparser.add_argument(
+        "--config-edits",
+        type=argparse.FileType('r'),
+        help="Read config edits from file, one per line."
+    )
     argparser.add_argument(
         "-p", "--plugin",
         action="append",
@@ -90,40 +134,69 @@ def main(args=sys.argv):
         type=argparse.FileType('w'),
         help="Copy of new GoCD configuration XML file."
     )
+    argparser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of independent setting operations, or parameter sets, to run concurrently. "
+             "With --stats, the time of each operation is reported."
+    )
 
     go, pargs = init_run(argparser, args)
 
     settings = None
-    if pargs.json_settings:
-        json_settings = get_json_settings(pargs.json_settings)
-        settings = JsonSettings(json_settings, list2dict(pargs.define or []), verbose=pargs.verbose)
+    try:
+        if pargs.parameter_sets is not None:
+            if not pargs.json_settings:
+                argparser.error("--parameter-sets needs -j/--json-settings")
+            json_settings = get_json_settings(pargs.json_settings)
+            settings = BulkSettings(json_settings, BulkSettings.load_parameter_sets(pargs.parameter_sets),
+                                    list2dict(pargs.define or []), verbose=pargs.verbose,
+                                    template_cache=go.template_cache)
+        elif pargs.json_settings:
+            json_settings = get_json_settings(pargs.json_settings)
+            settings = JsonSettings(json_settings, list2dict(pargs.define or []), verbose=pargs.verbose,
+                                    template_cache=go.template_cache)
 
-    if pargs.yaml_settings is not None:
-        settings = YamlSettings(pargs.yaml_settings, list2dict(pargs.define or []), verbose=pargs.verbose)
+        if pargs.yaml_settings is not None:
+            settings = YamlSettings(pargs.yaml_settings, list2dict(pargs.define or []), verbose=pargs.verbose,
+                                    template_cache=go.template_cache)
 
-    if settings:
-        if pargs.plugin:
-            for plugin in pargs.plugin:
-                settings.register_plugin(importlib.import_module(plugin))
-        settings.server_operations(go)
+        if settings:
+            if pargs.plugin:
+                for plugin in pargs.plugin:
+                    settings.register_plugin(importlib.import_module(plugin))
+            try:
+                settings.server_operations(go, min(pargs.jobs, go.pool_size))
+            finally:
+                if isinstance(settings, BulkSettings):
+                    settings.print_report(sys.stdout)
 
-    if pargs.rename_pipeline_group:
-        old_name, new_name = split_on_head(pargs.rename_pipeline_group)
-        go.rename_pipeline_group(old_name, new_name)
+        if pargs.rename_pipeline_group:
+            old_name, new_name = split_on_head(pargs.rename_pipeline_group)
+            go.rename_pipeline_group(old_name, new_name)
 
-    if pargs.move_all_pipelines_in_group:
-        old_name, new_name = split_on_head(pargs.move_all_pipelines_in_group)
-        go.move_all_pipelines_in_group(old_name, new_name)
+        if pargs.move_all_pipelines_in_group:
+            old_name, new_name = split_on_head(pargs.move_all_pipelines_in_group)
+            go.move_all_pipelines_in_group(old_name, new_name)
 
-    if pargs.dump is not None:
-        go.fetch_config()
-        envelope = '<?xml version="1.0" encoding="utf-8"?>\n%s'
-        pargs.dump.write(envelope % go.cruise_xml)
+        edits = [parse_config_edit(edit) for edit in pargs.config_edit or []]
+        if pargs.config_edits is not None:
+            edits.extend(read_config_edits(pargs.config_edits))
+        if edits:
+            go.edit_config(edits)
 
-    if pargs.dump_test_config is not None:
-        go.fetch_config()
-        envelope = '<?xml version="1.0" encoding="utf-8"?>\n%s'
-        pargs.dump_test_config.write(envelope % go.cruise_xml_subset)
+        if pargs.dump is not None:
+            go.fetch_config()
+            envelope = '<?xml version="1.0" encoding="utf-8"?>\n%s'
+            pargs.dump.write(envelope % go.cruise_xml)
+
+        if pargs.dump_test_config is not None:
+            go.fetch_config(sections=CruiseTree.select_sections(CruiseTree.test_config_sections))
+            envelope = '<?xml version="1.0" encoding="utf-8"?>\n%s'
+            pargs.dump_test_config.write(envelope % go.cruise_xml_subset)
+    finally:
+        report_stats(go, pargs, settings)
 
 
 def split_on_head(string_with_sep_first):
@@ -131,6 +204,35 @@ def split_on_head(string_with_sep_first):
     return names.split(separator)
 
 
+def parse_config_edit(edit):
+    """
+    'action :name1:name2' -> ('action', ['name1', 'name2'])
+    """
+    action, _, names = edit.strip().partition(' ')
+    names = names.strip()
+    return action, split_on_head(names) if names else []
+
+
+def read_config_edits(edits_file):
+    """
+    Config edits, one per line. Blank lines and lines starting with # are skipped.
+    """
+    return [parse_config_edit(line) for line in edits_file
+            if line.strip() and not line.lstrip().startswith('#')]
+
+
+def report_stats(go, pargs, settings=None):
+    if pargs.stats:
+        go.stats.print_report(sys.stderr)
+        # The report of parameter sets is always printed, on stdout.
+        if settings is not None and settings.scheduler is not None and not isinstance(settings, BulkSettings):
+            print(file=sys.stderr)
+            settings.print_report(sys.stderr)
+    if pargs.stats_json is not None:
+        go.stats.write_json(pargs.stats_json)
+        pargs.stats_json.close()
+
+
 def init_run(argparser, args):
     argparser.add_argument(
         "-v", "--verbose",
@@ -152,6 +254,16 @@ def init_run(argparser, args):
         action="append",
         help="Prompt for config parameter without echo."
     )
+    argparser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Write time and transfer per Go server endpoint to stderr."
+    )
+    argparser.add_argument(
+        "--stats-json",
+        type=argparse.FileType('w'),
+        help="Write time and transfer per Go server endpoint as json to this file."
+    )
     argparser.add_argument(
         "--set-test-config",
         type=argparse.FileType('r'),
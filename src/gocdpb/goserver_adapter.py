@@ -2,11 +2,55 @@
 from __future__ import print_function
 import sys
 import json
+import time
+import random
+import threading
 import yaml
 import requests
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.compat import urlencode
 
 from goserver_config import CruiseTree
+from disk_cache import ConfigXmlCache, InstanceCache, TemplateCache, default_cache_dir
+from request_stats import RequestStats
+
+
+class ChunkReader(object):
+    """
+    File-like object on top of an iterator of bytes chunks, such as
+    response.iter_content(), so that the XML can be parsed while it's
+    being downloaded.
+    """
+    def __init__(self, chunks, on_close=None):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.on_close = on_close
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        if self.on_close:
+            self.on_close()
+
+
+class ConflictError(RuntimeError):
+    """
+    The config on the Go server, or a pipeline config in it, changed
+    after we fetched it.
+    """
 
 
 class Goserver(object):
@@ -14,6 +58,23 @@ class Goserver(object):
     Manages HTTP communication with the Go server.
     """
     config_xml_rest_path = "/admin/restful/configuration/file/{}/xml"
+    pipelines_admin_path = "/api/admin/pipelines"
+    pipeline_admin_path = "/api/admin/pipelines/{name}"
+    environment_admin_path = "/api/admin/environments/{name}"
+    unpause_path = "/api/pipelines/{name}/unpause"
+    pipeline_status_path = "/api/pipelines/{name}/status"
+    pipeline_instance_path = "/api/pipelines/{name}/instance/{counter}"
+    pipeline_groups_path = "/api/config/pipeline_groups"
+    default_pool_size = 10
+    default_connect_timeout = 10.0
+    default_read_timeout = 300.0
+    stream_chunk_size = 64 * 1024
+    default_conflict_retries = 3
+    default_conflict_backoff = 1.0
+    max_conflict_backoff = 30.0
+    # Unedited parsed configs for the lifetime of the process:
+    # (url, md5) -> CruiseTree
+    _parsed_configs = {}
 
     def __init__(self, config, verbose, config_overrides):
         self.__config = {}
@@ -22,24 +83,160 @@ class Goserver(object):
         self.__config.update(config_overrides)
         self.verbose = verbose
         self._cruise_config_md5 = None
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._config_cache = None
+        self._instance_cache = None
+        self._template_cache = None
+        self.stats = RequestStats()
         self.tree = None
 
     def check_config(self):
         assert 'url' in self.__config, "'url' missing."
         assert not (('username' in self.__config) ^ ('password' in self.__config)), \
             "Need both or neither of ('username', 'password') in configuration."
+        try:
+            assert self.pool_size > 0, "'pool_size' must be positive."
+            assert all(t > 0 for t in self.timeout), "Timeouts must be positive."
+        except ValueError as error:
+            raise AssertionError(str(error))
 
-    def fetch_config(self):
+    def fetch_config(self, sections=None):
         """
         Fetch configuration from Go server
+
+        The XML is parsed while it's downloaded. With `sections` (see
+        CruiseTree.fromstream) we only keep some of it, and get a partial
+        tree, which we can look at, but not upload.
+
+        As long as the md5 of the config on the server is the same, we
+        reuse the (full) tree we parsed before in this process. It's only
+        handed to one fetch at a time, and taken out of the memo until
+        release_config() puts it back, if it wasn't edited.
+        """
+        self.release_config()
+        stream = self.config_xml_stream()
+        try:
+            memo_key = (self.__config['url'], self._cruise_config_md5)
+            tree = self._parsed_configs.pop(memo_key, None)
+            if tree is None:
+                tree = CruiseTree.fromstream(stream, sections)
+        finally:
+            stream.close()
+        self.tree = tree
+
+    def release_config(self):
+        """
+        Let go of the fetched tree. Unless it was edited (see
+        CruiseTree.edited), later fetches of the same config may reuse it.
+        """
+        tree = self.tree
+        self.tree = None
+        if tree is not None and not tree.partial and not tree.edited:
+            memo_key = (self.__config['url'], self._cruise_config_md5)
+            self._parsed_configs.setdefault(memo_key, tree)
+
+    def _config_flag(self, key, default):
+        value = self.__config.get(key, default)
+        if isinstance(value, bool):
+            return value
+        return str(value).lower() not in ('false', 'no', 'off', '0', '')
+
+    @property
+    def cache_dir(self):
+        return self.__config.get('cache_dir') or default_cache_dir()
+
+    @property
+    def config_cache(self):
+        """
+        Local copy of the cruise-config.xml, or None if disabled.
+        """
+        if self._config_cache is None and self._config_flag('config_cache', True):
+            self._config_cache = ConfigXmlCache(self.cache_dir, self.__config['url'])
+        return self._config_cache
+
+    @property
+    def instance_cache(self):
+        """
+        Local store of pipeline instances, or None if disabled.
         """
-        self.tree = CruiseTree.fromstring(self.xml_from_url())
+        if self._instance_cache is None and self._config_flag('instance_cache', True):
+            max_mb = self.__config.get('instance_cache_size')
+            max_bytes = None if max_mb is None else int(float(max_mb) * 1024 * 1024)
+            self._instance_cache = InstanceCache(self.cache_dir, self.__config['url'], max_bytes)
+        return self._instance_cache or None
+
+    @instance_cache.setter
+    def instance_cache(self, cache):
+        # False rather than None, so that we don't create a new one.
+        self._instance_cache = cache or False
+
+    @property
+    def template_cache(self):
+        """
+        Local store of compiled settings templates, or None if disabled.
+        """
+        if self._template_cache is None and self._config_flag('template_cache', True):
+            max_mb = self.__config.get('template_cache_size')
+            max_bytes = None if max_mb is None else int(float(max_mb) * 1024 * 1024)
+            self._template_cache = TemplateCache(self.cache_dir, max_bytes)
+        return self._template_cache or None
 
     @property
     def __auth(self):
         if 'username' in self.__config:
             return self.__config['username'], self.__config['password']
 
+    @property
+    def pool_size(self):
+        return int(self.__config.get('pool_size', self.default_pool_size))
+
+    @property
+    def timeout(self):
+        """
+        (connect, read) timeouts in seconds, as used by requests.
+        """
+        return (float(self.__config.get('connect_timeout', self.default_connect_timeout)),
+                float(self.__config.get('read_timeout', self.default_read_timeout)))
+
+    @property
+    def conflict_retries(self):
+        return int(self.__config.get('conflict_retries', self.default_conflict_retries))
+
+    def conflict_backoff(self, retry):
+        """
+        Seconds to wait before retry number `retry` of a config upload:
+        A random part of an exponentially growing, but bounded, time.
+        """
+        base = float(self.__config.get('conflict_backoff', self.default_conflict_backoff))
+        return random.uniform(0, min(self.max_conflict_backoff, base * 2 ** (retry - 1)))
+
+    @property
+    def session(self):
+        """
+        A keep-alive session shared by all requests to the Go server,
+        so that we only pay for the TCP/TLS handshake once per connection
+        in the pool, rather than once per REST call. It's made by the
+        first thread which needs it.
+        """
+        with self._session_lock:
+            if self._session is None:
+                adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                      pool_maxsize=self.pool_size)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.auth = self.__auth
+                self._session = session
+            return self._session
+
+    def close(self):
+        self.release_config()
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
     @property
     def cruise_xml(self):
         return self.tree.tostring()
@@ -48,35 +245,100 @@ class Goserver(object):
     def cruise_xml_subset(self):
         return self.tree.config_subset_tostring()
 
-    def request(self, action, path, **kwargs):
+    @staticmethod
+    def body_size(data):
+        if data is None:
+            return 0
+        if isinstance(data, dict):
+            data = urlencode(data)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return len(data)
+
+    @staticmethod
+    def response_size(response):
+        content = getattr(response, 'content', None)
+        if content is None:
+            content = (response.text or u'').encode('utf-8')
+        return len(content)
+
+    def request(self, action, path, template=None, retries=0, **kwargs):
+        """
+        Send a request to the Go server, and record what it cost in
+        self.stats. `template` is the path before the names were filled
+        in, so that we can see the cost per endpoint. `retries` is the
+        number of times the caller tried before.
+        """
         action = action.upper()
         base_url = self.__config['url']
         if not base_url.endswith('/go'):
             print('Adding /go to %s' % base_url)
             base_url += '/go'
         url = base_url + path
-        if self.__auth:
-            kwargs['auth'] = self.__auth
-        response = requests.request(action, url, **kwargs)
-        if response.status_code != 200:
+        kwargs.setdefault('timeout', self.timeout)
+        sent = self.body_size(kwargs.get('data'))
+        start = time.time()
+        try:
+            response = self.session.request(action, url, **kwargs)
+        except requests.RequestException:
+            self.stats.record(action, template or path, 'error', time.time() - start, sent, 0, retries)
+            raise
+        if kwargs.get('stream'):
+            # Don't read the content here. (Time is until the headers arrived.)
+            received = int(response.headers.get('Content-Length') or 0)
+        else:
+            received = self.response_size(response)
+        self.stats.record(action, template or path, response.status_code, time.time() - start,
+                          sent, received, retries)
+        if response.status_code not in (200, 304):
             sys.stderr.write("Failed to {} {}\n".format(action, url))
             sys.stderr.write("status-code: {}\n".format(response.status_code))
             sys.stderr.write(u"text: {}\n".format(response.text))
         return response
 
     def xml_from_url(self):
+        """
+        Get the cruise-config.xml as text.
+        """
+        stream = self.config_xml_stream()
+        try:
+            return stream.read().decode('utf-8')
+        finally:
+            stream.close()
+
+    def config_xml_stream(self):
+        """
+        Get the cruise-config.xml as a binary file-like object, which
+        reads from the response as it arrives. If we have a local copy,
+        we only ask the server to send the config if its md5 differs
+        from ours, and otherwise read the local copy.
+        """
         action = 'GET'
         path = self.config_xml_rest_path.format(action)
-        response = self.request(action, path)
+        headers = {}
+        cache = self.config_cache
+        cached_md5 = cache.md5 if cache else None
+        if cached_md5:
+            headers['If-None-Match'] = '"{}"'.format(cached_md5)
+        response = self.request(action, path, headers=headers, stream=True)
+        if response.status_code == 304 and cached_md5:
+            response.close()
+            self._cruise_config_md5 = cached_md5
+            return cache.open()
         if response.status_code != 200:
+            response.close()
             raise RuntimeError(str(response.status_code))
         try:
             self._cruise_config_md5 = response.headers['x-cruise-config-md5']
         except KeyError:
             print("Missing 'x-cruise-config-md5' in:", file=sys.stderr)
             print(response.headers, file=sys.stderr)
+            response.close()
             raise
-        return response.text
+        chunks = response.iter_content(self.stream_chunk_size)
+        if cache:
+            chunks = cache.store_chunks(self._cruise_config_md5, chunks)
+        return ChunkReader(chunks, response.close)
 
     def create_a_pipeline(self, pipeline):
         """
@@ -85,7 +347,7 @@ class Goserver(object):
 
         :param pipeline: Json object as describe in API above.
         """
-        path = "/api/admin/pipelines"
+        path = self.pipelines_admin_path
         data = json.dumps(pipeline)
         headers = {
             'Accept': 'application/vnd.go.cd+json',
@@ -96,11 +358,12 @@ class Goserver(object):
             raise RuntimeError(str(response.status_code))
 
     def get_pipeline_config(self, pipeline_name):
-        path = "/api/admin/pipelines/" + pipeline_name
+        template = self.pipeline_admin_path
+        path = template.format(name=pipeline_name)
         headers = {
             'Accept': 'application/vnd.go.cd+json'
         }
-        response = self.request('get', path, headers=headers)
+        response = self.request('get', path, template=template, headers=headers)
         if response.status_code != 200:
             raise RuntimeError(str(response.status_code))
         json_data = json.loads(response.text.replace("\\'", "'"),
@@ -108,25 +371,49 @@ class Goserver(object):
         etag = response.headers['etag']
         return etag, json_data
 
-    def edit_pipeline_config(self, pipeline_name, etag, pipeline):
-        path = "/api/admin/pipelines/" + pipeline_name
+    def edit_pipeline_config(self, pipeline_name, etag, pipeline, retries=0):
+        template = self.pipeline_admin_path
+        path = template.format(name=pipeline_name)
         data = json.dumps(pipeline)
         headers = {
             'Accept': 'application/vnd.go.cd+json',
             'Content-Type': 'application/json',
             'If-Match': etag
         }
-        response = self.request('put', path, data=data, headers=headers)
+        response = self.request('put', path, template=template, data=data, headers=headers, retries=retries)
+        if response.status_code == 412:
+            raise ConflictError(str(response.status_code))
         if response.status_code != 200:
             print(response.text)
             raise RuntimeError(str(response.status_code))
 
+    def update_pipeline_config(self, pipeline_name, change):
+        """
+        Fetch a pipeline config, call change(pipeline) to edit it in
+        place, and put it back. If someone else changed it in between,
+        fetch it and make the change again, with backoff, as
+        upload_config() does.
+        """
+        retry = 0
+        while True:
+            etag, pipeline = self.get_pipeline_config(pipeline_name)
+            change(pipeline)
+            try:
+                self.edit_pipeline_config(pipeline_name, etag, pipeline, retries=retry)
+                return
+            except ConflictError:
+                if retry >= self.conflict_retries:
+                    raise
+            retry += 1
+            time.sleep(self.conflict_backoff(retry))
+
     def delete_pipeline_config(self, pipeline_name):
-        path = "/api/admin/pipelines/" + pipeline_name
+        template = self.pipeline_admin_path
+        path = template.format(name=pipeline_name)
         headers = {
             'Accept': 'application/vnd.go.cd+json',
         }
-        response = self.request('delete', path, headers=headers)
+        response = self.request('delete', path, template=template, headers=headers)
         if response.status_code != 200:
             print(response.text)
             raise RuntimeError(str(response.status_code))
@@ -136,15 +423,15 @@ class Goserver(object):
             'Accept': 'application/vnd.go.cd+json',
             'X-GoCD-Confirm': 'true'
         }
-        path = "/api/pipelines/" + pipeline_name + "/unpause"
-        self.request('post', path, headers=headers)
+        template = self.unpause_path
+        self.request('post', template.format(name=pipeline_name), template=template, headers=headers)
 
     def get_pipeline_status(self, pipeline_name):
-        path = "/api/pipelines/" + pipeline_name + "/status"
+        template = self.pipeline_status_path
         headers = {
             'Accept': 'application/json'
         }
-        response = self.request('get', path, headers=headers)
+        response = self.request('get', template.format(name=pipeline_name), template=template, headers=headers)
         if response.status_code != 200:
             raise RuntimeError(str(response.status_code))
         json_data = json.loads(response.text.replace("\\'", "'"),
@@ -152,7 +439,7 @@ class Goserver(object):
         return json_data
 
     def get_pipeline_groups(self):
-        path = "/api/config/pipeline_groups"
+        path = self.pipeline_groups_path
         headers = {
             'Accept': 'application/json'
         }
@@ -164,17 +451,43 @@ class Goserver(object):
         return json_data
 
     def get_pipeline_instance(self, pipeline, instance):
-        path = "/api/pipelines/" + pipeline + "/instance/" + instance
+        """
+        A pipeline instance never changes once it exists, so we keep
+        them in the instance cache (if enabled) between runs.
+        """
+        cache = self.instance_cache
+        if cache:
+            json_data = cache.get(pipeline, instance)
+            if json_data is not None:
+                return json_data
+        template = self.pipeline_instance_path
         headers = {
             'Accept': 'application/json'
         }
-        response = self.request('get', path, headers=headers)
+        response = self.request('get', template.format(name=pipeline, counter=instance), template=template,
+                                headers=headers)
         if response.status_code != 200:
             raise RuntimeError(str(response.status_code))
-        json_data = json.loads(response.text.replace("\\'", "'"),
-                               object_pairs_hook=OrderedDict)
+        json_text = response.text.replace("\\'", "'")
+        json_data = json.loads(json_text, object_pairs_hook=OrderedDict)
+        if cache:
+            cache.put(pipeline, instance, json_text)
         return json_data
 
+    def get_environment_pipelines(self, env_name):
+        """
+        The names of the pipelines in an environment, from the
+        environments API rather than the whole config XML.
+        """
+        template = self.environment_admin_path
+        headers = {
+            'Accept': 'application/vnd.go.cd+json'
+        }
+        response = self.request('get', template.format(name=env_name), template=template, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(str(response.status_code))
+        return set(pipeline['name'] for pipeline in json.loads(response.text).get('pipelines', ()))
+
     def patch_environment(
             self,
             env_name,
@@ -182,7 +495,7 @@ class Goserver(object):
             pipelines_remove=None,
             agents_add=None,
             agents_remove=None):
-        path = "/api/admin/environments/" + env_name
+        template = self.environment_admin_path
         pipelines = {}
         if pipelines_add:
             pipelines["add"] = pipelines_add
@@ -203,7 +516,8 @@ class Goserver(object):
             'Accept': 'application/vnd.go.cd+json',
             'Content-Type': 'application/json'
         }
-        response = self.request('patch', path, data=data, headers=headers)
+        response = self.request('patch', template.format(name=env_name), template=template, data=data,
+                                headers=headers)
         if response.status_code != 200:
             raise RuntimeError(str(response.status_code))
 
@@ -211,16 +525,65 @@ class Goserver(object):
         """
         This method pushes a new cruise-config.xml to the go server.
         It's used when there is no REST API for the changes we want to do.
+
+        If the tree is the same as when it was fetched, nothing is sent.
+
+        If someone else changed the config after we fetched it, we fetch
+        it again, make the same edits (see CruiseTree.replay) and try
+        again, up to `conflict_retries` times, with backoff.
+        """
+        if self.tree.partial:
+            raise ValueError("Can't upload a config where only some sections were loaded.")
+        retry = 0
+        while True:
+            try:
+                self.post_config(retry)
+                return
+            except ConflictError:
+                if retry >= self.conflict_retries or not self.tree.operations:
+                    raise
+            retry += 1
+            self.rebase_config(retry)
+
+    def rebase_config(self, retry):
         """
+        Fetch the config again, after a while, and make the edits we
+        made to the one we have.
+        """
+        operations = self.tree.operations
+        delay = self.conflict_backoff(retry)
+        if self.verbose:
+            print("Config changed on server, retrying in {:.1f}s.".format(delay))
+        time.sleep(delay)
+        self.fetch_config()
+        self.tree.replay(operations)
+
+    def post_config(self, retry=0):
+        tree = self.tree
+        changes = None
+        if tree.original_fingerprint is not None:
+            changes = CruiseTree.fingerprint_diff(tree.original_fingerprint, tree.fingerprint())
+        if not tree.edited or changes == []:
+            if self.verbose:
+                print("Config unchanged, not uploaded.")
+            tree.forget_edits()
+            return
+        if changes and self.verbose:
+            print("Config changes:\n{}\n".format("\n".join(changes)))
         headers = {
             'Confirm': 'true'
         }
+        # A form rather than chunks, so that it's sent with a Content-Length.
+        # Some proxies in front of Go servers reject chunked request bodies.
         data = {'xmlFile': self.cruise_xml, 'md5': self._cruise_config_md5}
         action = 'POST'
         response = self.request(action,
                                 self.config_xml_rest_path.format(action),
                                 headers=headers,
-                                data=data)
+                                data=data,
+                                retries=retry)
+        if response.status_code == 409:
+            raise ConflictError(response.status_code)
         if response.status_code != 200:
             sys.stderr.write("status-code: %s\n" % response.status_code)
             # GoCD produces broken JSON???, see
@@ -231,6 +594,19 @@ class Goserver(object):
             sys.stderr.write(
                 "originalContent:\n%s\n" % json_data["originalContent"])
             raise RuntimeError(response.status_code)
+        # The server has it now, so there is nothing to compare with.
+        tree.original_fingerprint = None
+
+    def edit_config(self, edits):
+        """
+        Make all `edits`, (action, names) pairs for CruiseTree.edit(), in
+        one fetched config, and upload it once. If an edit fails, nothing
+        is uploaded.
+        """
+        self.fetch_config()
+        for action, names in edits:
+            self.tree.edit(action, *names)
+        self.upload_config()
 
     def rename_pipeline_group(self, source_name, target_name):
         target_group = None
@@ -242,8 +618,8 @@ class Goserver(object):
             names = ", ".join(p['name'] for p in target_group['pipelines'])
             raise ValueError('Pipeline group "{}" exists and contains pipelines: {}'.format(target_name, names))
         self.fetch_config()
-        if target_group:
-            self.tree.drop_pipeline_group(target_name)
+        # Checked again when the edits are replayed after a conflict.
+        self.tree.make_room_for_group(target_name)
         self.tree.rename_pipeline_group(source_name, target_name)
         self.upload_config()
 
@@ -257,9 +633,90 @@ class Goserver(object):
             names = ", ".join(p['name'] for p in target_group['pipelines'])
             raise ValueError('Pipeline group "{}" exists and contains pipelines: {}'.format(target_name, names))
         self.fetch_config()
-        if target_group:
-            self.tree.drop_pipeline_group(target_name)
+        # Checked again when the edits are replayed after a conflict.
+        self.tree.make_room_for_group(target_name)
         self.tree.move_all_pipelines_in_group(source_name, target_name)
         self.upload_config()
 
 
+class AsyncGoserver(object):
+    """
+    Concurrent counterpart to Goserver.
+
+    Offers the same REST operations as Goserver, but each call returns
+    immediately with an AsyncResult. Call .get() on it, or pass a list
+    of them to gather(), to wait for the outcome. Exceptions raised by
+    Goserver are re-raised by .get().
+
+    At most `concurrency` calls are in flight at the same time, and they
+    all share the connection pool of the wrapped Goserver, so concurrency
+    is capped at its pool_size. (This is based on threads, not asyncio,
+    since we still need to run on Python 2.7.)
+    """
+    def __init__(self, go_server, concurrency=None):
+        self.go = go_server
+        self.concurrency = min(concurrency or go_server.pool_size, go_server.pool_size)
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def verbose(self):
+        return self.go.verbose
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.concurrency)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def submit(self, func, *args, **kwargs):
+        return self.pool.apply_async(func, args, kwargs)
+
+    def map(self, func, iterable):
+        """
+        Call func for each item concurrently, and return the results in
+        the same order as the items.
+        """
+        return self.pool.map(func, iterable)
+
+    @staticmethod
+    def gather(results):
+        return [result.get() for result in results]
+
+    def create_a_pipeline(self, pipeline):
+        return self.submit(self.go.create_a_pipeline, pipeline)
+
+    def get_pipeline_config(self, pipeline_name):
+        return self.submit(self.go.get_pipeline_config, pipeline_name)
+
+    def edit_pipeline_config(self, pipeline_name, etag, pipeline):
+        return self.submit(self.go.edit_pipeline_config, pipeline_name, etag, pipeline)
+
+    def update_pipeline_config(self, pipeline_name, change):
+        return self.submit(self.go.update_pipeline_config, pipeline_name, change)
+
+    def unpause(self, pipeline_name):
+        return self.submit(self.go.unpause, pipeline_name)
+
+    def get_pipeline_status(self, pipeline_name):
+        return self.submit(self.go.get_pipeline_status, pipeline_name)
+
+    def get_pipeline_instance(self, pipeline, instance):
+        return self.submit(self.go.get_pipeline_instance, pipeline, instance)
+
+    def get_environment_pipelines(self, env_name):
+        return self.submit(self.go.get_environment_pipelines, env_name)
+
+    def patch_environment(self, env_name, **kwargs):
+        return self.submit(self.go.patch_environment, env_name, **kwargs)
@@ -1,53 +1,145 @@
 # -*- coding: utf-8 -*-
 import copy
+import hashlib
+import functools
+from collections import OrderedDict
 from xml.etree import ElementTree
 
+from xml_backend import default_backend, indent
+
+
+def replayable(method):
+    """
+    Record calls to a CruiseTree edit method in tree.operations, so that
+    the same edits can be made to a newer config, see replay(). Calls
+    from other recorded methods aren't recorded by themselves.
+
+    The tree is marked as edited before the first call, even if it
+    fails half way, and the fingerprint of the tree as it was before is
+    kept, so that we can tell what the edits changed.
+    """
+    @functools.wraps(method)
+    def recorded(self, *args):
+        if self._recording:
+            return method(self, *args)
+        if not self.edited:
+            if not self.partial:
+                self.original_fingerprint = self.fingerprint()
+            self.edited = True
+        self._recording = True
+        try:
+            result = method(self, *args)
+        finally:
+            self._recording = False
+        self.operations.append((method.__name__, args))
+        return result
+    return recorded
+
 
 class CruiseTree(ElementTree.ElementTree):
     """
     A thin layer on top of the cruise-config.xml used by the Go server.
     """
+    # Sections of the config replaced by set_test_settings_xml().
+    test_config_sections = ('pipelines', 'templates', 'environments')
+    # True if only some sections were loaded, see fromstream().
+    partial = False
+
+    # The XML library we use, see xml_backend.
+    backend = default_backend()
+
+    # Name -> element indexes, built by index().
+    _groups = None
+    _pipelines = None
+    _templates = None
+
+    _recording = False
+    # True once an edit method was called, see replayable.
+    edited = False
+    # fingerprint() from before the first edit, for full trees.
+    original_fingerprint = None
+
+    def __init__(self, element=None, file=None):
+        ElementTree.ElementTree.__init__(self, element, file)
+        # (method name, args) for the edits made, see replayable.
+        self.operations = []
+
+    def replay(self, operations):
+        """
+        Make edits recorded in another tree's operations to this tree.
+        Changes made directly to the elements aren't recorded, and don't
+        mark the tree as edited.
+        """
+        for name, args in operations:
+            getattr(self, name)(*args)
+
+    def forget_edits(self):
+        """
+        Mark the tree as unedited, when the edits turned out to change
+        nothing, so that it can be reused.
+        """
+        self.operations = []
+        self.edited = False
+        self.original_fingerprint = None
 
     @classmethod
     def fromstring(cls, text):
-        return cls(ElementTree.fromstring(text))
+        return cls(cls.backend.fromstring(text))
+
+    @classmethod
+    def fromstream(cls, stream, sections=None):
+        """
+        Parse the XML in a file-like object while it's being read.
+
+        With `sections`, a function which tells whether to keep a top
+        level element (see select_sections), other top level elements
+        are dropped as soon as they are parsed. Such a tree is partial,
+        and must not be uploaded to the Go server.
+        """
+        root = None
+        depth = 0
+        for event, element in cls.backend.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1 and sections is not None and not sections(element):
+                root.remove(element)
+        tree = cls(root)
+        tree.partial = sections is not None
+        return tree
+
+    @staticmethod
+    def select_sections(tags=(), groups=()):
+        """
+        A `sections` function for fromstream(), which keeps the top
+        level elements with the given tags, and the named pipeline groups.
+        """
+        def keep(element):
+            return element.tag in tags or (element.tag == 'pipelines' and element.get('group') in groups)
+        return keep
 
     def tostring(self):
-        self.indent(self.getroot())
-        return ElementTree.tostring(self.getroot())
+        return self.backend.tostring(self.getroot())
+
+    def tostring_chunks(self):
+        """
+        The same XML as tostring(), in one chunk per top level element,
+        so that we never hold all of it in memory at once.
+        """
+        return self.backend.tostring_chunks(self.getroot())
 
     def config_subset_tostring(self):
         """
         See GoProxy.set_test_settings_xml()
         """
-        root = copy.deepcopy(self).getroot()
-        for child in list(root):
-            if child.tag not in ('pipelines', 'templates', 'environments'):
-                root.remove(child)
-        self.indent(root)
-        return ElementTree.tostring(root)
+        root = self.getroot()
+        sections = [child for child in root if child.tag in self.test_config_sections]
+        return b''.join(self.backend.tostring_chunks(root, sections))
 
-    @classmethod
-    def indent(cls, elem, level=0):
-        """
-        Fredrik Lundh's standard recipe.
-        (Why isn't this in xml.etree???)
-        :param elem: the XML element
-        :param level: how much indentation
-        """
-        i = "\n" + level * "  "
-        if len(elem):
-            if not elem.text or not elem.text.strip():
-                elem.text = i + "  "
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-            for elem in elem:
-                cls.indent(elem, level + 1)
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-        else:
-            if level and (not elem.tail or not elem.tail.strip()):
-                elem.tail = i
+    indent = staticmethod(indent)
 
     def set_test_settings_xml(self, test_settings_xml):
         """
@@ -63,22 +155,27 @@ class CruiseTree(ElementTree.ElementTree):
         We want to replace the sections pipelines*, templates and environments.
         Let server and agents stay as usual.
         We've never used repositories so far.
-        :param test_settings_xml:
+        :param test_settings_xml: file with the XML
         """
+        self.set_test_settings(test_settings_xml.read())
+
+    @replayable
+    def set_test_settings(self, xml):
         root = self.getroot()
 
         self.drop_sections_to_be_replaced(root)
 
-        test_settings = CruiseTree().parse(test_settings_xml)
+        test_settings = self.backend.fromstring(xml)
 
         ix = self.place_for_test_settings(root)
 
         for element_type in ('environments', 'templates', 'pipelines'):
             for elem in reversed(test_settings.findall(element_type)):
                 root.insert(ix, elem)
+        self._groups = None
 
     def drop_sections_to_be_replaced(self, root):
-        for tag in ('pipelines', 'templates', 'environments'):
+        for tag in self.test_config_sections:
             for element_to_drop in self.findall(tag):
                 root.remove(element_to_drop)
 
@@ -90,25 +187,273 @@ class CruiseTree(ElementTree.ElementTree):
                 break
         return ix
 
+    def index(self):
+        """
+        Look up pipeline groups, pipelines and templates by name from now
+        on, rather than by scanning the config. The edit methods below
+        keep the indexes up to date. Call reindex() after editing the
+        elements in some other way.
+        """
+        if self._groups is not None:
+            return
+        self._pipelines = {}
+        self._templates = {}
+        self._index_groups()
+        for group in self.findall('pipelines'):
+            self._index_pipelines(group)
+        for templates in self.findall('templates'):
+            for template in templates.findall('pipeline'):
+                self._templates.setdefault(template.get('name'), template)
+
+    def reindex(self):
+        self._groups = None
+        self.index()
+
+    def _index_groups(self):
+        # Group names should be unique, but if they aren't, we keep all
+        # of them in document order, and find the first.
+        self._groups = {}
+        for group in self.findall('pipelines'):
+            self._groups.setdefault(group.get('group'), []).append(group)
+
+    def _add_group(self, group):
+        if group.get('group') in self._groups:
+            self._index_groups()
+        else:
+            self._groups[group.get('group')] = [group]
+
+    def _remove_group(self, group):
+        groups = self._groups[group.get('group')]
+        groups.remove(group)
+        if not groups:
+            del self._groups[group.get('group')]
+
+    def _index_pipelines(self, group):
+        for pipeline in group.findall('pipeline'):
+            self._pipelines.setdefault(pipeline.get('name'), (group, pipeline))
+
+    def _unindex_pipelines(self, group):
+        for pipeline in group.findall('pipeline'):
+            if self._pipelines.get(pipeline.get('name'), (None, None))[1] is pipeline:
+                del self._pipelines[pipeline.get('name')]
+
+    def find_pipeline_group(self, name):
+        """
+        The <pipelines group="name"> element, or None.
+        """
+        self.index()
+        groups = self._groups.get(name)
+        return groups[0] if groups else None
+
+    def find_pipeline(self, name):
+        """
+        (group, pipeline) elements for the pipeline, or None.
+        """
+        self.index()
+        return self._pipelines.get(name)
+
+    def find_template(self, name):
+        """
+        The <pipeline name="name"> element in <templates>, or None.
+        """
+        self.index()
+        return self._templates.get(name)
+
+    # Attributes which tell elements with the same tag apart in fingerprint().
+    key_attributes = ('group', 'name', 'uuid')
+
+    @classmethod
+    def element_key(cls, element):
+        for attribute in cls.key_attributes:
+            if element.get(attribute) is not None:
+                return u'{}[{}]'.format(element.tag, element.get(attribute))
+        return element.tag
+
+    @staticmethod
+    def element_fields(element):
+        """
+        The tag, attributes, text and tail of an element, as bytes.
+        Text which is only whitespace is left out, since that's
+        indentation, which tostring() changes.
+        """
+        fields = [element.tag]
+        for text in element.text, element.tail:
+            fields.append(text if text and text.strip() else '')
+        for key, value in sorted(element.attrib.items()):
+            fields.extend((key, value))
+        return u'\0'.join(fields).encode('utf-8')
+
+    @classmethod
+    def update_digest(cls, digest, element):
+        digest.update(cls.element_fields(element))
+        for child in element:
+            digest.update(b'<')
+            cls.update_digest(digest, child)
+        digest.update(b'>')
+
+    def fingerprint(self):
+        """
+        An md5 digest of each top level section, and of each element in
+        those, in an OrderedDict with keys such as 'pipelines[group1]'
+        and 'pipelines[group1]/pipeline[p1]'. The root element itself has
+        the key ''. It doesn't depend on indentation, so compare a
+        fingerprint from before some edits with one from after them to
+        see what changed.
+        """
+        root = self.getroot()
+        fingerprint = OrderedDict([(u'', hashlib.md5(self.element_fields(root)).hexdigest())])
+        for section in root:
+            section_key = self.unique_key(fingerprint, self.element_key(section))
+            fingerprint[section_key] = None
+            section_digest = hashlib.md5(self.element_fields(section))
+            for element in section:
+                key = self.unique_key(fingerprint, section_key + u'/' + self.element_key(element))
+                digest = hashlib.md5()
+                self.update_digest(digest, element)
+                fingerprint[key] = digest.hexdigest()
+                section_digest.update(fingerprint[key].encode('ascii'))
+            fingerprint[section_key] = section_digest.hexdigest()
+        return fingerprint
+
+    @staticmethod
+    def unique_key(fingerprint, key):
+        unique, count = key, 1
+        while unique in fingerprint:
+            count += 1
+            unique = u'{}#{}'.format(key, count)
+        return unique
+
+    @staticmethod
+    def fingerprint_diff(before, after):
+        """
+        What differs between two fingerprints, as lines such as
+        '+ pipelines[g]/pipeline[p]' (added), '- ...' (removed) and
+        '~ ...' (changed). The elements in an added or removed section
+        aren't listed, and a changed section is only listed if none of
+        the elements in it were added, removed or changed.
+        """
+        keys = list(before) + [key for key in after if key not in before]
+        changed = [key for key in keys if before.get(key) != after.get(key)]
+        changed_sections = set(key.split('/')[0] for key in changed if '/' in key)
+        lines = []
+        for key in changed:
+            section = key.split('/')[0]
+            if key == section and section in changed_sections and section in before and section in after:
+                continue
+            if key != section and (section not in before or section not in after):
+                continue
+            mark = '+' if key not in before else '-' if key not in after else '~'
+            lines.append(u'{} {}'.format(mark, key or '(root)'))
+        return lines
+
+    # The edits that edit() can make, and the number of names they take.
+    edits = {
+        'rename-pipeline-group': 2,
+        'move-all-pipelines-in-group': 2,
+        'drop-pipeline-group': 1,
+        'move-pipeline': 2,
+    }
+
+    @replayable
+    def edit(self, action, *names):
+        """
+        Make one of the edits above, e.g. edit('move-pipeline', 'p1', 'g2').
+
+        Unlike the methods it calls, it raises ValueError if the group or
+        pipeline to change is missing, and if a group would get the name
+        of a group which has pipelines. An empty group with that name is
+        dropped, like Goserver.rename_pipeline_group does.
+        """
+        if action not in self.edits:
+            raise ValueError('Unknown config edit "{}", expected one of: {}'.format(
+                action, ", ".join(sorted(self.edits))))
+        if len(names) != self.edits[action]:
+            raise ValueError('Config edit "{}" takes {} names, got: {}'.format(
+                action, self.edits[action], ", ".join(names)))
+        if action == 'move-pipeline':
+            if self.find_pipeline(names[0]) is None:
+                raise ValueError('No pipeline "{}" in config'.format(names[0]))
+            self.move_pipeline(*names)
+            return
+        if self.find_pipeline_group(names[0]) is None:
+            raise ValueError('No pipeline group "{}" in config'.format(names[0]))
+        if action == 'drop-pipeline-group':
+            self.drop_pipeline_group(*names)
+            return
+        self.make_room_for_group(names[1])
+        if action == 'rename-pipeline-group':
+            self.rename_pipeline_group(*names)
+        else:
+            self.move_all_pipelines_in_group(*names)
+
+    @replayable
+    def make_room_for_group(self, name):
+        group = self.find_pipeline_group(name)
+        if group is None:
+            return
+        names = [pipeline.get('name') for pipeline in group.findall('pipeline')]
+        if names:
+            raise ValueError('Pipeline group "{}" exists and contains pipelines: {}'.format(name, ", ".join(names)))
+        self.drop_pipeline_group(name)
+
+    @replayable
     def rename_pipeline_group(self, old_name, new_name):
-        for element in self.findall('pipelines'):
-            if element.attrib['group'] == old_name:
-                element.attrib['group'] = new_name
-                break
+        group = self.find_pipeline_group(old_name)
+        if group is None:
+            return
+        self._remove_group(group)
+        group.attrib['group'] = new_name
+        self._add_group(group)
 
+    @replayable
     def move_all_pipelines_in_group(self, source_group, target_group):
-        for i, old_group in enumerate(self.getroot()):
-            if old_group.tag == 'pipelines' and old_group.attrib['group'] == source_group:
-                new_group = copy.deepcopy(old_group)
-                new_group.attrib['group'] = target_group
-                self.getroot().insert(i, new_group)
-                for pipeline in old_group.findall('pipeline'):
-                    old_group.remove(pipeline)
-                break
+        old_group = self.find_pipeline_group(source_group)
+        if old_group is None:
+            return
+        root = self.getroot()
+        new_group = old_group.makeelement(old_group.tag, dict(old_group.attrib))
+        new_group.attrib['group'] = target_group
+        new_group.text, new_group.tail = old_group.text, old_group.tail
+        # The pipelines move to the new group. The rest, e.g.
+        # authorization, stays and is copied.
+        for child in list(old_group):
+            if child.tag == 'pipeline':
+                old_group.remove(child)
+                new_group.append(child)
+                if self._pipelines.get(child.get('name'), (None, None))[1] is child:
+                    self._pipelines[child.get('name')] = (new_group, child)
+            else:
+                new_group.append(copy.deepcopy(child))
+        root.insert(list(root).index(old_group), new_group)
+        self._add_group(new_group)
 
+    @replayable
     def drop_pipeline_group(self, name):
-        for element in self.findall('pipelines'):
-            if element.attrib['group'] == name:
-                root = self.getroot()
-                root.remove(element)
-                break
+        group = self.find_pipeline_group(name)
+        if group is None:
+            return
+        self.getroot().remove(group)
+        self._remove_group(group)
+        self._unindex_pipelines(group)
+
+    @replayable
+    def move_pipeline(self, name, target_group):
+        """
+        Move a pipeline to another group. A missing group is created
+        after the one the pipeline was in.
+        """
+        found = self.find_pipeline(name)
+        if found is None:
+            return
+        old_group, pipeline = found
+        new_group = self.find_pipeline_group(target_group)
+        if new_group is old_group:
+            return
+        if new_group is None:
+            root = self.getroot()
+            new_group = old_group.makeelement('pipelines', {'group': target_group})
+            root.insert(list(root).index(old_group) + 1, new_group)
+            self._add_group(new_group)
+        old_group.remove(pipeline)
+        new_group.append(pipeline)
+        self._pipelines[name] = (new_group, pipeline)
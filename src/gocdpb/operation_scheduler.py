@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    from Queue import Queue
+except ImportError:  # Python 3
+    from queue import Queue
+
+OperationRecord = namedtuple('OperationRecord', 'index description seconds error')
+
+
+@contextmanager
+def thread_pool(jobs):
+    """
+    A ThreadPool with `jobs` threads, or None if jobs < 2, so that the
+    caller runs things itself. The pool is closed and joined on exit.
+    """
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    try:
+        yield pool
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def bounded_map(func, items, jobs):
+    """
+    func(item) for each item, on up to `jobs` threads. For calls to the
+    Go server, jobs should be at most its pool_size, since the calls
+    beyond that would only wait for a connection.
+    :return: The results, in the same order as the items.
+    """
+    items = list(items)
+    with thread_pool(min(jobs, len(items))) as pool:
+        if pool is None:
+            return [func(item) for item in items]
+        return pool.map(func, items)
+
+
+def name_dependencies(names, after_all=None):
+    """
+    For each of a list of sets of names, the indexes of the earlier sets
+    with any of the same names. A set which is None, since we can't tell,
+    depends on all earlier ones, and all later ones depend on it.
+    :param after_all: For each set, True if it should depend on all
+    earlier ones anyway.
+    """
+    after_all = after_all or [False] * len(names)
+    return [set(earlier for earlier in range(index)
+                if after_all[index] or names[index] is None or names[earlier] is None or
+                names[index] & names[earlier])
+            for index in range(len(names))]
+
+
+class OperationScheduler(object):
+    """
+    Run operations on up to `jobs` threads. Each operation starts after
+    the earlier operations it depends on have finished, and otherwise in
+    the order given. After a failure, no more operations are started,
+    or with `keep_going`, only those depending on a failed one aren't.
+    The first error is raised once the running ones have finished.
+    """
+    def __init__(self, jobs=1, keep_going=False):
+        self.jobs = max(1, jobs)
+        self.keep_going = keep_going
+        self.records = []
+        self.seconds = 0.0
+
+    @staticmethod
+    def timed(index, func):
+        start = time.time()
+        try:
+            func()
+        except Exception as error:
+            return index, time.time() - start, error
+        return index, time.time() - start, None
+
+    def run(self, operations):
+        """
+        :param operations: (description, func, dependencies) for each
+        operation, where dependencies are the indexes of the operations
+        it must run after.
+        """
+        start = time.time()
+        self.records = [OperationRecord(index, description, None, None)
+                        for index, (description, func, dependencies) in enumerate(operations)]
+        finished = set()
+        started = set()
+        results = Queue()
+        jobs = min(self.jobs, len(operations))
+        errors = []
+        running = 0
+        try:
+            with thread_pool(jobs) as pool:
+                while True:
+                    for index, (description, func, dependencies) in enumerate(operations):
+                        if (errors and not self.keep_going) or running >= jobs:
+                            break
+                        if index in started or not finished.issuperset(dependencies):
+                            continue
+                        started.add(index)
+                        running += 1
+                        if pool is None:
+                            results.put(self.timed(index, func))
+                        else:
+                            pool.apply_async(self.timed, (index, func), callback=results.put)
+                    if not running:
+                        break
+                    index, seconds, error = results.get()
+                    running -= 1
+                    self.records[index] = self.records[index]._replace(seconds=seconds, error=error)
+                    if error is None:
+                        finished.add(index)
+                    else:
+                        errors.append((index, error))
+        finally:
+            self.seconds = time.time() - start
+        if errors:
+            raise min(errors)[1]
+
+    def print_report(self, out, title="Settings operations"):
+        print("{}: {}, on up to {} threads, {:.3f}s".format(
+            title, len(self.records), self.jobs, self.seconds), file=out)
+        for record in self.records:
+            if record.seconds is None:
+                result = "not run"
+            elif record.error is not None:
+                result = "failed after {:.3f}s: {!r}".format(record.seconds, record.error)
+            else:
+                result = "{:.3f}s".format(record.seconds)
+            print("  {:3} {}: {}".format(record.index + 1, record.description, result), file=out)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+RequestRecord = namedtuple('RequestRecord', 'method template status seconds sent received retries')
+
+
+class RequestStats(object):
+    """
+    What each request to the Go server cost. Goserver.request adds a
+    RequestRecord for every call, and we summarize them per endpoint,
+    i.e. per method and path template, such as
+    PUT /api/admin/pipelines/{name}.
+    """
+    # Upper bounds in seconds for the latency histogram.
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def record(self, method, template, status, seconds, sent=0, received=0, retries=0):
+        with self.lock:
+            self.records.append(RequestRecord(method, template, status, seconds, sent, received, retries))
+
+    @classmethod
+    def bucket_label(cls, index):
+        if index < len(cls.buckets):
+            return '< {}s'.format(cls.buckets[index])
+        return '>= {}s'.format(cls.buckets[-1])
+
+    @classmethod
+    def bucket_index(cls, seconds):
+        for index, bound in enumerate(cls.buckets):
+            if seconds < bound:
+                return index
+        return len(cls.buckets)
+
+    @staticmethod
+    def percentile(sorted_values, fraction):
+        return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+    def summary(self):
+        """
+        Totals per endpoint, slowest total time first.
+        """
+        with self.lock:
+            records = list(self.records)
+        by_endpoint = OrderedDict()
+        for record in records:
+            by_endpoint.setdefault((record.method, record.template), []).append(record)
+        endpoints = []
+        for (method, template), endpoint_records in by_endpoint.items():
+            times = sorted(record.seconds for record in endpoint_records)
+            histogram = [0] * (len(self.buckets) + 1)
+            for seconds in times:
+                histogram[self.bucket_index(seconds)] += 1
+            statuses = OrderedDict()
+            for record in endpoint_records:
+                statuses[str(record.status)] = statuses.get(str(record.status), 0) + 1
+            endpoints.append(OrderedDict([
+                ("method", method),
+                ("path", template),
+                ("count", len(endpoint_records)),
+                ("statuses", statuses),
+                ("total_seconds", sum(times)),
+                ("mean_seconds", sum(times) / len(times)),
+                ("p50_seconds", self.percentile(times, 0.5)),
+                ("p95_seconds", self.percentile(times, 0.95)),
+                ("max_seconds", times[-1]),
+                ("bytes_sent", sum(record.sent for record in endpoint_records)),
+                ("bytes_received", sum(record.received for record in endpoint_records)),
+                ("retries", sum(record.retries for record in endpoint_records)),
+                ("histogram", OrderedDict((self.bucket_label(i), count) for i, count in enumerate(histogram))),
+            ]))
+        endpoints.sort(key=lambda endpoint: -endpoint['total_seconds'])
+        return endpoints
+
+    def as_dict(self):
+        endpoints = self.summary()
+        return OrderedDict([
+            ("requests", sum(endpoint['count'] for endpoint in endpoints)),
+            ("total_seconds", sum(endpoint['total_seconds'] for endpoint in endpoints)),
+            ("bytes_sent", sum(endpoint['bytes_sent'] for endpoint in endpoints)),
+            ("bytes_received", sum(endpoint['bytes_received'] for endpoint in endpoints)),
+            ("retries", sum(endpoint['retries'] for endpoint in endpoints)),
+            ("endpoints", endpoints),
+        ])
+
+    def write_json(self, json_file):
+        json.dump(self.as_dict(), json_file, indent=4, separators=(',', ': '))
+        json_file.write('\n')
+
+    def print_report(self, out):
+        totals = self.as_dict()
+        print("Go server requests: {requests}, {total_seconds:.3f}s, "
+              "{bytes_sent} bytes sent, {bytes_received} bytes received, "
+              "{retries} retries".format(**totals), file=out)
+        for endpoint in totals['endpoints']:
+            print(file=out)
+            print("{method} {path}".format(**endpoint), file=out)
+            print("  count: {count}  statuses: {statuses}  retries: {retries}".format(
+                count=endpoint['count'], retries=endpoint['retries'],
+                statuses=", ".join("{}: {}".format(*item) for item in endpoint['statuses'].items())), file=out)
+            print("  time: total {total_seconds:.3f}s  mean {mean_seconds:.3f}s  p50 {p50_seconds:.3f}s  "
+                  "p95 {p95_seconds:.3f}s  max {max_seconds:.3f}s".format(**endpoint), file=out)
+            print("  bytes: sent {bytes_sent}  received {bytes_received}".format(**endpoint), file=out)
+            widest = max(endpoint['histogram'].values())
+            for label, count in endpoint['histogram'].items():
+                if count:
+                    bar = '#' * max(1, int(round(40.0 * count / widest)))
+                    print("  {:>9} {:6} {}".format(label, count, bar), file=out)
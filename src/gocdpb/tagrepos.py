@@ -1,26 +1,47 @@
 # -*- coding: utf-8 -*-
 from __future__ import division, print_function
+from contextlib import contextmanager
 from copy import deepcopy
-from os import path, chdir, getcwd
+from os import path
 from shutil import rmtree
 import collections
 import argparse
 import sys
 import json
 import functools
+import hashlib
+import tempfile
 import subprocess
 import pipes
+import errno
+import os
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from operation_scheduler import bounded_map
 
 
 class Git(object):
-    def __init__(self, verbose=False):
+    """
+    Run git commands in the given repository directory, without
+    changing the working directory of the process. (Several Git
+    objects might be used in parallel threads.)
+    """
+    def __init__(self, directory=None, verbose=False):
+        self.directory = directory
         self.verbose = verbose
 
     def _call_git(self, *args):
+        command = ['git']
+        if self.directory is not None:
+            command += ['-C', self.directory]
+        command += list(args)
         if self.verbose:
-            print("git", " ".join(map(pipes.quote, args)))
+            print(" ".join(map(pipes.quote, command)))
         try:
-            result = subprocess.check_output(['git'] + list(args), stderr=subprocess.STDOUT)
+            result = subprocess.check_output(command, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             # Make sure we always see what the stdout before re-raising the exception.
             # Otherwise it gets lost.
@@ -40,7 +61,6 @@ class GitTagger(object):
         self.directory = directory
         self.repo_name = None
         self.msg = None
-        self.start_dir = None
         self.git = None
         self.verbose = verbose
 
@@ -51,18 +71,27 @@ class GitTagger(object):
             repo_name = path.splitext(repo_name)[0]
         return repo_name
 
+    def clone_path(self, url):
+        return path.join(self.directory, self.get_repo_name(url))
+
+    @contextmanager
+    def locked(self, url):
+        """
+        Held while the repository at url is cloned, tagged and pushed.
+        """
+        yield
+
+    @property
+    def repo_path(self):
+        return path.join(self.directory, self.repo_name)
+
     def clone(self, repo, branch):
-        self.start_dir = getcwd()
-        chdir(self.directory)
-        self.git = Git(verbose=self.verbose)
-        self.git.clone(repo)
         self.repo_name = self.get_repo_name(repo)
-        chdir(self.repo_name)
+        Git(verbose=self.verbose).clone(repo, self.repo_path)
+        self.git = Git(self.repo_path, verbose=self.verbose)
         self.git.checkout(branch)
-        chdir(self.start_dir)
 
     def tag(self, name, revision):
-        chdir(path.join(self.directory, self.repo_name))
         try:
             self.git.tag(name, revision)
         except subprocess.CalledProcessError as e:
@@ -73,28 +102,145 @@ class GitTagger(object):
                 raise
 
         self.msg = 'Tagged {}:{} with {}'.format(self.repo_name, revision, name)
-        chdir(self.start_dir)
 
     def branch(self, name, revision):
-        chdir(path.join(self.directory, self.repo_name))
         self.git.branch(name, revision)
         self.msg = 'Branched {}:{} with {}'.format(self.repo_name, revision, name)
-        chdir(self.start_dir)
 
     def push(self, tag_or_branch):
-        chdir(path.join(self.directory, self.repo_name))
         self.git.push('origin', tag_or_branch)
-        chdir(self.start_dir)
 
     def clean(self):
-        chdir(self.directory)
-        rmtree(self.repo_name)
-        chdir(self.start_dir)
+        rmtree(self.repo_path)
 
 
-def branch_tag_repos(directory, name, structure, branch_set=None, push=False, clean=False, verbose=False, tag=True):
-    if branch_set is None:
-        branch_set = set()
+class MirrorTagger(GitTagger):
+    """
+    Tag and branch in a bare mirror of the repository, which is kept in
+    `directory` between runs. The first run makes a bare clone, and later
+    runs just fetch what's new. There is no working tree to check out.
+
+    Runs using the same `directory` at the same time take turns with each
+    mirror, by locking a file next to it, since a fetch prunes the tags
+    another run has made but not pushed yet. (Not on Windows.)
+    """
+    def __init__(self, directory, verbose=False):
+        super(MirrorTagger, self).__init__(directory, verbose)
+        self.url = None
+
+    def clone_path(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+        return path.join(self.directory, '{}-{}.git'.format(self.get_repo_name(url), digest))
+
+    @property
+    def repo_path(self):
+        return self.clone_path(self.url)
+
+    @contextmanager
+    def locked(self, url):
+        try:
+            os.makedirs(self.directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        with open(self.clone_path(url) + '.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def clone(self, repo, branch):
+        self.url = repo
+        self.repo_name = self.get_repo_name(repo)
+        if path.isdir(self.repo_path):
+            self.git = Git(self.repo_path, verbose=self.verbose)
+            self.git.fetch('--prune', 'origin', '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+        else:
+            Git(verbose=self.verbose).clone('--bare', repo, self.repo_path)
+            self.git = Git(self.repo_path, verbose=self.verbose)
+
+    def clean(self):
+        """
+        The mirror is kept for the next run.
+        """
+
+
+class RemoteTagger(GitTagger):
+    """
+    Tag and branch directly in the remote repository, without any clone.
+
+    One ls-remote per repository tells us which tags and branches exist
+    already, and those are left alone. For the others, we fetch just the
+    revision to tag into a scratch repository in `directory`, and push it
+    to the new ref with an explicit refspec. Nothing happens remotely
+    until push() is called.
+    """
+    def __init__(self, directory, verbose=False):
+        super(RemoteTagger, self).__init__(directory, verbose)
+        self.url = None
+        self.remote_refs = {}
+        self.pending = collections.OrderedDict()
+
+    def clone_path(self, url):
+        """
+        There is no clone, so just keep repos apart by URL.
+        """
+        return url
+
+    def clone(self, repo, branch):
+        self.url = repo
+        self.repo_name = self.get_repo_name(repo)
+        self.git = Git(verbose=self.verbose)
+        output = self.git._call_git('ls-remote', '--tags', '--heads', repo)
+        if not isinstance(output, str):
+            output = output.decode('utf-8')
+        self.remote_refs = {}
+        for line in output.splitlines():
+            if '\t' in line:
+                sha, ref = line.split('\t', 1)
+                self.remote_refs[ref] = sha
+
+    def _add_ref(self, ref, revision):
+        if ref in self.remote_refs:
+            print("{} already exists in {}, continuing".format(ref, self.url))
+            return False
+        self.pending.setdefault(ref.split('/', 2)[2], []).append((ref, revision))
+        return True
+
+    def tag(self, name, revision):
+        if self._add_ref('refs/tags/' + name, revision):
+            self.msg = 'Tagged {}:{} with {}'.format(self.repo_name, revision, name)
+
+    def branch(self, name, revision):
+        if self._add_ref('refs/heads/' + name, revision):
+            self.msg = 'Branched {}:{} with {}'.format(self.repo_name, revision, name)
+
+    def push(self, tag_or_branch):
+        for ref, revision in self.pending.pop(tag_or_branch, []):
+            scratch = tempfile.mkdtemp(prefix=self.repo_name + '-', dir=self.directory)
+            try:
+                Git(verbose=self.verbose).init('-q', '--bare', scratch)
+                git = Git(scratch, verbose=self.verbose)
+                git.fetch('--depth', '1', self.url, revision)
+                sha = git._call_git('rev-parse', 'FETCH_HEAD')
+                if not isinstance(sha, str):
+                    sha = sha.decode('utf-8')
+                git.push(self.url, '{}:{}'.format(sha.strip(), ref))
+            finally:
+                rmtree(scratch)
+
+    def clean(self):
+        """
+        Scratch repositories are removed as soon as they are pushed.
+        """
+
+
+RepoJob = collections.namedtuple('RepoJob', 'url branch revision should_branch')
+
+
+def repo_jobs(structure, branch_set, tag):
+    """
+    What to do with each Git repo in the gocdrepos structure.
+    """
     for repo in structure:
         if repo['type'] != 'Git':
             print("Don't know how to handle material type " + repo['type'])
@@ -111,18 +257,63 @@ def branch_tag_repos(directory, name, structure, branch_set=None, push=False, cl
         url = url_part.split(':', 1)[1].strip()
         branch = branch_part.split(':', 1)[1].strip()
         rev = repo.get('revision') or repo['tag']
-        tagger = GitTagger(directory, verbose)
-        tagger.clone(url, branch)
-        if should_branch:
-            tagger.branch(name, rev)
-        else:
-            tagger.tag(name, rev)
-        if push:
-            tagger.push(name)
+        yield RepoJob(url, branch, rev, should_branch)
+
+
+def make_tagger(directory, mirror_dir=None, verbose=False, remote=False):
+    if remote:
+        return RemoteTagger(directory, verbose)
+    if mirror_dir:
+        return MirrorTagger(mirror_dir, verbose)
+    return GitTagger(directory, verbose)
+
+
+def branch_tag_url(tagger, name, url, url_jobs, push, clean):
+    """
+    Clone (or fetch) url once, and then perform all its jobs.
+    """
+    with tagger.locked(url):
+        tagger.clone(url, url_jobs[0].branch)
+        for job in url_jobs:
+            if job.should_branch:
+                tagger.branch(name, job.revision)
+            else:
+                tagger.tag(name, job.revision)
+            if push:
+                tagger.push(name)
         if clean:
             tagger.clean()
 
 
+def branch_tag_repos(directory, name, structure, branch_set=None, push=False, clean=False, verbose=False, tag=True,
+                     jobs=1, mirror_dir=None, remote=False):
+    """
+    Tag or branch the repos in structure, with up to `jobs` repos
+    handled in parallel. Each URL is only cloned or fetched once, and
+    URLs that share a clone directory are handled one after the other
+    in the same worker.
+    With a mirror_dir, we use persistent mirrors instead of new clones.
+    With remote, we don't clone at all, see RemoteTagger.
+    """
+    if branch_set is None:
+        branch_set = set()
+    by_clone_path = collections.OrderedDict()
+    for job in repo_jobs(structure, branch_set, tag):
+        clone_path = make_tagger(directory, mirror_dir, remote=remote).clone_path(job.url)
+        url_jobs = by_clone_path.setdefault(clone_path, collections.OrderedDict()).setdefault(job.url, [])
+        # The same revision might be listed for several branches.
+        if not any((job.revision, job.should_branch) == (other.revision, other.should_branch)
+                   for other in url_jobs):
+            url_jobs.append(job)
+
+    def run(jobs_by_url):
+        for url, url_jobs in jobs_by_url.items():
+            tagger = make_tagger(directory, mirror_dir, verbose, remote)
+            branch_tag_url(tagger, name, url, url_jobs, push, clean)
+
+    bounded_map(run, by_clone_path.values(), jobs)
+
+
 def check_consistent(structure, label):
     revisions = collections.defaultdict(list)
     pipelines = collections.defaultdict(list)
@@ -256,6 +447,24 @@ def main_branchrepos():
         action='store_true',
         help="Verbose Git output."
     )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help="Number of repositories to handle in parallel."
+    )
+    clone_group = parser.add_mutually_exclusive_group()
+    clone_group.add_argument(
+        '-m', '--mirror-dir',
+        help="Keep bare mirrors of the repositories here between runs, and "
+             "tag/branch in them rather than in new clones in DIRECTORY."
+    )
+    clone_group.add_argument(
+        '-r', '--remote-only',
+        action='store_true',
+        help="Don't clone. Skip tags/branches that exist in the remote repo, "
+             "and push the others after fetching just the revision. Implies --push."
+    )
 
     pargs = parser.parse_args()
     branch_set = branch_set_from_args(pargs)
@@ -263,7 +472,8 @@ def main_branchrepos():
 
     check_consistent(structure, pargs.jsonfile.name)
     branch_tag_repos(
-        pargs.directory, pargs.tag_name, structure, branch_set, pargs.push, pargs.clean, pargs.verbose, tag=False
+        pargs.directory, pargs.tag_name, structure, branch_set, pargs.push or pargs.remote_only, pargs.clean,
+        pargs.verbose, tag=False, jobs=pargs.jobs, mirror_dir=pargs.mirror_dir, remote=pargs.remote_only
     )
 
 
@@ -310,13 +520,33 @@ def main():
         action='store_true',
         help="Verbose Git output."
     )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help="Number of repositories to handle in parallel."
+    )
+    clone_group = parser.add_mutually_exclusive_group()
+    clone_group.add_argument(
+        '-m', '--mirror-dir',
+        help="Keep bare mirrors of the repositories here between runs, and "
+             "tag/branch in them rather than in new clones in DIRECTORY."
+    )
+    clone_group.add_argument(
+        '-r', '--remote-only',
+        action='store_true',
+        help="Don't clone. Skip tags/branches that exist in the remote repo, "
+             "and push the others after fetching just the revision. Implies --push."
+    )
 
     pargs = parser.parse_args()
     branch_set = branch_set_from_args(pargs)
     structure = json.load(pargs.jsonfile)
 
     check_consistent(structure, pargs.jsonfile.name)
-    branch_tag_repos(pargs.directory, pargs.tag_name, structure, branch_set, pargs.push, pargs.clean, pargs.verbose)
+    branch_tag_repos(pargs.directory, pargs.tag_name, structure, branch_set, pargs.push or pargs.remote_only,
+                     pargs.clean, pargs.verbose, jobs=pargs.jobs, mirror_dir=pargs.mirror_dir,
+                     remote=pargs.remote_only)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+The XML library behind CruiseTree.
+
+We use lxml, with its C parser and indentation, if it's installed, and
+xml.etree otherwise. Set $GOCDPB_XML_BACKEND to 'stdlib' or 'lxml' to
+choose. Both backends produce the same bytes from the same config, also
+where lxml would escape characters differently from xml.etree.
+"""
+import os
+import re
+import sys
+import copy
+from xml.etree import ElementTree
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    unichr_ = unichr
+except NameError:
+    unichr_ = chr
+
+
+def indent(elem, level=0):
+    """
+    Fredrik Lundh's standard recipe.
+    (Why isn't this in xml.etree???)
+    :param elem: the XML element
+    :param level: how much indentation
+    """
+    i = "\n" + level * "  "
+    if len(elem):
+        if not elem.text or not elem.text.strip():
+            elem.text = i + "  "
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+        for elem in elem:
+            indent(elem, level + 1)
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+    else:
+        if level and (not elem.tail or not elem.tail.strip()):
+            elem.tail = i
+
+
+def namespaced_below(root, children=None):
+    """
+    True if anything below the root (or in `children`) has a namespaced
+    tag or attribute. Then the namespace declarations don't all end up
+    in the root.
+    """
+    for element in root if children is None else children:
+        for descendant in element.iter():
+            if not callable(descendant.tag) and descendant.tag.startswith('{'):
+                return True
+            if any(key.startswith('{') for key in descendant.attrib):
+                return True
+    return False
+
+
+def indent_top_level(root, children, indent_child):
+    """
+    Indent the root and `children`, some of its top level elements, the
+    way indent() would if they were the only ones.
+    """
+    if not root.text or not root.text.strip():
+        root.text = "\n  "
+    if not root.tail or not root.tail.strip():
+        root.tail = "\n"
+    for child in children:
+        indent_child(child)
+        if not child.tail or not child.tail.strip():
+            child.tail = "\n  "
+
+
+def tail_chunks(children, tostring):
+    """
+    tostring() of each of the top level `children`, but with the last
+    one written as if it was last in the root.
+    """
+    for child in children[:-1]:
+        yield tostring(child)
+    last = children[-1]
+    tail = last.tail
+    if not tail or not tail.strip():
+        last.tail = "\n"
+    try:
+        yield tostring(last)
+    finally:
+        last.tail = tail
+
+
+def stdlib_subset(root, children, to_stdlib):
+    """
+    A new xml.etree root like `root`, with copies of the `children`.
+    """
+    subset = ElementTree.Element(root.tag, dict(root.attrib))
+    subset.text, subset.tail = root.text, root.tail
+    for child in children:
+        subset.append(to_stdlib(child))
+    return subset
+
+
+class StdlibBackend(object):
+    name = 'stdlib'
+
+    @staticmethod
+    def fromstring(text):
+        return ElementTree.fromstring(text)
+
+    @staticmethod
+    def parse(source):
+        return ElementTree.parse(source).getroot()
+
+    @staticmethod
+    def iterparse(stream, events):
+        return ElementTree.iterparse(stream, events=events)
+
+    @staticmethod
+    def tostring(root):
+        indent(root)
+        return ElementTree.tostring(root)
+
+    @classmethod
+    def tostring_chunks(cls, root, children=None):
+        """
+        The same as tostring(), in one chunk per top level element.
+        With `children`, only those top level elements are written.
+        """
+        children = list(root) if children is None else list(children)
+        if not children or namespaced_below(root, children):
+            if len(children) < len(root):
+                root = stdlib_subset(root, children, copy.deepcopy)
+            yield cls.tostring(root)
+            return
+        indent_top_level(root, children, lambda child: indent(child, 1))
+        start = ElementTree.Element(root.tag, root.attrib)
+        start.text = root.text
+        start_tag = ElementTree.tostring(start)
+        end_tag = '</{}>'.format(root.tag)
+        # The tail, if any, is whitespace from indent().
+        end = end_tag + (root.tail or '')
+        if not isinstance(end, type(start_tag)):
+            end = end.encode('ascii')
+        yield start_tag[:-len(end_tag)]
+        for chunk in tail_chunks(children, ElementTree.tostring):
+            yield chunk
+        yield end
+
+
+class LxmlBackend(object):
+    """
+    lxml, made to serialize like xml.etree: Comments and processing
+    instructions are dropped when parsing, empty elements are written as
+    <x /> rather than <x/>, before Python 3.8, attributes are sorted, and
+    characters are escaped the way this Python's xml.etree does it.
+
+    Configs without top level elements, or with namespaced elements or
+    attributes below the root, are serialized by StdlibBackend.
+    """
+    name = 'lxml'
+    sorts_attributes = sys.version_info < (3, 8)
+
+    # The character references where xml.etree may differ: Tab and CR,
+    # which it writes raw or as &#09; and &#13; depending on version and
+    # context, and hexadecimal ones, which lxml writes for some
+    # characters outside the BMP. (xml.etree always writes decimal.)
+    odd_reference = re.compile(br'&#(?:9|13|x[0-9a-fA-F]+);')
+    # A tag, where the references are in attribute values, or a reference
+    # in text. lxml escapes '>' in attribute values.
+    tag_or_odd_reference = re.compile(br'<[^>]*>|&#(?:9|13|x[0-9a-fA-F]+);')
+    # (reference, in an attribute value) -> what xml.etree writes.
+    _etree_references = {}
+
+    @staticmethod
+    def parser():
+        return lxml_etree.XMLParser(remove_comments=True, remove_pis=True)
+
+    @classmethod
+    def fromstring(cls, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        return lxml_etree.fromstring(text, cls.parser())
+
+    @classmethod
+    def parse(cls, source):
+        return lxml_etree.parse(source, cls.parser()).getroot()
+
+    @staticmethod
+    def iterparse(stream, events):
+        return lxml_etree.iterparse(stream, events=events, remove_comments=True, remove_pis=True)
+
+    @classmethod
+    def like_etree(cls, xml):
+        # '>' is always escaped in text and attribute values by lxml.
+        xml = xml.replace(b'/>', b' />')
+        if cls.odd_reference.search(xml) is None:
+            return xml
+        return cls.tag_or_odd_reference.sub(cls.escape_like_etree, xml)
+
+    @classmethod
+    def escape_like_etree(cls, match):
+        text = match.group(0)
+        if text.startswith(b'<'):
+            return cls.odd_reference.sub(lambda ref: cls.etree_reference(ref.group(0), True), text)
+        return cls.etree_reference(text, False)
+
+    @classmethod
+    def etree_reference(cls, reference, in_attribute):
+        """
+        What xml.etree writes for the character of a reference, in an
+        attribute value or in text.
+        """
+        key = (reference, in_attribute)
+        if key not in cls._etree_references:
+            code = reference[2:-1].decode('ascii')
+            char = unichr_(int(code[1:], 16) if code.startswith('x') else int(code))
+            element = ElementTree.Element('x')
+            if in_attribute:
+                element.set('a', char)
+                escaped = ElementTree.tostring(element)[len(b'<x a="'):-len(b'" />')]
+            else:
+                element.text = char
+                escaped = ElementTree.tostring(element)[len(b'<x>'):-len(b'</x>')]
+            cls._etree_references[key] = escaped
+        return cls._etree_references[key]
+
+    @classmethod
+    def prepare(cls, root):
+        """
+        Indent the same way as indent(), and sort attributes if
+        xml.etree would.
+        """
+        lxml_etree.indent(root, space='  ')
+        if len(root) and not (root.tail or '').strip():
+            root.tail = '\n'
+        if cls.sorts_attributes:
+            cls.sort_attributes(root)
+
+    @classmethod
+    def prepare_child(cls, child):
+        lxml_etree.indent(child, space='  ', level=1)
+        if cls.sorts_attributes:
+            cls.sort_attributes(child)
+
+    @staticmethod
+    def sort_attributes(element, xpath='descendant-or-self::*[count(@*) > 1]'):
+        for element in element.xpath(xpath):
+            items = sorted(element.attrib.items())
+            element.attrib.clear()
+            for key, value in items:
+                element.set(key, value)
+
+    @staticmethod
+    def to_stdlib(element):
+        stdlib_element = ElementTree.fromstring(lxml_etree.tostring(element, with_tail=False))
+        stdlib_element.tail = element.tail
+        return stdlib_element
+
+    @staticmethod
+    def declaration(prefix, uri):
+        """
+        ' xmlns:prefix="uri"', as lxml writes it.
+        """
+        empty = lxml_etree.tostring(lxml_etree.Element('x', nsmap={prefix: uri}))
+        return empty[len(b'<x'):-len(b'/>')]
+
+    @classmethod
+    def tostring(cls, root):
+        # Leave the odd cases to xml.etree: Childless roots keep the text
+        # of any earlier indentation, and namespaces are declared where used.
+        if not len(root) or namespaced_below(root):
+            indent(root)
+            return ElementTree.tostring(cls.to_stdlib(root))
+        cls.prepare(root)
+        return cls.like_etree(lxml_etree.tostring(root))
+
+    @classmethod
+    def tostring_chunks(cls, root, children=None):
+        """
+        The same as tostring(), in one chunk per top level element.
+        With `children`, only those top level elements are written.
+        """
+        children = list(root) if children is None else list(children)
+        if not children or namespaced_below(root, children):
+            if len(children) < len(root):
+                yield StdlibBackend.tostring(stdlib_subset(root, children, cls.to_stdlib))
+            else:
+                yield cls.tostring(root)
+            return
+        if len(children) < len(root):
+            indent_top_level(root, children, cls.prepare_child)
+            if cls.sorts_attributes:
+                cls.sort_attributes(root, 'self::*')
+        else:
+            cls.prepare(root)
+        start = lxml_etree.Element(root.tag, nsmap=root.nsmap)
+        for key, value in root.items():
+            start.set(key, value)
+        start.text = root.text
+        start_tag = cls.like_etree(lxml_etree.tostring(start))
+        end_tag = '</{}>'.format(root.tag).encode('ascii')
+        yield start_tag[:-len(end_tag)]
+        # lxml declares the namespaces of the root again in each child.
+        declarations = [cls.declaration(prefix, uri) for prefix, uri in root.nsmap.items()]
+        for chunk in tail_chunks(children, lxml_etree.tostring):
+            head_end = chunk.index(b'>')
+            head = chunk[:head_end]
+            for declaration in declarations:
+                head = head.replace(declaration, b'', 1)
+            yield cls.like_etree(head + chunk[head_end:])
+        yield end_tag + (root.tail or '').encode('ascii')
+
+
+def default_backend():
+    name = os.environ.get('GOCDPB_XML_BACKEND')
+    if name == 'stdlib':
+        return StdlibBackend
+    if lxml_etree is None or not hasattr(lxml_etree, 'indent'):
+        if name == 'lxml':
+            raise ImportError("GOCDPB_XML_BACKEND=lxml, but lxml (4.5 or later) isn't installed.")
+        return StdlibBackend
+    return LxmlBackend
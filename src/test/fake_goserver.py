@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process stand-in for a GoCD server, for tests and benchmarks.
+
+It implements the parts of the GoCD REST API that goserver_adapter.Goserver
+uses, on top of an in-memory model which can be seeded with a synthetic
+topology of pipelines and repositories. Latency can be injected to mimic
+a remote server.
+
+It's not part of the installed package. Run it stand-alone from the root
+of the repo with e.g.:
+
+    PYTHONPATH=src python -m test.fake_goserver --pipelines 1000 --repos 100 --latency 0.05
+"""
+from __future__ import print_function
+import re
+import sys
+import json
+import time
+import socket
+import random
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from xml.etree import ElementTree
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+
+
+def _sha(*parts):
+    return hashlib.sha1(u'/'.join(u'{}'.format(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class SyntheticTopology(object):
+    """
+    A generated GoCD setup: `pipelines` pipelines spread over `groups`
+    pipeline groups, each built from one of `repos` git repositories and
+    depending on up to `fan_in` earlier pipelines, so that they form a
+    DAG. Each pipeline has `instances` built instances.
+    """
+    def __init__(self, pipelines=10, repos=5, groups=None, fan_in=2, instances=1,
+                 environments=2, templates=2, seed=0):
+        self.pipeline_count = pipelines
+        self.repo_count = repos
+        self.group_count = groups or max(1, pipelines // 20)
+        self.fan_in = fan_in
+        self.instance_count = instances
+        self.environment_count = environments
+        self.template_count = templates
+        self.random = random.Random(seed)
+
+    @staticmethod
+    def pipeline_name(index):
+        return 'pipeline{:05d}'.format(index)
+
+    @staticmethod
+    def repo_url(index):
+        return 'https://git.example.com/repo{:04d}.git'.format(index)
+
+    def group_name(self, index):
+        return 'group{:03d}'.format(index % self.group_count)
+
+    def upstreams(self, index):
+        """
+        Indexes of the pipelines that pipeline `index` depends on.
+        Always a few of the closest preceding ones, which makes the graph
+        both deep and diamond shaped.
+        """
+        candidates = list(range(max(0, index - 2 * self.fan_in), index))
+        self.random.shuffle(candidates)
+        return sorted(candidates[:self.fan_in])
+
+    def build(self, state):
+        upstreams = {}
+        for index in range(self.pipeline_count):
+            name = self.pipeline_name(index)
+            upstreams[index] = self.upstreams(index)
+            materials = [git_material(self.repo_url(index % self.repo_count))]
+            materials += [dependency_material(self.pipeline_name(upstream))
+                          for upstream in upstreams[index]]
+            state.add_pipeline(self.group_name(index), pipeline_config(name, materials), paused=False)
+        for index in range(self.template_count):
+            state.add_template('template{:02d}'.format(index))
+        for index in range(self.environment_count):
+            members = [self.pipeline_name(i) for i in range(index, self.pipeline_count, 10)]
+            state.add_environment('env{:02d}'.format(index), members)
+        for index in range(self.pipeline_count):
+            for counter in range(1, self.instance_count + 1):
+                revisions = [git_revision(self.repo_url(index % self.repo_count),
+                                          _sha(index, counter))]
+                revisions += [pipeline_revision(self.pipeline_name(upstream), counter)
+                              for upstream in upstreams[index]]
+                state.add_instance(self.pipeline_name(index), counter, revisions)
+        return state
+
+
+def git_material(url):
+    return OrderedDict([
+        ("type", "git"),
+        ("attributes", OrderedDict([("url", url), ("branch", "master"), ("auto_update", True)])),
+    ])
+
+
+def dependency_material(pipeline):
+    return OrderedDict([
+        ("type", "dependency"),
+        ("attributes", OrderedDict([("pipeline", pipeline), ("stage", "defaultStage"), ("auto_update", True)])),
+    ])
+
+
+def pipeline_config(name, materials):
+    return OrderedDict([
+        ("name", name),
+        ("label_template", "${COUNT}"),
+        ("template", None),
+        ("materials", materials),
+        ("stages", [OrderedDict([
+            ("name", "defaultStage"),
+            ("jobs", [OrderedDict([
+                ("name", "defaultJob"),
+                ("tasks", [OrderedDict([
+                    ("type", "exec"),
+                    ("attributes", OrderedDict([("command", "make"), ("run_if", ["passed"])])),
+                ])]),
+            ])]),
+        ])]),
+    ])
+
+
+def git_revision(url, revision):
+    return {
+        "material": {"description": "URL: {}, Branch: master".format(url), "type": "Git"},
+        "modifications": [{"modified_time": 1455889817000, "revision": revision}],
+    }
+
+
+def pipeline_revision(pipeline, counter):
+    return {
+        "material": {"description": pipeline, "type": "Pipeline"},
+        "modifications": [{"modified_time": 1455889817000,
+                           "revision": "{}/{}/defaultStage/1".format(pipeline, counter)}],
+    }
+
+
+class FakeGoState(object):
+    """
+    What the fake server knows: the cruise-config XML, the pipeline
+    configs served by the pipeline admin API with their etags, paused
+    pipelines and built pipeline instances.
+    """
+    section_order = ['server', 'repositories', 'config-repos', 'pipelines',
+                     'templates', 'environments', 'agents']
+
+    def __init__(self, xml=None):
+        self.lock = threading.RLock()
+        self.root = ElementTree.fromstring(xml or (
+            '<cruise schemaVersion="88"><server /><agents /></cruise>'))
+        self.pipelines = {}
+        self.etags = {}
+        self.paused = set()
+        self.instances = {}
+        self.requests = []
+        self._md5 = None
+
+    @property
+    def xml(self):
+        return ElementTree.tostring(self.root).decode('utf-8')
+
+    @property
+    def md5(self):
+        if self._md5 is None:
+            self._md5 = hashlib.md5(self.xml.encode('utf-8')).hexdigest()
+        return self._md5
+
+    def changed(self):
+        self._md5 = None
+
+    def insert_in_order(self, element):
+        """
+        Put a new top level element where the cruise-config schema wants it.
+        """
+        rank = self.section_order.index(element.tag)
+        index = 0
+        for i, child in enumerate(self.root):
+            if child.tag in self.section_order and self.section_order.index(child.tag) <= rank:
+                index = i + 1
+        self.root.insert(index, element)
+
+    def group_element(self, group_name, create=False):
+        for element in self.root.findall('pipelines'):
+            if element.get('group') == group_name:
+                return element
+        if create:
+            element = ElementTree.Element('pipelines', group=group_name)
+            self.insert_in_order(element)
+            return element
+
+    def pipeline_element(self, name):
+        for group in self.root.findall('pipelines'):
+            for element in group.findall('pipeline'):
+                if element.get('name') == name:
+                    return group, element
+        return None, None
+
+    def add_pipeline(self, group_name, config, paused=True):
+        with self.lock:
+            group = self.group_element(group_name, create=True)
+            element = ElementTree.SubElement(group, 'pipeline', name=config['name'])
+            materials = ElementTree.SubElement(element, 'materials')
+            for material in config.get('materials') or []:
+                attributes = material['attributes']
+                if material['type'] == 'git':
+                    ElementTree.SubElement(materials, 'git', url=attributes['url'])
+                elif material['type'] == 'dependency':
+                    ElementTree.SubElement(materials, 'pipeline', pipelineName=attributes['pipeline'],
+                                           stageName=attributes.get('stage') or 'defaultStage')
+            for stage in config.get('stages') or []:
+                stage_element = ElementTree.SubElement(element, 'stage', name=stage['name'])
+                jobs = ElementTree.SubElement(stage_element, 'jobs')
+                for job in stage.get('jobs') or []:
+                    tasks = ElementTree.SubElement(ElementTree.SubElement(jobs, 'job', name=job['name']), 'tasks')
+                    for task in job.get('tasks') or []:
+                        if task['type'] == 'exec':
+                            ElementTree.SubElement(tasks, 'exec', command=task['attributes']['command'])
+            self.pipelines[config['name']] = config
+            self.etags[config['name']] = 1
+            if paused:
+                self.paused.add(config['name'])
+            self.changed()
+
+    def add_template(self, name):
+        with self.lock:
+            templates = self.root.find('templates')
+            if templates is None:
+                templates = ElementTree.Element('templates')
+                self.insert_in_order(templates)
+            template = ElementTree.SubElement(templates, 'pipeline', name=name)
+            ElementTree.SubElement(template, 'stage', name='defaultStage')
+            self.changed()
+
+    def environment_element(self, name):
+        environments = self.root.find('environments')
+        if environments is not None:
+            for element in environments.findall('environment'):
+                if element.get('name') == name:
+                    return element
+
+    def add_environment(self, name, pipelines=()):
+        with self.lock:
+            environments = self.root.find('environments')
+            if environments is None:
+                environments = ElementTree.Element('environments')
+                self.insert_in_order(environments)
+            environment = ElementTree.SubElement(environments, 'environment', name=name)
+            self.patch_environment(environment, add=pipelines)
+
+    def environment_pipelines(self, name):
+        environment = self.environment_element(name)
+        if environment is None:
+            return None
+        return [element.get('name') for element in environment.findall('pipelines/pipeline')]
+
+    def patch_environment(self, environment, add=(), remove=()):
+        members = environment.find('pipelines')
+        if members is None:
+            members = ElementTree.SubElement(environment, 'pipelines')
+        existing = set(element.get('name') for element in members)
+        for name in add:
+            if name not in existing:
+                ElementTree.SubElement(members, 'pipeline', name=name)
+                existing.add(name)
+        for element in list(members):
+            if element.get('name') in remove:
+                members.remove(element)
+        self.changed()
+
+    def add_instance(self, pipeline, counter, material_revisions):
+        self.instances[(pipeline, str(counter))] = OrderedDict([
+            ("name", pipeline),
+            ("counter", int(counter)),
+            ("label", str(counter)),
+            ("build_cause", {"material_revisions": material_revisions}),
+        ])
+
+    def pipeline_json(self, name):
+        """
+        Pipeline config as served by the pipeline admin API. Pipelines
+        that only exist in an uploaded XML get a minimal config.
+        """
+        if name not in self.pipelines:
+            _group, element = self.pipeline_element(name)
+            if element is None:
+                return None
+            materials = [git_material(git.get('url')) for git in element.findall('materials/git')]
+            materials += [dependency_material(dep.get('pipelineName'))
+                          for dep in element.findall('materials/pipeline')]
+            self.pipelines[name] = pipeline_config(name, materials)
+            self.etags[name] = 1
+        return self.pipelines[name]
+
+    def pipeline_groups(self):
+        groups = []
+        for group in self.root.findall('pipelines'):
+            groups.append(OrderedDict([
+                ("name", group.get('group')),
+                ("pipelines", [OrderedDict([("name", element.get('name')), ("label", "${COUNT}"),
+                                            ("materials", []), ("stages", [])])
+                               for element in group.findall('pipeline')]),
+            ]))
+        return groups
+
+
+class FakeGoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config_xml_path = re.compile(r'^/go/admin/restful/configuration/file/(GET|POST)/xml$')
+    pipeline_admin_path = re.compile(r'^/go/api/admin/pipelines/([^/]+)$')
+    environment_path = re.compile(r'^/go/api/admin/environments/([^/]+)$')
+    unpause_path = re.compile(r'^/go/api/pipelines/([^/]+)/unpause$')
+    status_path = re.compile(r'^/go/api/pipelines/([^/]+)/status$')
+    instance_path = re.compile(r'^/go/api/pipelines/([^/]+)/instance/([^/]+)$')
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and body are separate writes. Don't let Nagle hold back
+        # the body until the client's delayed ACK.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                chunk = self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks).decode('utf-8')
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8')
+
+    def respond(self, status, body=u'', headers=None):
+        if not isinstance(body, (type(u''), bytes)):
+            body = json.dumps(body)
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def handle_any(self):
+        self.server.request_started()
+        try:
+            self.server.delay()
+            body = self.read_body()
+            with self.state.lock:
+                self.state.requests.append((self.command, self.path))
+                self.route(body)
+        finally:
+            self.server.request_finished()
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_any
+
+    def route(self, body):
+        path = self.path.split('?')[0]
+        method = self.command
+        match = self.config_xml_path.match(path)
+        if match and method == 'GET':
+            return self.get_config_xml()
+        if match and method == 'POST':
+            return self.post_config_xml(body)
+        if path == '/go/api/admin/pipelines' and method == 'POST':
+            return self.create_pipeline(body)
+        match = self.pipeline_admin_path.match(path)
+        if match:
+            return self.pipeline_admin(method, match.group(1), body)
+        match = self.environment_path.match(path)
+        if match and method == 'GET':
+            return self.get_environment(match.group(1))
+        if match and method == 'PATCH':
+            return self.patch_environment(match.group(1), body)
+        match = self.unpause_path.match(path)
+        if match and method == 'POST':
+            return self.unpause(match.group(1))
+        match = self.status_path.match(path)
+        if match and method == 'GET':
+            return self.status(match.group(1))
+        if path == '/go/api/config/pipeline_groups' and method == 'GET':
+            return self.respond(200, self.state.pipeline_groups())
+        match = self.instance_path.match(path)
+        if match and method == 'GET':
+            instance = self.state.instances.get(match.groups())
+            if instance is None:
+                return self.respond(404, {"message": "Not found."})
+            return self.respond(200, instance)
+        self.respond(404, {"message": "No such endpoint: {} {}".format(method, path)})
+
+    def get_config_xml(self):
+        md5 = self.state.md5
+        if self.headers.get('If-None-Match', '').strip('"') == md5:
+            return self.respond(304, headers={'x-cruise-config-md5': md5})
+        self.respond(200, self.state.xml, {'x-cruise-config-md5': md5, 'Content-Type': 'text/xml'})
+
+    def post_config_xml(self, body):
+        form = parse_qs(body, keep_blank_values=True)
+        if form.get('md5', [''])[0] != self.state.md5:
+            return self.respond(409, {"result": "Someone else has modified the configuration.",
+                                      "originalContent": ""})
+        self.state.root = ElementTree.fromstring(form['xmlFile'][0].encode('utf-8'))
+        self.state.changed()
+        self.respond(200, {"result": "File changed successfully."})
+
+    def create_pipeline(self, body):
+        data = json.loads(body, object_pairs_hook=OrderedDict)
+        name = data['pipeline']['name']
+        if self.state.pipeline_json(name) is not None:
+            return self.respond(422, {"message": "Failed to add pipeline. The pipeline '{}' already exists.".format(
+                name)})
+        self.state.add_pipeline(data['group'], data['pipeline'])
+        self.respond(200, data['pipeline'], {'ETag': '"1"'})
+
+    def pipeline_admin(self, method, name, body):
+        config = self.state.pipeline_json(name)
+        if config is None:
+            return self.respond(404, {"message": "Not found."})
+        etag = '"{}"'.format(self.state.etags[name])
+        if method == 'GET':
+            return self.respond(200, config, {'ETag': etag})
+        if method == 'PUT':
+            if self.headers.get('If-Match') != etag:
+                return self.respond(412, {"message": "Someone has modified the configuration for pipeline '{}'."
+                                          .format(name)})
+            self.state.pipelines[name] = json.loads(body, object_pairs_hook=OrderedDict)
+            self.state.etags[name] += 1
+            return self.respond(200, self.state.pipelines[name], {'ETag': '"{}"'.format(self.state.etags[name])})
+        if method == 'DELETE':
+            group, element = self.state.pipeline_element(name)
+            if element is not None:
+                group.remove(element)
+            del self.state.pipelines[name]
+            self.state.changed()
+            return self.respond(200, {"message": "Pipeline '{}' was deleted successfully.".format(name)})
+        self.respond(405, {"message": "Method not allowed."})
+
+    def get_environment(self, name):
+        if self.state.environment_element(name) is None:
+            return self.respond(404, {"message": "Not found."})
+        self.respond(200, {"name": name, "pipelines": [{"name": pipeline}
+                                                       for pipeline in self.state.environment_pipelines(name)]})
+
+    def patch_environment(self, name, body):
+        environment = self.state.environment_element(name)
+        if environment is None:
+            return self.respond(404, {"message": "Not found."})
+        data = json.loads(body)
+        pipelines = data.get('pipelines', {})
+        self.state.patch_environment(environment, pipelines.get('add', ()), pipelines.get('remove', ()))
+        self.get_environment(name)
+
+    def unpause(self, name):
+        if self.state.pipeline_json(name) is None:
+            return self.respond(404, {"message": "Not found."})
+        if name not in self.state.paused:
+            return self.respond(409, {"message": "Failed to unpause pipeline '{}'. "
+                                                 "Pipeline '{}' is already unpaused.".format(name, name)})
+        self.state.paused.discard(name)
+        self.respond(200, {"message": "Pipeline '{}' unpaused successfully.".format(name)})
+
+    def status(self, name):
+        if self.state.pipeline_json(name) is None:
+            return self.respond(404, {"message": "Not found."})
+        self.respond(200, OrderedDict([("paused", name in self.state.paused), ("schedulable", True),
+                                       ("locked", False)]))
+
+
+class FakeGoServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a FakeGoState on localhost, in a background thread.
+
+        with FakeGoServer(state, latency=0.05) as server:
+            go = Goserver(None, False, {'url': server.url})
+    """
+    daemon_threads = True
+
+    def __init__(self, state=None, latency=0.0, jitter=0.0, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeGoHandler)
+        self.state = state if state is not None else FakeGoState()
+        self.latency = latency
+        self.jitter = jitter
+        self.thread = None
+        # Requests being handled now, and the most at any one time.
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/go'.format(self.server_address[1])
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def request_started(self):
+        with self.in_flight_lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def request_finished(self):
+        with self.in_flight_lock:
+            self.in_flight -= 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(args=sys.argv):
+    argparser = argparse.ArgumentParser(description="Run a fake Go CD server with synthetic content.")
+    argparser.add_argument("--pipelines", type=int, default=100, help="Number of pipelines.")
+    argparser.add_argument("--repos", type=int, default=20, help="Number of git repositories.")
+    argparser.add_argument("--fan-in", type=int, default=2, help="Upstream pipelines per pipeline.")
+    argparser.add_argument("--latency", type=float, default=0.0, help="Seconds of delay per request.")
+    argparser.add_argument("--port", type=int, default=8153, help="Port to listen on.")
+    pargs = argparser.parse_args(args[1:])
+    topology = SyntheticTopology(pargs.pipelines, pargs.repos, fan_in=pargs.fan_in)
+    server = FakeGoServer(topology.build(FakeGoState()), pargs.latency, port=pargs.port)
+    print("Serving fake Go CD server at {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
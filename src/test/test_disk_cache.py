@@ -0,0 +1,170 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from jinja2 import Environment
+
+from gocdpb.disk_cache import ConfigXmlCache, InstanceCache, TemplateCache
+from gocdpb.gocd_settings import JsonSettings
+
+
+class InstanceCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_what_was_put(self):
+        cache = InstanceCache(self.cache_dir, 'http://go/go')
+        self.assertIsNone(cache.get('p', '1'))
+        cache.put('p', '1', u'{"name": "p", "counter": 1}')
+        self.assertEqual({'name': 'p', 'counter': 1}, cache.get('p', '1'))
+        self.assertIsNone(cache.get('p', '2'))
+
+    def test_keyed_by_server(self):
+        InstanceCache(self.cache_dir, 'http://go/go').put('p', '1', u'{}')
+        self.assertIsNone(InstanceCache(self.cache_dir, 'http://other/go').get('p', '1'))
+
+    def test_least_recently_used_is_evicted(self):
+        text = u'{"data": "%s"}' % ('x' * 100)
+        cache = InstanceCache(self.cache_dir, 'http://go/go', max_bytes=len(text) * 3)
+        cache.put('p', '1', text)
+        cache.put('p', '2', text)
+        # Make p/1 recently used, and p/2 old.
+        os.utime(cache.path('p', '1'), (2000000000, 2000000000))
+        os.utime(cache.path('p', '2'), (1000000000, 1000000000))
+        cache.put('p', '3', text)
+        os.utime(cache.path('p', '3'), (1500000000, 1500000000))
+        # Over max_bytes, so down to 90% of it.
+        cache.put('p', '4', text)
+        self.assertIsNotNone(cache.get('p', '1'))
+        self.assertIsNone(cache.get('p', '2'))
+        self.assertIsNone(cache.get('p', '3'))
+        self.assertIsNotNone(cache.get('p', '4'))
+
+    def test_directory_is_only_listed_when_full(self):
+        text = u'{"data": "%s"}' % ('x' * 100)
+        cache = InstanceCache(self.cache_dir, 'http://go/go', max_bytes=len(text) * 3)
+        evictions = []
+        evict = cache.evict
+
+        def counted_evict():
+            evictions.append(len(os.listdir(cache.directory)))
+            return evict()
+        cache.evict = counted_evict
+        for counter in range(5):
+            cache.put('p', str(counter), text)
+        # On the first put, and when the fourth took it over max_bytes.
+        self.assertEqual([1, 4], evictions)
+
+    def test_clear(self):
+        cache = InstanceCache(self.cache_dir, 'http://go/go')
+        cache.put('p', '1', u'{}')
+        cache.clear()
+        self.assertIsNone(cache.get('p', '1'))
+
+
+class TemplateCacheTests(unittest.TestCase):
+    template = u'[{"name": "{{ repo_name }}"{% if group %}, "group": "{{ group }}"{% endif %}}]'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.compile = Environment.compile
+
+    def tearDown(self):
+        Environment.compile = self.compile
+        shutil.rmtree(self.cache_dir)
+
+    def cached_files(self, cache):
+        return os.listdir(cache.directory) if os.path.isdir(cache.directory) else []
+
+    def test_warm_compile_loads_bytecode(self):
+        parameters = {'repo_name': 'r', 'group': 'g'}
+        expected = JsonSettings.compile_template(self.template).render(parameters)
+        cache = TemplateCache(self.cache_dir)
+        self.assertEqual(expected, JsonSettings.compile_template(self.template, cache).render(parameters))
+        self.assertEqual(1, len(self.cached_files(cache)))
+
+        def fail(*args, **kwargs):
+            raise AssertionError("Compiled again")
+        Environment.compile = fail
+        warm = JsonSettings.compile_template(self.template, TemplateCache(self.cache_dir))
+        self.assertEqual(expected, warm.render(parameters))
+
+    def test_keyed_by_content(self):
+        cache = TemplateCache(self.cache_dir)
+        JsonSettings.compile_template(self.template, cache)
+        JsonSettings.compile_template(self.template + u' ', cache)
+        JsonSettings.compile_template(self.template, cache)
+        self.assertEqual(2, len(self.cached_files(cache)))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TemplateCache(self.cache_dir)
+        paths = {}
+        for name in 'ab':
+            JsonSettings.compile_template(u'{{ %s }}' % name, cache)
+            paths[name], = [os.path.join(cache.directory, file_name) for file_name in self.cached_files(cache)
+                            if os.path.join(cache.directory, file_name) not in paths.values()]
+        # Make a recently used, and b old.
+        os.utime(paths['a'], (2000000000, 2000000000))
+        os.utime(paths['b'], (1000000000, 1000000000))
+        cache = TemplateCache(self.cache_dir, max_bytes=2 * os.path.getsize(paths['a']))
+        JsonSettings.compile_template(u'{{ c }}', cache)
+        self.assertTrue(os.path.exists(paths['a']))
+        self.assertFalse(os.path.exists(paths['b']))
+        self.assertEqual(2, len(self.cached_files(cache)))
+
+    def test_clear(self):
+        cache = TemplateCache(self.cache_dir)
+        JsonSettings.compile_template(self.template, cache)
+        cache.clear()
+        self.assertEqual([], self.cached_files(cache))
+
+
+@unittest.skipUnless(os.name == 'posix', "File modes are POSIX")
+class CachePermissionsTests(unittest.TestCase):
+    """
+    The caches hold copies of the admin-only config, so they must not be
+    readable by other users, whatever the umask.
+    """
+    def setUp(self):
+        self.cache_dir = os.path.join(tempfile.mkdtemp(), 'gocdpb')
+        self.umask = os.umask(0o022)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        shutil.rmtree(os.path.dirname(self.cache_dir))
+
+    def assertMode(self, mode, path):
+        self.assertEqual(oct(mode), oct(stat.S_IMODE(os.stat(path).st_mode)))
+
+    def test_config_cache(self):
+        cache = ConfigXmlCache(self.cache_dir, 'http://go/go')
+        self.assertEqual([b'<cruise/>'], list(cache.store_chunks('abc', [b'<cruise/>'])))
+        self.assertMode(0o700, self.cache_dir)
+        self.assertMode(0o700, cache.directory)
+        self.assertMode(0o600, cache.xml_path)
+        self.assertMode(0o600, cache.md5_path)
+
+    def test_instance_cache(self):
+        cache = InstanceCache(self.cache_dir, 'http://go/go')
+        cache.put('p', '1', u'{}')
+        self.assertMode(0o700, cache.directory)
+        self.assertMode(0o600, cache.path('p', '1'))
+
+    def test_template_cache(self):
+        cache = TemplateCache(self.cache_dir)
+        JsonSettings.compile_template(u'{{ x }}', cache)
+        self.assertMode(0o700, cache.directory)
+        for file_name in os.listdir(cache.directory):
+            self.assertMode(0o600, os.path.join(cache.directory, file_name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,300 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import json
+import shutil
+import tempfile
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from test.fake_goserver import (FakeGoServer, FakeGoState, SyntheticTopology, pipeline_config, git_material,
+                                dependency_material)
+from gocdpb.goserver_adapter import Goserver, ConflictError
+from gocdpb.gocd_settings import Pipeline, JsonSettings, BulkSettings
+
+
+class FakeGoServerTests(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        Goserver._parsed_configs.clear()
+        self.state = SyntheticTopology(pipelines=30, repos=4, fan_in=2).build(FakeGoState())
+        self.server = FakeGoServer(self.state).start()
+        self.go = self.goserver()
+
+    def goserver(self, **config):
+        config.update({'url': self.server.url, 'cache_dir': self.cache_dir, 'instance_cache': False,
+                       'conflict_backoff': 0.01})
+        return Goserver(None, False, config)
+
+    def tearDown(self):
+        self.go.close()
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+        Goserver._parsed_configs.clear()
+
+    def test_config_round_trip(self):
+        self.go.fetch_config()
+        self.assertEqual(30, len(self.go.tree.findall('pipelines/pipeline')))
+        self.go.tree.rename_pipeline_group('group000', 'renamed')
+        self.go.upload_config()
+        self.assertIsNotNone(self.state.group_element('renamed'))
+
+    def test_unchanged_config_is_not_sent_again(self):
+        self.go.fetch_config()
+        self.go.fetch_config()
+        self.assertEqual(self.state.md5, self.go._cruise_config_md5)
+        self.assertIsNotNone(self.go.config_cache.md5)
+
+    def test_config_edits_are_uploaded_together(self):
+        edits = [('rename-pipeline-group', ['group000', 'renamed']),
+                 ('move-pipeline', ['pipeline00000', 'moved']),
+                 ('move-all-pipelines-in-group', ['renamed', 'again'])]
+        del self.state.requests[:]
+        self.go.edit_config(edits)
+        self.assertEqual(['GET', 'POST'], [method for method, path in self.state.requests])
+        self.assertIsNone(self.state.group_element('group000'))
+        self.assertEqual(29, len(self.state.group_element('again').findall('pipeline')))
+        self.assertEqual(['pipeline00000'],
+                         [p.get('name') for p in self.state.group_element('moved').findall('pipeline')])
+
+    def test_failed_config_edit_uploads_nothing(self):
+        md5 = self.state.md5
+        edits = [('rename-pipeline-group', ['group000', 'renamed']), ('drop-pipeline-group', ['nonesuch'])]
+        self.assertRaises(ValueError, self.go.edit_config, edits)
+        self.assertEqual(md5, self.state.md5)
+        self.go.fetch_config()
+        self.assertIsNotNone(self.go.tree.find_pipeline_group('group000'))
+
+    def test_upload_of_stale_config_is_rejected(self):
+        self.go = self.goserver(conflict_retries=0)
+        self.go.fetch_config()
+        self.state.add_pipeline('group000', pipeline_config('sneaky', []))
+        self.go.tree.rename_pipeline_group('group000', 'renamed')
+        self.assertRaises(ConflictError, self.go.upload_config)
+
+    def test_edits_are_made_again_to_changed_config(self):
+        self.go.fetch_config()
+        self.go.tree.edit('rename-pipeline-group', 'group000', 'renamed')
+        self.go.tree.move_pipeline('pipeline00001', 'moved')
+        self.state.add_pipeline('group000', pipeline_config('sneaky', []))
+        del self.state.requests[:]
+        self.go.upload_config()
+        self.assertEqual(['POST', 'GET', 'POST'], [method for method, path in self.state.requests])
+        self.assertIn('sneaky', [p.get('name') for p in self.state.group_element('renamed')])
+        self.assertIsNotNone(self.state.group_element('moved'))
+        self.assertEqual([1], [endpoint['retries'] for endpoint in self.go.stats.summary()
+                               if endpoint['method'] == 'POST'])
+
+    def test_edits_which_no_longer_apply_are_not_retried(self):
+        self.go.fetch_config()
+        self.go.tree.edit('move-pipeline', 'pipeline00001', 'moved')
+        group, pipeline = self.state.pipeline_element('pipeline00001')
+        group.remove(pipeline)
+        self.state.changed()
+        self.assertRaises(ValueError, self.go.upload_config)
+        self.assertEqual('GET', self.state.requests[-1][0])
+
+    def test_unchanged_config_is_not_uploaded(self):
+        self.go.fetch_config()
+        self.go.tree.rename_pipeline_group('nonesuch', 'renamed')
+        self.go.tree.tostring()
+        del self.state.requests[:]
+        self.go.upload_config()
+        self.assertEqual([], self.state.requests)
+
+    def test_config_changes_are_shown_when_verbose(self):
+        self.go.verbose = True
+        self.go.fetch_config()
+        self.go.tree.move_pipeline('pipeline00001', 'new')
+        out = StringIO()
+        saved, sys.stdout = sys.stdout, out
+        try:
+            self.go.upload_config()
+        finally:
+            sys.stdout = saved
+        self.assertEqual("Config changes:\n"
+                         "- pipelines[group000]/pipeline[pipeline00001]\n"
+                         "+ pipelines[new]\n\n", out.getvalue())
+        self.assertIsNotNone(self.state.group_element('new'))
+
+    def test_pipeline_admin_api_with_etags(self):
+        self.go.create_a_pipeline({'group': 'new', 'pipeline': pipeline_config('p', [git_material('/r')])})
+        self.assertTrue(self.go.get_pipeline_status('p')['paused'])
+        self.go.unpause('p')
+        self.assertFalse(self.go.get_pipeline_status('p')['paused'])
+        etag, config = self.go.get_pipeline_config('p')
+        config['label_template'] = 'x'
+        self.go.edit_pipeline_config('p', etag, config)
+        self.assertRaises(RuntimeError, self.go.edit_pipeline_config, 'p', etag, config)
+        self.assertEqual('x', self.go.get_pipeline_config('p')[1]['label_template'])
+        self.assertIn('p', [pipeline['name'] for group in self.go.get_pipeline_groups()
+                            for pipeline in group['pipelines']])
+
+    def test_pipeline_update_is_retried_on_conflict(self):
+        calls = []
+
+        def change(pipeline):
+            calls.append(pipeline['name'])
+            if len(calls) == 1:
+                # Someone else changes it before we put it back.
+                self.state.etags['pipeline00002'] += 1
+            pipeline['label_template'] = 'mine'
+
+        self.go.update_pipeline_config('pipeline00002', change)
+        self.assertEqual(['pipeline00002'] * 2, calls)
+        self.assertEqual('mine', self.state.pipelines['pipeline00002']['label_template'])
+
+    def test_downstream_updates_are_merged_per_pipeline(self):
+        self.go.create_a_pipeline({'group': 'new', 'pipeline': pipeline_config('up', [git_material('/r')])})
+        settings = JsonSettings(json.dumps([{"add-downstream-dependencies": [
+            {"name": "pipeline00002", "material": dependency_material('up')},
+            {"name": "pipeline00003", "material": dependency_material('up')},
+            {"name": "pipeline00002", "material": dependency_material('pipeline00001')},
+        ]}]), {})
+        del self.state.requests[:]
+        settings.server_operations(self.go)
+        self.assertEqual(['GET', 'GET', 'PUT', 'PUT'],
+                         sorted(method for method, path in self.state.requests))
+        materials = [material['attributes'].get('pipeline')
+                     for material in self.state.pipelines['pipeline00002']['materials']]
+        self.assertEqual(['up', 'pipeline00001'], materials[-2:])
+
+    def test_pipelines_are_unpaused_and_reported_once(self):
+        self.go.verbose = True
+        settings = JsonSettings(json.dumps([
+            {"create-a-pipeline": {"group": "new", "pipeline": pipeline_config(name, [git_material('/r')])},
+             "unpause": True}
+            for name in ('a', 'b', 'c')]), {})
+        out = StringIO()
+        saved, sys.stdout = sys.stdout, out
+        try:
+            settings.server_operations(self.go)
+        finally:
+            sys.stdout = saved
+        unpauses = [path for method, path in self.state.requests if path.endswith('/unpause')]
+        self.assertEqual(['/go/api/pipelines/{}/unpause'.format(name) for name in 'abc'], sorted(unpauses))
+        self.assertEqual(3, out.getvalue().count('"paused": false'))
+        self.assertEqual(set(), self.state.paused & set('abc'))
+
+    def test_pipelines_of_succeeded_operations_are_finished_after_a_failure(self):
+        settings = JsonSettings(json.dumps([
+            {"create-a-pipeline": {"group": "new", "pipeline": pipeline_config('a', [git_material('/a')])},
+             "environment": "env00", "unpause": True},
+            {"create-a-pipeline": {"group": "new", "pipeline": pipeline_config('b', [git_material('/b')])},
+             "add-downstream-dependencies": [{"name": "nonesuch", "material": dependency_material('b')}],
+             "environment": "env00", "unpause": True},
+        ]), {})
+        self.assertRaises(RuntimeError, settings.server_operations, self.go)
+        self.assertEqual(set(['b']), self.state.paused & set('ab'))
+        self.assertEqual(set(['a']), set(self.state.environment_pipelines('env00')) & set('ab'))
+
+    def test_patch_environment(self):
+        self.go.patch_environment('env00', pipelines_add=['pipeline00001'], pipelines_remove=['pipeline00000'])
+        members = self.state.environment_pipelines('env00')
+        self.assertIn('pipeline00001', members)
+        self.assertNotIn('pipeline00000', members)
+        self.assertRaises(RuntimeError, self.go.patch_environment, 'no-such-env', pipelines_add=['x'])
+
+    def test_environments_are_patched_once_with_new_members(self):
+        self.state.patch_environment(self.state.environment_element('env01'), add=['a'])
+        self.state.changed()
+        settings = JsonSettings(json.dumps([
+            {"create-a-pipeline": {"group": "new", "pipeline": pipeline_config(name, [git_material('/r')])},
+             "environment": env_name}
+            for name, env_name in (('a', 'env00'), ('b', 'env01'), ('c', 'env00'))]), {})
+        patches = []
+        patch_environment = self.go.patch_environment
+
+        def record_patch(env_name, pipelines_add):
+            patches.append((env_name, pipelines_add))
+            return patch_environment(env_name, pipelines_add=pipelines_add)
+        self.go.patch_environment = record_patch
+        del self.state.requests[:]
+        settings.server_operations(self.go)
+        self.assertEqual([('env00', ['a', 'b', 'c']), ('env01', ['b'])], sorted(patches))
+        # The members are read from the environments API, not the config XML.
+        self.assertEqual(['/go/api/admin/environments/env00', '/go/api/admin/environments/env01'],
+                         sorted(path for method, path in self.state.requests if method == 'GET'))
+        self.assertEqual(set('abc'), set(self.state.environment_pipelines('env00')) & set('abc'))
+        self.assertEqual(set('ab'), set(self.state.environment_pipelines('env01')) & set('abc'))
+
+    def test_independent_operations_run_concurrently(self):
+        names = ['p{}'.format(index) for index in range(8)]
+        operations = [{"create-a-pipeline": {"group": "new", "pipeline": pipeline_config(name, [git_material('/r')])}}
+                      for name in names]
+        operations[3]["environment"] = "env00"
+        operations.append({"add-downstream-dependencies": [
+            {"name": "pipeline00002", "material": dependency_material('p7')}]})
+        settings = JsonSettings(json.dumps(operations), {})
+        self.server.latency = 0.05
+        settings.server_operations(self.go, jobs=4)
+        self.assertEqual(names, settings.pipeline_names)
+        self.assertEqual(set(names[:4]), set(self.state.environment_pipelines('env00')) & set(names))
+        materials = self.state.pipelines['pipeline00002']['materials']
+        self.assertEqual('p7', materials[-1]['attributes']['pipeline'])
+        # The pipelines were created in parallel rather than one after the other.
+        self.assertTrue(self.server.max_in_flight > 1)
+
+    def test_default_dependency_is_on_pipeline_created_before_in_settings(self):
+        operations = [
+            {"create-a-pipeline": {"group": "new", "pipeline": pipeline_config('a', [git_material('/a')])}},
+            {"add-downstream-dependencies": [{"name": "pipeline00000", "task": {"type": "fetch"}}]},
+            {"create-a-pipeline": {"group": "new", "pipeline": pipeline_config('b', [git_material('/b')])}},
+        ]
+        created = []
+        create_a_pipeline = self.go.create_a_pipeline
+
+        def slow_a(pipeline):
+            if pipeline['pipeline']['name'] == 'a':
+                time.sleep(0.1)
+            create_a_pipeline(pipeline)
+            created.append(pipeline['pipeline']['name'])
+        self.go.create_a_pipeline = slow_a
+        JsonSettings(json.dumps(operations), {}).server_operations(self.go, jobs=2)
+        self.assertEqual(['b', 'a'], created)
+        material = self.state.pipelines['pipeline00000']['materials'][-1]
+        self.assertEqual(('dependency', 'a'), (material['type'], material['attributes']['pipeline']))
+
+    def test_parameter_sets_share_environment_patches(self):
+        template = json.dumps([
+            {"create-a-pipeline": {"group": "new", "pipeline": pipeline_config('{{ repo }}', [git_material('/r')])},
+             "environment": "env00", "unpause": True},
+            {"add-downstream-dependencies": [{"name": "{{ downstream }}",
+                                              "material": dependency_material('{{ repo }}')}]},
+        ])
+        parameter_sets = [{'repo': 'r{}'.format(index), 'downstream': 'pipeline0000{}'.format(index)}
+                          for index in range(4)]
+        parameter_sets[2]['downstream'] = 'nonesuch'
+        bulk = BulkSettings(template, parameter_sets, {})
+        del self.state.requests[:]
+        self.assertRaises(RuntimeError, bulk.server_operations, self.go, 4)
+        patches = [path for method, path in self.state.requests if method == 'PATCH']
+        self.assertEqual(['/go/api/admin/environments/env00'], patches)
+        repos = set(parameter_set['repo'] for parameter_set in parameter_sets)
+        # r2 was created before its downstream update failed.
+        self.assertEqual(repos, set(self.state.environment_pipelines('env00')) & repos)
+        self.assertEqual(set(), self.state.paused & repos)
+        out = StringIO()
+        bulk.print_report(out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Parameter sets: 4, on up to 4 threads, '))
+        self.assertIn('3 parameter set 3: downstream=nonesuch, repo=r2: failed after ', lines[3])
+
+    def test_upstream_traversal(self):
+        pipeline = Pipeline('pipeline00029/1', self.go, 'json')
+        pipeline.prepare_recursive_repos(jobs=4)
+        pipeline.collect_recursive_repos()
+        urls = set(repo.as_dict()['description'] for repo in pipeline.recursive_repos)
+        self.assertEqual(4, len(urls))
+        self.assertIn(('pipeline00000', '1'), pipeline.visited)
+        instance_requests = [path for method, path in self.state.requests if '/instance/' in path]
+        self.assertEqual(len(pipeline.visited), len(instance_requests))
+
+
+if __name__ == '__main__':
+    unittest.main()
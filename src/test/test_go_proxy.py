@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+from io import BytesIO
 from xml.etree import ElementTree
 
 from gocdpb.goserver_config import CruiseTree
@@ -84,6 +85,128 @@ class TestCruiseTree(unittest.TestCase):
         actual = tree.tostring()
         self.assertEqual(expected, actual)
 
+    config = (u'<?xml version="1.0" encoding="utf-8"?>\n'
+              u'<cruise xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+              u' xsi:noNamespaceSchemaLocation="cruise-config.xsd" schemaVersion="88">\n'
+              u'  <server artifactsdir="artifacts" />\n'
+              u'  <pipelines group="x"><pipeline name="p1" /></pipelines>\n'
+              u'  <pipelines group="y"><pipeline name="r\xe4ksm\xf6rg\xe5s" /></pipelines>\n'
+              u'  <environments><environment name="e" /></environments>\n'
+              u'  <agents />\n'
+              u'</cruise>\n').encode('utf-8')
+
+    def test_stream_whole_config(self):
+        tree = CruiseTree.fromstream(BytesIO(self.config))
+        self.assertFalse(tree.partial)
+        self.assertEqual(CruiseTree.fromstring(self.config).tostring(), tree.tostring())
+
+    def test_stream_some_sections(self):
+        sections = CruiseTree.select_sections(tags=('agents',), groups=('y',))
+        tree = CruiseTree.fromstream(BytesIO(self.config), sections)
+        self.assertTrue(tree.partial)
+        self.assertEqual(['pipelines', 'agents'], [child.tag for child in tree.getroot()])
+        self.assertEqual('y', tree.find('pipelines').get('group'))
+
+    def test_chunks_make_up_tostring(self):
+        tree = CruiseTree.fromstring(self.config)
+        chunks = list(tree.tostring_chunks())
+        self.assertEqual(len(tree.getroot()) + 2, len(chunks))
+        self.assertEqual(CruiseTree.fromstring(self.config).tostring(), type(chunks[0])().join(chunks))
+
+    def assert_index_is_fresh(self, tree):
+        found = (dict(tree._groups), dict(tree._pipelines), dict(tree._templates))
+        tree.reindex()
+        self.assertEqual((tree._groups, tree._pipelines, tree._templates), found)
+
+    def test_find_by_name(self):
+        tree = CruiseTree.fromstring(
+            '<cruise><pipelines group="x"><pipeline name="p1" /><pipeline name="p2" /></pipelines>'
+            '<templates><pipeline name="t1"><stage name="s" /></pipeline></templates></cruise>')
+        group = tree.find('pipelines')
+        self.assertIs(group, tree.find_pipeline_group('x'))
+        self.assertEqual((group, group[1]), tree.find_pipeline('p2'))
+        self.assertEqual('s', tree.find_template('t1')[0].get('name'))
+        self.assertIsNone(tree.find_pipeline_group('y'))
+        self.assertIsNone(tree.find_pipeline('t1'))
+        self.assertIsNone(tree.find_template('p1'))
+
+    def test_edits_keep_index_up_to_date(self):
+        tree = CruiseTree.fromstring(self.config)
+        tree.index()
+        tree.rename_pipeline_group('x', 'z')
+        self.assertIsNone(tree.find_pipeline_group('x'))
+        self.assertEqual('p1', tree.find_pipeline_group('z')[0].get('name'))
+        self.assert_index_is_fresh(tree)
+        tree.move_all_pipelines_in_group('z', 'w')
+        group, pipeline = tree.find_pipeline('p1')
+        self.assertIs(group, tree.find_pipeline_group('w'))
+        self.assertEqual(0, len(tree.find_pipeline_group('z')))
+        self.assert_index_is_fresh(tree)
+        tree.drop_pipeline_group('w')
+        self.assertIsNone(tree.find_pipeline('p1'))
+        self.assertIsNone(tree.find_pipeline_group('w'))
+        self.assert_index_is_fresh(tree)
+        tree.rename_pipeline_group('z', 'y')
+        self.assertEqual(['y', 'y'], [group.get('group') for group in tree.findall('pipelines')])
+        self.assertIs(tree.find('pipelines'), tree.find_pipeline_group('y'))
+        self.assert_index_is_fresh(tree)
+
+    def test_move_pipeline(self):
+        tree = CruiseTree.fromstring(self.config)
+        tree.move_pipeline('p1', 'y')
+        self.assertEqual([], tree.find_pipeline_group('x').findall('pipeline'))
+        self.assertEqual([u'r\xe4ksm\xf6rg\xe5s', 'p1'], [p.get('name') for p in tree.find_pipeline_group('y')])
+        tree.move_pipeline('p1', 'new')
+        self.assertEqual(['x', 'y', 'new'], [group.get('group') for group in tree.findall('pipelines')])
+        self.assertIs(tree.find_pipeline_group('new'), tree.find_pipeline('p1')[0])
+        self.assert_index_is_fresh(tree)
+
+    def test_edit(self):
+        tree = CruiseTree.fromstring(self.config)
+        self.assertRaises(ValueError, tree.edit, 'rename-pipeline-group', 'x', 'y')
+        self.assertRaises(ValueError, tree.edit, 'rename-pipeline-group', 'nonesuch', 'z')
+        self.assertRaises(ValueError, tree.edit, 'move-pipeline', 'nonesuch', 'z')
+        self.assertRaises(ValueError, tree.edit, 'drop-pipeline-group', 'x', 'y')
+        self.assertRaises(ValueError, tree.edit, 'rename-pipeline', 'p1', 'p2')
+        tree.edit('move-all-pipelines-in-group', 'x', 'z')
+        tree.edit('rename-pipeline-group', 'y', 'x')
+        self.assertEqual(['z', 'x'], [group.get('group') for group in tree.findall('pipelines')])
+        tree.edit('drop-pipeline-group', 'z')
+        self.assertIsNone(tree.find_pipeline('p1'))
+        self.assert_index_is_fresh(tree)
+
+    def test_fingerprint_ignores_indentation(self):
+        tree = CruiseTree.fromstring(self.config)
+        before = tree.fingerprint()
+        self.assertEqual(before, CruiseTree.fromstring(tree.tostring()).fingerprint())
+        self.assertEqual([], CruiseTree.fingerprint_diff(before, tree.fingerprint()))
+
+    def test_fingerprint_diff(self):
+        tree = CruiseTree.fromstring(self.config)
+        before = tree.fingerprint()
+        tree.rename_pipeline_group('x', 'z')
+        tree.find('server').set('artifactsdir', 'elsewhere')
+        tree.find_pipeline_group('y').append(tree.find_pipeline_group('y').makeelement('pipeline', {'name': 'p2'}))
+        tree.find('environments')[0].set('name', 'f')
+        self.assertEqual([u'~ server',
+                          u'- pipelines[x]',
+                          u'- environments/environment[e]',
+                          u'+ pipelines[z]',
+                          u'+ pipelines[y]/pipeline[p2]',
+                          u'+ environments/environment[f]'],
+                         CruiseTree.fingerprint_diff(before, tree.fingerprint()))
+
+    def test_edits_are_recorded_for_replay(self):
+        tree = CruiseTree.fromstring(self.config)
+        tree.edit('rename-pipeline-group', 'x', 'z')
+        tree.move_pipeline('p1', 'y')
+        self.assertEqual([('edit', ('rename-pipeline-group', 'x', 'z')), ('move_pipeline', ('p1', 'y'))],
+                         tree.operations)
+        other = CruiseTree.fromstring(self.config)
+        other.replay(tree.operations)
+        self.assertEqual(tree.tostring(), other.tostring())
+        self.assertEqual(tree.operations, other.operations)
+
 
 if __name__ == '__main__':
     unittest.main()
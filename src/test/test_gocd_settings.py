@@ -1,9 +1,12 @@
 #!/usr/bin/python -tt
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
+import tempfile
 import unittest
 import json
-from gocdpb.gocd_settings import Pipeline, JsonSettings
+from gocdpb.gocd_settings import Pipeline, JsonSettings, BulkSettings
 
 TEST_DATA1 = '''{
     "build_cause": {
@@ -161,6 +164,40 @@ class StubGo(object):
         pass
 
 
+def pipeline_material(pipeline_instance):
+    return {
+        "material": {"description": pipeline_instance.split('/')[0], "type": "Pipeline"},
+        "modifications": [{"modified_time": 1, "revision": pipeline_instance + "/stage/1"}]
+    }
+
+
+def git_material(url, revision):
+    return {
+        "material": {"description": "URL: {}, Branch: master".format(url), "type": "Git"},
+        "modifications": [{"modified_time": 1, "revision": revision}]
+    }
+
+
+class DagStubGo(object):
+    """
+    Pipeline instances in a diamond: top <- (left, right) <- base
+    """
+    graph = {
+        ('top', '1'): [pipeline_material('left/1'), pipeline_material('right/1')],
+        ('left', '1'): [pipeline_material('base/1'), git_material('/tmp/left', 'l1')],
+        ('right', '1'): [pipeline_material('base/1')],
+        ('base', '1'): [git_material('/tmp/base', 'b1')],
+    }
+
+    def __init__(self):
+        self.calls = []
+        self.verbose = False
+
+    def get_pipeline_instance(self, pipeline, instance):
+        self.calls.append((pipeline, instance))
+        return {"build_cause": {"material_revisions": self.graph[(pipeline, instance)]}}
+
+
 class DummyPluginFunction(object):
     call_log = []
 
@@ -197,6 +234,29 @@ class GocdSettingsTests(unittest.TestCase):
         self.assertEqual(kwargs['go'].get_pipeline_instance, go.get_pipeline_instance)
         self.assertEqual(settings.pipeline_names, ['NAME'])
 
+    def test_operation_dependencies(self):
+        def dependency(upstream):
+            return {"type": "dependency", "attributes": {"pipeline": upstream, "stage": "s"}}
+
+        def create(name, *upstreams):
+            return {"create-a-pipeline": {"pipeline": {"name": name,
+                                                       "materials": [dependency(up) for up in upstreams]}}}
+        operations = [
+            create('a'),
+            create('b'),
+            create('c', 'a'),
+            {"add-downstream-dependencies": [{"name": "d", "material": dependency('b')}]},
+            {"environment": "e", "unpause": True, "dummy-action": {"pipeline": {"name": "e"}}},
+            # Depends on the last pipeline created, see ensure_dependency_material()
+            {"add-downstream-dependencies": [{"name": "d", "task": {}}]},
+            create('f'),
+        ]
+        settings = JsonSettings(json.dumps(operations), {})
+        settings.register_plugin(DummyPluginModule)
+        self.assertEqual([set(), set(), set([0]), set([1]), set(), set(range(5)), set()],
+                         settings.operation_dependencies())
+        self.assertEqual('create-a-pipeline a, c', settings.describe_operation(settings.list[2]))
+
     def test_get_pipelines_with_several_version_of_same_material(self):
         pl = Pipeline('test3/3', StubGo(), 'json')
         pl.prepare_recursive_repos()
@@ -205,6 +265,119 @@ class GocdSettingsTests(unittest.TestCase):
                          [{'type': u'Git', 'description': u'URL: /tmp/test3, Branch: master',
                            'revision': u'ecc9ba924d30b29401ff06af6e6b7aa002a65ec6'}])
 
+    def test_shared_upstream_is_fetched_once(self):
+        go = DagStubGo()
+        pl = Pipeline('top/1', go, 'json')
+        pl.prepare_recursive_repos()
+        pl.collect_recursive_repos()
+        self.assertEqual(sorted(go.calls), sorted(set(go.calls)))
+        self.assertEqual(4, len(go.calls))
+        left, right = pl.upstreams
+        self.assertIs(left.upstreams[0], right.upstreams[0])
+        repos = dict((str(repo), pipelines) for repo, pipelines in pl.recursive_repos.items())
+        self.assertEqual({'Git; URL: /tmp/base, Branch: master; b1': set([('base', '1')]),
+                          'Git; URL: /tmp/left, Branch: master; l1': set([('left', '1')])},
+                         repos)
+
+    def test_concurrent_traversal_gives_same_result(self):
+        def traverse(jobs):
+            go = DagStubGo()
+            pl = Pipeline('top/1', go, 'json')
+            pl.prepare_recursive_repos(jobs)
+            pl.collect_recursive_repos()
+            upstreams = dict(((p.pipeline, p.instance), [(u.pipeline, u.instance) for u in p.upstreams])
+                             for p in pl.visited.values())
+            repos = dict((str(repo), pipelines) for repo, pipelines in pl.recursive_repos.items())
+            return sorted(go.calls), upstreams, repos
+
+        self.assertEqual(traverse(1), traverse(4))
+
+
+class CountingBulkSettings(BulkSettings):
+    compiled = 0
+
+    @classmethod
+    def compile_template(cls, template_data, template_cache=None):
+        cls.compiled += 1
+        return BulkSettings.compile_template(template_data, template_cache)
+
+
+class BulkSettingsTests(unittest.TestCase):
+    template = '[{"create-a-pipeline": {"group": "{{ group }}", "pipeline": {"name": "{{ repo }}"}}}]'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def parameter_sets(self, file_name, text):
+        path = os.path.join(self.directory, file_name)
+        with open(path, 'w') as parameter_file:
+            parameter_file.write(text)
+        with open(path) as parameter_file:
+            return BulkSettings.load_parameter_sets(parameter_file)
+
+    def test_parameter_set_formats(self):
+        expected = [{'repo': 'a', 'group': 'x'}, {'repo': 'b', 'group': 'y'}]
+        self.assertEqual(expected, self.parameter_sets('sets.csv', 'repo,group\na,x\nb,y\n'))
+        self.assertEqual(expected, self.parameter_sets(
+            'sets.jsonl', '{"repo": "a", "group": "x"}\n\n{"repo": "b", "group": "y"}\n'))
+        self.assertEqual(expected, self.parameter_sets('sets.yaml', '- {repo: a, group: x}\n- {repo: b, group: y}\n'))
+        self.assertRaises(ValueError, self.parameter_sets, 'sets.yaml', 'repo: a\n')
+
+    def test_template_is_compiled_once(self):
+        CountingBulkSettings.compiled = 0
+        bulk = CountingBulkSettings(self.template, [{'repo': 'a'}, {'repo': 'b'}, {'repo': 'c'}], {'group': 'g'})
+        self.assertEqual(1, CountingBulkSettings.compiled)
+        self.assertEqual([['a', 'g'], ['b', 'g'], ['c', 'g']],
+                         [[settings.list[0]["create-a-pipeline"]["pipeline"]["name"],
+                           settings.list[0]["create-a-pipeline"]["group"]] for settings in bulk.settings])
+
+    def test_parameter_sets_run_with_pipeline_names_in_order(self):
+        bulk = BulkSettings(self.template, [{'repo': 'a'}, {'repo': 'b'}], {'group': 'g'})
+        bulk.server_operations(StubGo())
+        self.assertEqual(['a', 'b'], bulk.pipeline_names)
+
+    def test_succeeded_operations_of_partly_failed_set_are_finished(self):
+        template = ('[{"create-a-pipeline": {"group": "g", "pipeline": {"name": "{{ repo }}-1"}}},'
+                    ' {"create-a-pipeline": {"group": "g", "pipeline": {"name": "{{ repo }}-2"}},'
+                    '  "environment": "e", "unpause": true}]')
+        go = FinishingStubGo(fail=['b-2'])
+        bulk = BulkSettings(template, [{'repo': 'a'}, {'repo': 'b'}], {})
+        self.assertRaises(RuntimeError, bulk.server_operations, go)
+        self.assertEqual(['a-1', 'a-2', 'b-1'], bulk.pipeline_names)
+        self.assertEqual([('e', ['a-1', 'a-2', 'b-1'])], go.patched)
+        self.assertEqual(['a-1', 'a-2', 'b-1'], sorted(go.unpaused))
+
+
+class FinishingStubGo(StubGo):
+    """
+    Records what's done with the created pipelines. Creating those
+    named in `fail` fails.
+    """
+    pool_size = 1
+
+    def __init__(self, fail=()):
+        super(FinishingStubGo, self).__init__()
+        self.fail = fail
+        self.patched = []
+        self.unpaused = []
+
+    def create_a_pipeline(self, pipeline):
+        if pipeline["pipeline"]["name"] in self.fail:
+            raise RuntimeError("422")
+
+    @staticmethod
+    def get_environment_pipelines(env_name):
+        return set()
+
+    def patch_environment(self, env_name, pipelines_add=None):
+        self.patched.append((env_name, pipelines_add))
+
+    def unpause(self, pipeline_name):
+        self.unpaused.append(pipeline_name)
+
 
 if __name__ == '__main__':
     unittest.main()
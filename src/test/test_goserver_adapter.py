@@ -0,0 +1,291 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import json
+import threading
+import time
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from gocdpb.goserver_adapter import Goserver, AsyncGoserver
+from gocdpb.goserver_config import CruiseTree
+from gocdpb.request_stats import RequestStats
+
+
+class StubResponse(object):
+    def __init__(self, status_code=200, text=u'{}', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size=1):
+        data = self.text.encode('utf-8')
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class StubSession(object):
+    def __init__(self, responses=None):
+        self.calls = []
+        self.responses = list(responses or [])
+
+    def request(self, action, url, **kwargs):
+        self.calls.append((action, url, kwargs))
+        if self.responses:
+            return self.responses.pop(0)
+        return StubResponse()
+
+
+class GoserverSessionTests(unittest.TestCase):
+    def test_session_is_pooled_and_reused(self):
+        go = Goserver(None, False, {'url': 'http://go/go', 'pool_size': '3',
+                                    'username': 'u', 'password': 'p'})
+        session = go.session
+        self.assertIs(session, go.session)
+        self.assertEqual(('u', 'p'), session.auth)
+        self.assertEqual(3, session.get_adapter('http://go/go')._pool_maxsize)
+
+    def test_request_uses_session_and_timeouts(self):
+        go = Goserver(None, False, {'url': 'http://go/go',
+                                    'connect_timeout': '2', 'read_timeout': 30})
+        go._session = StubSession()
+        go.unpause('p1')
+        go.get_pipeline_status('p1')
+        self.assertEqual(['POST', 'GET'], [call[0] for call in go._session.calls])
+        self.assertEqual('http://go/go/api/pipelines/p1/unpause', go._session.calls[0][1])
+        for call in go._session.calls:
+            self.assertEqual((2.0, 30.0), call[2]['timeout'])
+            self.assertNotIn('auth', call[2])
+
+    def test_check_config_rejects_bad_pool_size(self):
+        go = Goserver(None, False, {'url': 'http://go/go', 'pool_size': 'many'})
+        self.assertRaises(AssertionError, go.check_config)
+        go = Goserver(None, False, {'url': 'http://go/go', 'pool_size': 0})
+        self.assertRaises(AssertionError, go.check_config)
+
+
+class RequestStatsTests(unittest.TestCase):
+    def test_requests_are_recorded_per_endpoint(self):
+        go = Goserver(None, False, {'url': 'http://go/go'})
+        go._session = StubSession([StubResponse(200, u'{"paused": true}'), StubResponse(404, u'nope'),
+                                   StubResponse(200, u'{}', {'etag': '"1"'})])
+        go.get_pipeline_status('p1')
+        self.assertRaises(RuntimeError, go.get_pipeline_status, 'p2')
+        etag, pipeline = go.get_pipeline_config('p1')
+        endpoints = dict(((e['method'], e['path']), e) for e in go.stats.summary())
+        status = endpoints[('GET', '/api/pipelines/{name}/status')]
+        self.assertEqual(2, status['count'])
+        self.assertEqual({'200': 1, '404': 1}, status['statuses'])
+        self.assertEqual(len(u'{"paused": true}') + len(u'nope'), status['bytes_received'])
+        self.assertEqual(1, endpoints[('GET', '/api/admin/pipelines/{name}')]['count'])
+
+    def test_report_and_json(self):
+        stats = RequestStats()
+        stats.record('PUT', '/api/admin/pipelines/{name}', 200, 0.02, 100, 50)
+        stats.record('PUT', '/api/admin/pipelines/{name}', 412, 0.2, 100, 10, retries=1)
+        out = StringIO()
+        stats.print_report(out)
+        self.assertIn(u'PUT /api/admin/pipelines/{name}', out.getvalue())
+        self.assertIn(u'< 0.05s', out.getvalue())
+        data = json.loads(json.dumps(stats.as_dict()))
+        self.assertEqual(2, data['requests'])
+        self.assertEqual(1, data['retries'])
+        self.assertEqual(200, data['bytes_sent'])
+        self.assertEqual({'200': 1, '412': 1}, data['endpoints'][0]['statuses'])
+
+
+CONFIG_XML = u'<cruise>\n  <pipelines group="x" />\n</cruise>'
+
+
+class ConfigCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        Goserver._parsed_configs.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        Goserver._parsed_configs.clear()
+
+    def goserver(self, *responses):
+        go = Goserver(None, False, {'url': 'http://go/go', 'cache_dir': self.cache_dir})
+        go._session = StubSession(responses)
+        return go
+
+    def test_unchanged_config_is_neither_downloaded_nor_parsed_again(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}))
+        go.fetch_config()
+        first_tree = go.tree
+        self.assertNotIn('If-None-Match', go._session.calls[0][2]['headers'])
+        go.release_config()
+
+        go = self.goserver(StubResponse(304))
+        go.fetch_config()
+        self.assertEqual('"abc"', go._session.calls[0][2]['headers']['If-None-Match'])
+        self.assertIs(first_tree, go.tree)
+        self.assertEqual('abc', go._cruise_config_md5)
+
+    def test_fetched_config_is_not_shared(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}))
+        go.fetch_config()
+        other = self.goserver(StubResponse(304))
+        other.fetch_config()
+        self.assertIsNot(go.tree, other.tree)
+
+    def test_changed_config_is_not_reused(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}),
+                           StubResponse(304))
+        go.fetch_config()
+        go.tree.rename_pipeline_group('x', 'y')
+        go.fetch_config()
+        self.assertEqual('x', go.tree.find('pipelines').get('group'))
+        self.assertEqual([], go.tree.operations)
+
+    def test_reused_config_has_no_operations(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}),
+                           StubResponse(304))
+        go.fetch_config()
+        first_tree = go.tree
+        go.tree.rename_pipeline_group('nonesuch', 'y')
+        go.upload_config()
+        go.fetch_config()
+        self.assertIs(first_tree, go.tree)
+        self.assertEqual([], go.tree.operations)
+
+    def test_unedited_config_is_not_fingerprinted(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}),
+                           StubResponse(304))
+        fingerprint = CruiseTree.fingerprint
+
+        def fail(tree):
+            raise AssertionError("Fingerprinted")
+        CruiseTree.fingerprint = fail
+        try:
+            go.fetch_config()
+            first_tree = go.tree
+            go.upload_config()
+            go.fetch_config()
+        finally:
+            CruiseTree.fingerprint = fingerprint
+        self.assertIs(first_tree, go.tree)
+        self.assertEqual(2, len(go._session.calls))
+
+    def test_config_is_not_reused_after_failed_edit(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}),
+                           StubResponse(304))
+        go.fetch_config()
+        first_tree = go.tree
+        self.assertRaises(ValueError, go.tree.edit, 'move-pipeline', 'nonesuch', 'x')
+        self.assertTrue(first_tree.edited)
+        go.fetch_config()
+        self.assertIsNot(first_tree, go.tree)
+
+    def test_cached_config_is_used_in_new_process(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}))
+        go.fetch_config()
+        Goserver._parsed_configs.clear()
+
+        go = self.goserver(StubResponse(304))
+        go.fetch_config()
+        self.assertEqual('x', go.tree.find('pipelines').get('group'))
+
+    def test_changed_config_replaces_cache(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}))
+        go.fetch_config()
+        new_xml = CONFIG_XML.replace('"x"', '"y"')
+        go = self.goserver(StubResponse(200, new_xml, {'x-cruise-config-md5': 'def'}))
+        go.fetch_config()
+        self.assertEqual('y', go.tree.find('pipelines').get('group'))
+        self.assertEqual('def', go.config_cache.md5)
+        with go.config_cache.open() as xml_file:
+            self.assertEqual(new_xml, xml_file.read().decode('utf-8'))
+
+    def test_pipeline_instances_are_cached(self):
+        go = self.goserver(StubResponse(200, u'{"name": "p", "counter": 3}'))
+        self.assertEqual(3, go.get_pipeline_instance('p', '3')['counter'])
+        go = self.goserver()
+        self.assertEqual(3, go.get_pipeline_instance('p', '3')['counter'])
+        self.assertEqual([], go._session.calls)
+        go.instance_cache = None
+        go.get_pipeline_instance('p', '3')
+        self.assertEqual(1, len(go._session.calls))
+
+    def test_partial_config_is_not_uploaded(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}))
+        go.fetch_config(sections=CruiseTree.select_sections(tags=('agents',)))
+        self.assertEqual([], list(go.tree.getroot()))
+        self.assertRaises(ValueError, go.upload_config)
+        self.assertEqual(1, len(go._session.calls))
+
+    def test_config_is_uploaded_as_form(self):
+        go = self.goserver(StubResponse(200, CONFIG_XML, {'x-cruise-config-md5': 'abc'}))
+        go.fetch_config()
+        go.tree.rename_pipeline_group('x', 'y')
+        go.upload_config()
+        # Not an iterator, which requests would send chunked, without a Content-Length.
+        self.assertEqual({'md5': 'abc', 'xmlFile': go.cruise_xml}, go._session.calls[1][2]['data'])
+
+    def test_config_cache_can_be_disabled(self):
+        go = Goserver(None, False, {'url': 'http://go/go', 'cache_dir': self.cache_dir,
+                                    'config_cache': 'false'})
+        self.assertIsNone(go.config_cache)
+
+    def test_template_cache_size_and_disabling(self):
+        go = Goserver(None, False, {'url': 'http://go/go', 'cache_dir': self.cache_dir,
+                                    'template_cache_size': '0.5'})
+        self.assertEqual(512 * 1024, go.template_cache.max_bytes)
+        go = Goserver(None, False, {'url': 'http://go/go', 'template_cache': 'off'})
+        self.assertIsNone(go.template_cache)
+
+
+class SlowStubGo(object):
+    pool_size = 4
+    verbose = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def get_pipeline_status(self, pipeline_name):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        if pipeline_name == 'broken':
+            raise RuntimeError('404')
+        return {'name': pipeline_name}
+
+
+class AsyncGoserverTests(unittest.TestCase):
+    def test_concurrency_is_bounded(self):
+        stub = SlowStubGo()
+        with AsyncGoserver(stub, concurrency=2) as go:
+            results = [go.get_pipeline_status('p%d' % i) for i in range(8)]
+            statuses = go.gather(results)
+        self.assertEqual(['p%d' % i for i in range(8)], [status['name'] for status in statuses])
+        self.assertEqual(2, stub.max_running)
+
+    def test_default_concurrency_is_pool_size(self):
+        self.assertEqual(4, AsyncGoserver(SlowStubGo()).concurrency)
+
+    def test_concurrency_is_capped_at_pool_size(self):
+        self.assertEqual(4, AsyncGoserver(SlowStubGo(), concurrency=10).concurrency)
+
+    def test_errors_are_raised_by_get(self):
+        with AsyncGoserver(SlowStubGo()) as go:
+            result = go.get_pipeline_status('broken')
+            self.assertRaises(RuntimeError, result.get)
+
+
+if __name__ == '__main__':
+    unittest.main()
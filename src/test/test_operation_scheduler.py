@@ -0,0 +1,90 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from gocdpb.operation_scheduler import OperationScheduler
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def operation(self, name, seconds=0.02, error=None):
+        def run():
+            with self.lock:
+                self.events.append(('start', name))
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(seconds)
+            with self.lock:
+                self.running -= 1
+                self.events.append(('end', name))
+            if error is not None:
+                raise error
+        return run
+
+
+class OperationSchedulerTests(unittest.TestCase):
+    def test_one_job_runs_in_order(self):
+        recorder = Recorder()
+        OperationScheduler().run([(name, recorder.operation(name, 0), set()) for name in 'abc'])
+        self.assertEqual(['a', 'b', 'c'], [name for event, name in recorder.events if event == 'start'])
+        self.assertEqual(1, recorder.max_running)
+
+    def test_independent_operations_run_concurrently(self):
+        recorder = Recorder()
+        OperationScheduler(jobs=3).run([(name, recorder.operation(name), set()) for name in 'abcd'])
+        self.assertEqual(3, recorder.max_running)
+
+    def test_dependent_operations_wait(self):
+        recorder = Recorder()
+        OperationScheduler(jobs=4).run([
+            ('a', recorder.operation('a'), set()),
+            ('b', recorder.operation('b', 0), set()),
+            ('c', recorder.operation('c', 0), set([0])),
+        ])
+        self.assertTrue(recorder.events.index(('end', 'a')) < recorder.events.index(('start', 'c')))
+
+    def test_failure_stops_scheduling_and_is_reported(self):
+        recorder = Recorder()
+        scheduler = OperationScheduler(jobs=2)
+        self.assertRaises(ValueError, scheduler.run, [
+            ('a', recorder.operation('a', 0.05), set()),
+            ('b', recorder.operation('b', 0, ValueError('broken')), set()),
+            ('c', recorder.operation('c', 0), set()),
+        ])
+        self.assertNotIn(('start', 'c'), recorder.events)
+        self.assertIn(('end', 'a'), recorder.events)
+        out = StringIO()
+        scheduler.print_report(out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Settings operations: 3, on up to 2 threads, '))
+        self.assertTrue(lines[1].endswith('s') and '1 a: ' in lines[1])
+        self.assertIn("2 b: failed after ", lines[2])
+        self.assertIn("broken", lines[2])
+        self.assertTrue(lines[3].endswith('3 c: not run'))
+
+    def test_keep_going_only_skips_dependents_of_failures(self):
+        recorder = Recorder()
+        scheduler = OperationScheduler(keep_going=True)
+        self.assertRaises(ValueError, scheduler.run, [
+            ('a', recorder.operation('a', 0, ValueError('broken')), set()),
+            ('b', recorder.operation('b', 0), set([0])),
+            ('c', recorder.operation('c', 0), set()),
+        ])
+        self.assertEqual(['a', 'c'], [name for event, name in recorder.events if event == 'start'])
+        self.assertIsNone(scheduler.records[1].seconds)
+
+
+if __name__ == '__main__':
+    unittest.main()
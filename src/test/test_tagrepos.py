@@ -6,6 +6,11 @@ from collections import namedtuple
 import unittest
 from gocdpb import tagrepos
 import json
+import os
+import shutil
+import subprocess
+import tempfile
+from multiprocessing.pool import ThreadPool
 from os import getcwd, path, chdir
 import argparse
 
@@ -87,20 +92,25 @@ testdata = [
 ]
 
 
+def git_call(*args):
+    return MockSubprocess.response.format((['git'] + list(args),), {'stderr': 'sys.stdout'})
+
+
 class TestsBase(unittest.TestCase):
     def setUp(self):
         self._saved_subprocess = tagrepos.subprocess
-        self._saved_chdir = tagrepos.chdir
-        self._saved_rmtree = tagrepos.chdir
+        self._saved_rmtree = tagrepos.rmtree
+        self._saved_locked = tagrepos.MirrorTagger.locked
         self.log = []
         tagrepos.subprocess = MockSubprocess(log=self.log)
-        tagrepos.chdir = MockCall('chdir', log=self.log)
         tagrepos.rmtree = MockCall('rmtree', log=self.log)
+        # No lock files in mirror dirs that are never made.
+        tagrepos.MirrorTagger.locked = tagrepos.GitTagger.locked
 
     def tearDown(self):
         tagrepos.subprocess = self._saved_subprocess
-        tagrepos.chdir = self._saved_chdir
         tagrepos.rmtree = self._saved_rmtree
+        tagrepos.MirrorTagger.locked = self._saved_locked
 
 
 class GitTaggerTests(TestsBase):
@@ -119,24 +129,14 @@ class GitTaggerTests(TestsBase):
         tagger.clean()
 
         expected = [
-            ('chdir', ('directory',), {}),
-            u"Return from check_output args=(['git', 'clone', '/tmp/test1'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', ('test1',), {}),
-            u"Return from check_output args=(['git', 'checkout', 'master'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory/test1',), {}),
-            u"Return from check_output args=(['git', 'tag', 'RELEASE-1.2.3', "
-            u"'c142925e8d183b108020072143a669515612e8f3'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory/test1',), {}),
-            u"Return from check_output args=(['git', 'push', 'origin', "
-            u"'RELEASE-1.2.3'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory',), {}),
-            ('rmtree', ('test1',), {}),
-            ('chdir', (startdir,), {})
+            git_call('clone', '/tmp/test1', 'directory/test1'),
+            git_call('-C', 'directory/test1', 'checkout', 'master'),
+            git_call('-C', 'directory/test1', 'tag', 'RELEASE-1.2.3', 'c142925e8d183b108020072143a669515612e8f3'),
+            git_call('-C', 'directory/test1', 'push', 'origin', 'RELEASE-1.2.3'),
+            ('rmtree', ('directory/test1',), {}),
         ]
         self.assertEqual(expected, self.log)
+        self.assertEqual(startdir, getcwd())
 
     def test_tag_repos_when_tag_already_exists(self):
         tagrepos.subprocess.set_raise_when_tagging()
@@ -146,23 +146,15 @@ class GitTaggerTests(TestsBase):
         branch = 'master'
         rev = "c142925e8d183b108020072143a669515612e8f3"
         tag = 'RELEASE-1.2.3'
-        startdir = getcwd()
 
         tagger = tagrepos.GitTagger(directory)
         tagger.clone(repo, branch)
         tagger.tag(tag, rev)
 
         expected = [
-            ('chdir', ('directory',), {}),
-            u"Return from check_output args=(['git', 'clone', '/tmp/test1'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', ('test1',), {}),
-            u"Return from check_output args=(['git', 'checkout', 'master'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory/test1',), {}),
-            u"Return from check_output args=(['git', 'tag', 'RELEASE-1.2.3', "
-            u"'c142925e8d183b108020072143a669515612e8f3'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
+            git_call('clone', '/tmp/test1', 'directory/test1'),
+            git_call('-C', 'directory/test1', 'checkout', 'master'),
+            git_call('-C', 'directory/test1', 'tag', 'RELEASE-1.2.3', 'c142925e8d183b108020072143a669515612e8f3'),
         ]
         self.assertEqual(expected, self.log)
 
@@ -172,22 +164,15 @@ class GitTaggerTests(TestsBase):
         branch = 'master'
         rev = "c142925e8d183b108020072143a669515612e8f3"
         tag = 'RELEASE-1.2.3'
-        startdir = getcwd()
 
         tagger = tagrepos.GitTagger(directory)
         tagger.clone(repo, branch)
         tagger.branch(tag, rev)
 
         expected = [
-            ('chdir', ('directory',), {}),
-            u"Return from check_output args=(['git', 'clone', '/tmp/test1'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', ('test1',), {}),
-            u"Return from check_output args=(['git', 'checkout', 'master'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory/test1',), {}),
-            u"Return from check_output args=(['git', 'branch', 'RELEASE-1.2.3', "
-            u"'c142925e8d183b108020072143a669515612e8f3'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {})
+            git_call('clone', '/tmp/test1', 'directory/test1'),
+            git_call('-C', 'directory/test1', 'checkout', 'master'),
+            git_call('-C', 'directory/test1', 'branch', 'RELEASE-1.2.3', 'c142925e8d183b108020072143a669515612e8f3'),
         ]
         self.assertEqual(expected, self.log)
 
@@ -196,7 +181,6 @@ class TagReposTests(TestsBase):
     def test_branch_and_tag_repos(self):
         directory = 'directory'
         tag = 'GUTEN_TAG'
-        startdir = getcwd()
 
         tagrepos.branch_tag_repos(directory,
                                   tag,
@@ -206,59 +190,23 @@ class TagReposTests(TestsBase):
                                   clean=True)
 
         expected = [
-            ('chdir', ('directory',), {}),
-            u"Return from check_output args=(['git', 'clone', '/tmp/test3'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', ('test3',), {}),
-            u"Return from check_output args=(['git', 'checkout', 'master'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test3',), {}),
-            u"Return from check_output args=(['git', 'branch', 'GUTEN_TAG', "
-            u"'ecc9ba924d30b29401ff06af6e6b7aa002a65ec6'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test3',), {}),
-            u"Return from check_output args=(['git', 'push', 'origin', 'GUTEN_TAG'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory',), {}),
-            ('rmtree', ('test3',), {}),
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory',), {}),
-            u"Return from check_output args=(['git', 'clone', '/tmp/test1'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', ('test1',), {}),
-            u"Return from check_output args=(['git', 'checkout', 'master'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test1',), {}),
-            u"Return from check_output args=(['git', 'tag', 'GUTEN_TAG', "
-            u"'c142925e8d183b108020072143a669515612e8f3'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test1',), {}),
-            u"Return from check_output args=(['git', 'push', 'origin', 'GUTEN_TAG'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory',), {}),
-            ('rmtree', ('test1',), {}),
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory',), {}),
-            u"Return from check_output args=(['git', 'clone', '/tmp/test2'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', ('test2',), {}),
-            u"Return from check_output args=(['git', 'checkout', 'master'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test2',), {}),
-            u"Return from check_output args=(['git', 'branch', 'GUTEN_TAG', "
-            u"'tagga-ner'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test2',), {}),
-            u"Return from check_output args=(['git', 'push', 'origin', 'GUTEN_TAG'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory',), {}),
-            ('rmtree', ('test2',), {}),
-            ('chdir', (startdir,), {}),
+            git_call('clone', '/tmp/test3', 'directory/test3'),
+            git_call('-C', 'directory/test3', 'checkout', 'master'),
+            git_call('-C', 'directory/test3', 'branch', 'GUTEN_TAG', 'ecc9ba924d30b29401ff06af6e6b7aa002a65ec6'),
+            git_call('-C', 'directory/test3', 'push', 'origin', 'GUTEN_TAG'),
+            ('rmtree', ('directory/test3',), {}),
+
+            git_call('clone', '/tmp/test1', 'directory/test1'),
+            git_call('-C', 'directory/test1', 'checkout', 'master'),
+            git_call('-C', 'directory/test1', 'tag', 'GUTEN_TAG', 'c142925e8d183b108020072143a669515612e8f3'),
+            git_call('-C', 'directory/test1', 'push', 'origin', 'GUTEN_TAG'),
+            ('rmtree', ('directory/test1',), {}),
+
+            git_call('clone', '/tmp/test2', 'directory/test2'),
+            git_call('-C', 'directory/test2', 'checkout', 'master'),
+            git_call('-C', 'directory/test2', 'branch', 'GUTEN_TAG', 'tagga-ner'),
+            git_call('-C', 'directory/test2', 'push', 'origin', 'GUTEN_TAG'),
+            ('rmtree', ('directory/test2',), {}),
         ]
         self.assertEqual(expected, self.log)
 
@@ -268,7 +216,6 @@ class TagReposTests(TestsBase):
         """
         directory = 'directory'
         tag = 'GUTEN_TAG'
-        startdir = getcwd()
 
         tagrepos.branch_tag_repos(directory,
                                   tag,
@@ -279,41 +226,64 @@ class TagReposTests(TestsBase):
                                   tag=False)
 
         expected = [
-            ('chdir', ('directory',), {}),
-            u"Return from check_output args=(['git', 'clone', '/tmp/test3'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', ('test3',), {}),
-            u"Return from check_output args=(['git', 'checkout', 'master'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test3',), {}),
-            u"Return from check_output args=(['git', 'branch', 'GUTEN_TAG', "
-            u"'ecc9ba924d30b29401ff06af6e6b7aa002a65ec6'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test3',), {}),
-            u"Return from check_output args=(['git', 'push', 'origin', 'GUTEN_TAG'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory',), {}),
-            ('rmtree', ('test3',), {}),
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory',), {}),
-            u"Return from check_output args=(['git', 'clone', '/tmp/test2'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', ('test2',), {}),
-            u"Return from check_output args=(['git', 'checkout', 'master'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test2',), {}),
-            u"Return from check_output args=(['git', 'branch', 'GUTEN_TAG', "
-            u"'tagga-ner'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-
-            ('chdir', ('directory/test2',), {}),
-            u"Return from check_output args=(['git', 'push', 'origin', 'GUTEN_TAG'],), kwargs={'stderr': 'sys.stdout'}",
-            ('chdir', (startdir,), {}),
-            ('chdir', ('directory',), {}),
-            ('rmtree', ('test2',), {}),
-            ('chdir', (startdir,), {}),
+            git_call('clone', '/tmp/test3', 'directory/test3'),
+            git_call('-C', 'directory/test3', 'checkout', 'master'),
+            git_call('-C', 'directory/test3', 'branch', 'GUTEN_TAG', 'ecc9ba924d30b29401ff06af6e6b7aa002a65ec6'),
+            git_call('-C', 'directory/test3', 'push', 'origin', 'GUTEN_TAG'),
+            ('rmtree', ('directory/test3',), {}),
+
+            git_call('clone', '/tmp/test2', 'directory/test2'),
+            git_call('-C', 'directory/test2', 'checkout', 'master'),
+            git_call('-C', 'directory/test2', 'branch', 'GUTEN_TAG', 'tagga-ner'),
+            git_call('-C', 'directory/test2', 'push', 'origin', 'GUTEN_TAG'),
+            ('rmtree', ('directory/test2',), {}),
+        ]
+        self.assertEqual(expected, self.log)
+
+    def test_parallel_branch_and_tag_repos(self):
+        directory = 'directory'
+        tag = 'GUTEN_TAG'
+
+        tagrepos.branch_tag_repos(directory,
+                                  tag,
+                                  testdata,
+                                  branch_set=set(['test2', 'test3', 'not_used']),
+                                  push=True,
+                                  clean=True,
+                                  jobs=3)
+
+        for repo_name in ('test1', 'test2', 'test3'):
+            repo_dir = 'directory/' + repo_name
+            repo_log = [entry for entry in self.log if repo_dir in str(entry)]
+            self.assertEqual(5, len(repo_log))
+            self.assertIn("'clone'", repo_log[0])
+            self.assertEqual(('rmtree', (repo_dir,), {}), repo_log[-1])
+        self.assertEqual(15, len(self.log))
+
+    def test_each_url_is_cloned_once(self):
+        structure = [dict(testdata[1]), dict(testdata[1])]
+        structure[1]['description'] = "URL: /tmp/test1, Branch: release"
+
+        tagrepos.branch_tag_repos('directory', 'GUTEN_TAG', structure, push=True)
+
+        expected = [
+            git_call('clone', '/tmp/test1', 'directory/test1'),
+            git_call('-C', 'directory/test1', 'checkout', 'master'),
+            git_call('-C', 'directory/test1', 'tag', 'GUTEN_TAG', 'c142925e8d183b108020072143a669515612e8f3'),
+            git_call('-C', 'directory/test1', 'push', 'origin', 'GUTEN_TAG'),
+        ]
+        self.assertEqual(expected, self.log)
+
+    def test_tag_in_new_mirror(self):
+        tagrepos.branch_tag_repos('directory', 'GUTEN_TAG', testdata[1:2], push=True, clean=True,
+                                  mirror_dir='mirrors')
+
+        mirror = tagrepos.MirrorTagger('mirrors').clone_path('/tmp/test1')
+        self.assertTrue(mirror.startswith('mirrors/test1-'))
+        expected = [
+            git_call('clone', '--bare', '/tmp/test1', mirror),
+            git_call('-C', mirror, 'tag', 'GUTEN_TAG', 'c142925e8d183b108020072143a669515612e8f3'),
+            git_call('-C', mirror, 'push', 'origin', 'GUTEN_TAG'),
         ]
         self.assertEqual(expected, self.log)
 
@@ -386,6 +356,73 @@ class TagReposTests(TestsBase):
         self.assertEqual(change_count, 1)
         helper.assertions(new_repolist)
 
+
+def git(*args):
+    env = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+    return subprocess.check_output(('git',) + args, env=env).decode('utf-8').strip()
+
+
+class TaggerGitTests(unittest.TestCase):
+    """
+    MirrorTagger and RemoteTagger with real git repositories.
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = path.join(self.tmp, 'origin.git')
+        work = path.join(self.tmp, 'work')
+        git('init', '-q', '--bare', self.origin)
+        git('init', '-q', work)
+        git('-C', work, 'commit', '-q', '--allow-empty', '-m', 'first')
+        git('-C', work, 'push', '-q', self.origin, 'HEAD:refs/heads/master')
+        self.first = git('-C', work, 'rev-parse', 'HEAD')
+        git('-C', work, 'commit', '-q', '--allow-empty', '-m', 'second')
+        git('-C', work, 'push', '-q', self.origin, 'HEAD:refs/heads/master')
+        self.second = git('-C', work, 'rev-parse', 'HEAD')
+        self.mirror_dir = path.join(self.tmp, 'mirrors')
+        os.mkdir(self.mirror_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def structure(self, revision):
+        return [{"description": "URL: {}, Branch: master".format(self.origin),
+                 "pipelines": [{"counter": "1", "name": "p"}],
+                 "revision": revision,
+                 "type": "Git"}]
+
+    def test_mirror_is_reused_between_runs(self):
+        tagrepos.branch_tag_repos(None, 'R1', self.structure(self.first), push=True, mirror_dir=self.mirror_dir)
+        tagrepos.branch_tag_repos(None, 'R2', self.structure(self.second), branch_set=set(['p']), push=True,
+                                  mirror_dir=self.mirror_dir)
+
+        self.assertEqual(1, len([name for name in os.listdir(self.mirror_dir) if name.endswith('.git')]))
+        self.assertEqual(self.first, git('-C', self.origin, 'rev-parse', 'R1^{commit}'))
+        self.assertEqual(self.second, git('-C', self.origin, 'rev-parse', 'refs/heads/R2'))
+
+    def test_concurrent_runs_share_a_mirror(self):
+        structure = self.structure(self.first)
+        pool = ThreadPool(2)
+        try:
+            pool.map(lambda tag: tagrepos.branch_tag_repos(None, tag, structure, push=True,
+                                                          mirror_dir=self.mirror_dir), ['R1', 'R2'])
+        finally:
+            pool.close()
+        self.assertEqual(self.first, git('-C', self.origin, 'rev-parse', 'R1^{commit}'))
+        self.assertEqual(self.first, git('-C', self.origin, 'rev-parse', 'R2^{commit}'))
+
+    def test_remote_only(self):
+        tagrepos.branch_tag_repos(self.tmp, 'R1', self.structure(self.first), push=True, remote=True)
+        tagrepos.branch_tag_repos(self.tmp, 'R2', self.structure(self.second), branch_set=set(['p']), push=True,
+                                  remote=True)
+        # Existing tags are left alone.
+        tagrepos.branch_tag_repos(self.tmp, 'R1', self.structure(self.second), push=True, remote=True)
+
+        self.assertEqual(self.first, git('-C', self.origin, 'rev-parse', 'R1^{commit}'))
+        self.assertEqual(self.second, git('-C', self.origin, 'rev-parse', 'refs/heads/R2'))
+        self.assertEqual(sorted(['origin.git', 'work', 'mirrors']), sorted(os.listdir(self.tmp)))
+
+
 class BranchParamTests(TestsBase):
     def test_branch_list_empty(self):
         pargs = argparse.Namespace
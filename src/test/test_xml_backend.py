@@ -0,0 +1,159 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+import os
+import ast
+import copy
+import re
+import glob
+import unittest
+from io import BytesIO
+
+from gocdpb import xml_backend
+from gocdpb.goserver_config import CruiseTree
+from gocdpb.xml_backend import StdlibBackend, LxmlBackend
+
+TEXTTEST_DIR = os.path.join(os.path.dirname(__file__), '..', 'texttest')
+
+
+class StdlibCruiseTree(CruiseTree):
+    backend = StdlibBackend
+
+
+class LxmlCruiseTree(CruiseTree):
+    backend = LxmlBackend
+
+
+def texttest_configs():
+    """
+    The configs that the Go server returned in the texttest runs, and
+    the configs that the tests start from.
+    """
+    configs = []
+    for mock_path in glob.glob(os.path.join(TEXTTEST_DIR, '*', '*', 'pythonmocks.gocdpb')) + \
+            glob.glob(os.path.join(TEXTTEST_DIR, '*', 'pythonmocks.gocdpb')):
+        with open(mock_path) as mock_file:
+            mocks = mock_file.read()
+        # Streamed configs are recorded as the byte chunks (one, for these).
+        for literal in re.findall(r"->RET:(u?'''<\?xml.*?''')\n", mocks, re.DOTALL):
+            config = ast.literal_eval(literal)
+            if not isinstance(config, bytes):
+                config = config.encode('utf-8' if literal.startswith('u') else 'latin-1')
+            configs.append(config)
+    for config_path in glob.glob(os.path.join(TEXTTEST_DIR, '*', '*', 'config-before.xml')):
+        with open(config_path, 'rb') as config_file:
+            configs.append(config_file.read())
+    return configs
+
+
+@unittest.skipIf(xml_backend.lxml_etree is None, "lxml isn't installed.")
+class LxmlBackendTests(unittest.TestCase):
+    def assert_same_bytes(self, config):
+        stdlib_tree = StdlibCruiseTree.fromstring(config)
+        lxml_tree = LxmlCruiseTree.fromstring(config)
+        expected = stdlib_tree.tostring()
+        self.assertEqual(expected, lxml_tree.tostring())
+        self.assertEqual(expected, b''.join(LxmlCruiseTree.fromstring(config).tostring_chunks()))
+        self.assertEqual(expected, LxmlCruiseTree.fromstream(BytesIO(config)).tostring())
+        self.assertEqual(stdlib_tree.config_subset_tostring(), lxml_tree.config_subset_tostring())
+
+    def test_texttest_configs_give_same_bytes(self):
+        configs = texttest_configs()
+        self.assertTrue(len(configs) > 10)
+        for config in configs:
+            self.assert_same_bytes(config)
+
+    def test_tricky_config_gives_same_bytes(self):
+        self.assert_same_bytes(
+            u'<?xml version="1.0" encoding="utf-8"?>\n'
+            u'<!-- comment -->\n'
+            u'<cruise xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            u'xsi:noNamespaceSchemaLocation="cruise-config.xsd" schemaVersion="88">\n'
+            u'<server b="&gt;/" a="&quot;&amp;" />'
+            u'<pipelines group="g"><pipeline name="r\xe4ksm\xf6rg\xe5s" template="t"><!-- x -->'
+            u'<params><param name="p">  </param></params>'
+            u'<materials><git url="u" /></materials></pipeline></pipelines>'
+            u'<environments><environment name="e"><pipelines /></environment></environments>\n'
+            u'   <agents/></cruise>'.encode('utf-8'))
+
+    def test_escaped_characters_give_same_bytes(self):
+        # lxml writes tab and CR as references where xml.etree may not,
+        # and some characters outside the BMP as hexadecimal references.
+        self.assert_same_bytes(
+            u'<cruise a="t&#9;c&#13;n&#10;\U0001f600" schemaVersion="88">'
+            u'<server b="\xe4&#9;" />'
+            u'<pipelines group="g&#9;&#13;\U0001f600">'
+            u'<pipeline name="p\U0001f600"><params><param name="p">t\tc&#13;\U0001f600\xe4</param></params>'
+            u'</pipeline></pipelines>'
+            u'<environments><environment name="e&#13;" /></environments></cruise>'.encode('utf-8'))
+
+    def test_namespaces_below_root_are_left_to_stdlib(self):
+        self.assert_same_bytes(b'<cruise xmlns:x="urn:x"><server x:a="1" b="2" /></cruise>')
+
+    def test_edits_give_same_bytes(self):
+        config = texttest_configs()[0]
+        trees = [StdlibCruiseTree.fromstring(config), LxmlCruiseTree.fromstring(config)]
+        for tree in trees:
+            tree.rename_pipeline_group('first', 'second')
+            group = tree.find('pipelines')
+            group.append(group.makeelement('pipeline', {'name': 'new', 'labeltemplate': 'x'}))
+        self.assertEqual(trees[0].tostring(), trees[1].tostring())
+
+
+class ConfigSubsetTests(unittest.TestCase):
+    backends = [StdlibCruiseTree] + ([] if xml_backend.lxml_etree is None else [LxmlCruiseTree])
+
+    @staticmethod
+    def copied_subset(tree):
+        root = copy.deepcopy(tree).getroot()
+        for child in list(root):
+            if child.tag not in tree.test_config_sections:
+                root.remove(child)
+        return StdlibBackend.tostring(root)
+
+    def assert_subset_like_copy(self, config):
+        expected = self.copied_subset(StdlibCruiseTree.fromstring(config))
+        for tree_class in self.backends:
+            tree = tree_class.fromstring(config)
+            self.assertEqual(expected, tree.config_subset_tostring())
+            self.assertEqual(tree_class.fromstring(config).tostring(), tree.tostring())
+
+    def test_texttest_configs(self):
+        for config in texttest_configs():
+            self.assert_subset_like_copy(config)
+
+    def test_sections_in_the_middle(self):
+        self.assert_subset_like_copy(
+            b'<cruise><server /><pipelines group="g"><pipeline name="p" /></pipelines>'
+            b'<templates><pipeline name="t"><stage name="s" /></pipeline></templates><agents /></cruise>')
+
+    def test_no_sections(self):
+        self.assert_subset_like_copy(b'<cruise>\n  <server />\n  <agents />\n</cruise>')
+
+    def test_namespaced_sections(self):
+        self.assert_subset_like_copy(
+            b'<cruise xmlns:x="urn:x"><server /><pipelines group="g" x:a="1" /><agents /></cruise>')
+
+
+class DefaultBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.saved = os.environ.get('GOCDPB_XML_BACKEND')
+
+    def tearDown(self):
+        if self.saved is None:
+            os.environ.pop('GOCDPB_XML_BACKEND', None)
+        else:
+            os.environ['GOCDPB_XML_BACKEND'] = self.saved
+
+    def test_stdlib_can_be_chosen(self):
+        os.environ['GOCDPB_XML_BACKEND'] = 'stdlib'
+        self.assertIs(StdlibBackend, xml_backend.default_backend())
+
+    def test_lxml_when_installed(self):
+        os.environ.pop('GOCDPB_XML_BACKEND', None)
+        expected = StdlibBackend if xml_backend.lxml_etree is None else LxmlBackend
+        self.assertIs(expected, xml_backend.default_backend())
+
+
+if __name__ == '__main__':
+    unittest.main()